@@ -0,0 +1,326 @@
+from typing import Optional, Dict, Any
+import os
+import os.path
+import stat
+import errno
+import shutil
+import hashlib
+import uuid
+import logging
+from threading import Thread, Event, Lock
+
+
+logger = logging.getLogger(__name__)
+
+
+# Directories of flushed tasks wait here for the janitor. It's inside the attachments path so that renames stay
+# on one filesystem.
+TRASH_DIR = ".trash"
+
+
+# Generators write their output here, so that it can be published by rename.
+SCRATCH_DIR = ".scratch"
+
+
+# Content-addressed copies of generated files, hard-linked into task directories.
+BLOBS_DIR = ".blobs"
+# Smaller files aren't worth an inode and a hash.
+DEDUPE_MIN_SIZE = 64 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+# Content hash of a deduplicated file; the attribute belongs to the inode, so all links share it.
+HASH_XATTR = "user.kyzylborda.sha256"
+
+
+def get_trash_path(attachments_path: str) -> str:
+    return os.path.join(attachments_path, TRASH_DIR)
+
+
+def move_to_trash(attachments_path: str, path: str) -> bool:
+    """ Atomically hide a directory from users; it's removed later by TrashJanitor. Returns False if it doesn't exist. """
+    trash_path = get_trash_path(attachments_path)
+    os.makedirs(trash_path, exist_ok=True)
+    try:
+        os.rename(path, os.path.join(trash_path, uuid.uuid4().hex))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def get_scratch_path(attachments_path: str) -> str:
+    return os.path.join(attachments_path, SCRATCH_DIR)
+
+
+def get_blobs_path(attachments_path: str) -> str:
+    return os.path.join(attachments_path, BLOBS_DIR)
+
+
+class PublishStats:
+    """ How generator output has been moved into place in this process. """
+
+    renamed: int
+    copied: int
+    _lock: Lock
+
+    def __init__(self):
+        self.renamed = 0
+        self.copied = 0
+        self._lock = Lock()
+
+    def record(self, copied: bool):
+        with self._lock:
+            if copied:
+                self.copied += 1
+            else:
+                self.renamed += 1
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "renamed": self.renamed,
+                "copied": self.copied,
+            }
+
+
+publish_stats = PublishStats()
+
+
+def publish(from_path: str, to_path: str):
+    """ Move a file or directory into place by rename, falling back to copying across filesystems. """
+    try:
+        os.rename(from_path, to_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        logger.warn(f"'{from_path}' and '{to_path}' are on different filesystems, copying")
+        shutil.move(from_path, to_path)
+        publish_stats.record(copied=True)
+    else:
+        publish_stats.record(copied=False)
+
+
+class DedupeStats:
+    """ Files deduplicated in this process. """
+
+    files: int
+    linked: int
+    bytes_saved: int
+    _lock: Lock
+
+    def __init__(self):
+        self.files = 0
+        self.linked = 0
+        self.bytes_saved = 0
+        self._lock = Lock()
+
+    def record(self, size: int, linked: bool):
+        with self._lock:
+            self.files += 1
+            if linked:
+                self.linked += 1
+                self.bytes_saved += size
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "files": self.files,
+                "linked": self.linked,
+                "bytes_saved": self.bytes_saved,
+            }
+
+
+dedupe_stats = DedupeStats()
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_stored_hash(path: str) -> Optional[str]:
+    """ Content hash stored by dedupe_file, if any. """
+    try:
+        return os.getxattr(path, HASH_XATTR).decode("ascii")
+    except (OSError, AttributeError):
+        # Not deduplicated, or extended attributes aren't supported.
+        return None
+
+
+def store_hash(path: str, file_hash: str):
+    try:
+        os.setxattr(path, HASH_XATTR, file_hash.encode("ascii"))
+    except (OSError, AttributeError):
+        pass
+
+
+def dedupe_file(attachments_path: str, path: str) -> bool:
+    """ Replace a file with a hard link to its blob, or make it the blob if there is none yet.
+        Returns whether the file has been replaced. """
+    file_hash = hash_file(path)
+    store_hash(path, file_hash)
+    blob_dir = os.path.join(get_blobs_path(attachments_path), file_hash[:2])
+    blob_path = os.path.join(blob_dir, file_hash)
+    os.makedirs(blob_dir, exist_ok=True)
+    while True:
+        try:
+            os.link(path, blob_path)
+            return False
+        except FileExistsError:
+            pass
+        link_path = f"{path}.{uuid.uuid4().hex}"
+        try:
+            os.link(blob_path, link_path)
+        except FileNotFoundError:
+            # Collected concurrently; try to become the blob again.
+            continue
+        os.replace(link_path, path)
+        # The blob may predate stored hashes.
+        store_hash(path, file_hash)
+        return True
+
+
+def dedupe_files(attachments_path: str, directory: str):
+    """ Deduplicate large generated files in a directory against all other generated files. """
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                info = os.lstat(path)
+                if not stat.S_ISREG(info.st_mode) or info.st_size < DEDUPE_MIN_SIZE or info.st_nlink > 1:
+                    continue
+                linked = dedupe_file(attachments_path, path)
+            except OSError as e:
+                # E.g. the filesystem doesn't support hard links; the file is fine as it is.
+                logger.warn(f"Failed to deduplicate '{path}': {e}")
+                continue
+            dedupe_stats.record(info.st_size, linked)
+
+
+def collect_blobs(attachments_path: str) -> Dict[str, int]:
+    """ Remove blobs which aren't linked from any task directory; return disk usage of the rest. """
+    blobs = 0
+    removed = 0
+    blob_bytes = 0
+    bytes_saved = 0
+    blobs_path = get_blobs_path(attachments_path)
+    for dirpath, dirnames, filenames in os.walk(blobs_path):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                info = os.lstat(path)
+                # One link is the blob itself.
+                if info.st_nlink <= 1:
+                    os.unlink(path)
+                    removed += 1
+                    continue
+            except FileNotFoundError:
+                continue
+            blobs += 1
+            blob_bytes += info.st_size
+            # Every link but the blob and the first copy would be a separate copy otherwise.
+            bytes_saved += info.st_size * (info.st_nlink - 2)
+    return {
+        "blobs": blobs,
+        "removed": removed,
+        "bytes": blob_bytes,
+        "bytes_saved": bytes_saved,
+    }
+
+
+class TrashJanitor:
+    """ Removes the contents of the trash directory in a background thread, then blobs no longer linked from anywhere.
+
+        Several processes may run janitors for the same directory; they just skip what others have removed. """
+
+    removed: int
+    # Disk usage by blobs after the last collection.
+    blobs: Optional[Dict[str, int]]
+    _attachments_path: str
+    _interval: float
+    _lock: Lock
+    _wakeup: Event
+    _pid: Optional[int]
+
+    def __init__(self, attachments_path: str, interval: float=10):
+        self.removed = 0
+        self.blobs = None
+        self._attachments_path = attachments_path
+        self._interval = interval
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._pid = None
+
+    def start(self):
+        with self._lock:
+            # Threads don't survive fork(), start the janitor in every process.
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                Thread(target=self._run, name="kyzylborda-trash-janitor", daemon=True).start()
+
+    def wake_up(self):
+        """ Don't wait for the next interval. """
+        self._wakeup.set()
+
+    def _remove(self, path: str):
+        def on_error(function, error_path, exc_info):
+            # Another janitor is removing the same directory.
+            if not (isinstance(exc_info[1], OSError) and exc_info[1].errno == errno.ENOENT):
+                raise exc_info[1]
+
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, onerror=on_error)
+        else:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def clean(self):
+        trash_path = get_trash_path(self._attachments_path)
+        try:
+            names = os.listdir(trash_path)
+        except FileNotFoundError:
+            return
+        removed = 0
+        for name in names:
+            try:
+                self._remove(os.path.join(trash_path, name))
+            except Exception as e:
+                logger.error(f"Failed to remove '{name}' from the trash", exc_info=e)
+                continue
+            removed += 1
+        with self._lock:
+            self.removed += removed
+
+        if removed > 0 or self.blobs is None:
+            blobs = collect_blobs(self._attachments_path)
+            if blobs["removed"] > 0:
+                logger.info(f"Removed {blobs['removed']} unused blobs")
+            with self._lock:
+                self.blobs = blobs
+
+    def _run(self):
+        while True:
+            try:
+                self.clean()
+            except Exception as e:
+                logger.error("Failed to clean the trash", exc_info=e)
+            self._wakeup.wait(self._interval)
+            self._wakeup.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        try:
+            pending = len(os.listdir(get_trash_path(self._attachments_path)))
+        except FileNotFoundError:
+            pending = 0
+        with self._lock:
+            return {
+                "pending": pending,
+                "removed": self.removed,
+                "blobs": self.blobs,
+            }
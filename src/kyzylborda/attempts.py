@@ -0,0 +1,155 @@
+from typing import Optional, List, Dict, Deque, Any
+import os
+import atexit
+import logging
+from collections import deque
+from datetime import datetime
+from threading import Thread, Condition
+from sqlalchemy.exc import OperationalError, InterfaceError
+
+from .utils import utc_now
+from .tasks import TaskName, Flag
+from .db import SubmissionAttempt
+
+
+logger = logging.getLogger(__name__)
+
+
+# Attempts kept in memory while the database is unavailable; older ones are dropped.
+MAX_BUFFERED_ATTEMPTS = 100000
+
+
+def is_transient_error(e: Exception) -> bool:
+    """ Whether writing may succeed later, as opposed to rows which will never be accepted. """
+    return isinstance(e, (OperationalError, InterfaceError)) or getattr(e, "connection_invalidated", False)
+
+
+class AttemptLog:
+    """ Buffered writer of flag submission attempts.
+
+        Attempts are written by a background thread with multi-row INSERTs, when either the batch
+        is full or the flush interval has passed, so recording an attempt never waits for the database.
+        Batches failing for reasons other than database availability are written row by row, and rows which
+        are rejected (say, of users deleted in the meantime) are dropped. """
+
+    written: int
+    dropped: int
+    rejected: int
+    _db_engine: Any
+    _batch_size: int
+    _flush_interval: float
+    _condition: Condition
+    _buffer: Deque[Dict[str, Any]]
+    _thread: Optional[Thread]
+    _pid: Optional[int]
+
+    def __init__(self, db_engine, batch_size: int=500, flush_interval: float=1):
+        self.written = 0
+        self.dropped = 0
+        self.rejected = 0
+        self._db_engine = db_engine
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._condition = Condition()
+        self._buffer = deque()
+        self._thread = None
+        self._pid = None
+        atexit.register(self.flush)
+
+    def record(self, submitter_id: int, flag: Flag, result: str, task_name: Optional[TaskName]=None, owner_id: Optional[int]=None, remote_addr: Optional[str]=None, attempt_time: Optional[datetime]=None):
+        row = {
+            "submitter_id": submitter_id,
+            "flag": flag,
+            "result": result,
+            "task_name": task_name,
+            "owner_id": owner_id,
+            "remote_addr": remote_addr,
+            # Naive UTC, like other timestamps in the database.
+            "attempt_time": (attempt_time or utc_now()).replace(tzinfo=None),
+        }
+        with self._condition:
+            # Threads don't survive fork(), start the writer in every worker.
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = Thread(target=self._run, name="kyzylborda-attempts", daemon=True)
+                self._thread.start()
+            self._buffer.append(row)
+            if len(self._buffer) > MAX_BUFFERED_ATTEMPTS:
+                self._buffer.popleft()
+                self.dropped += 1
+            if len(self._buffer) >= self._batch_size:
+                self._condition.notify()
+
+    def _take_batch(self) -> List[Dict[str, Any]]:
+        count = min(self._batch_size, len(self._buffer))
+        return [self._buffer.popleft() for i in range(count)]
+
+    def _put_back(self, batch: List[Dict[str, Any]]):
+        with self._condition:
+            # Retry them with the next batch.
+            self._buffer.extendleft(reversed(batch))
+            while len(self._buffer) > MAX_BUFFERED_ATTEMPTS:
+                self._buffer.popleft()
+                self.dropped += 1
+
+    def _write_rows(self, batch: List[Dict[str, Any]]) -> bool:
+        for i, row in enumerate(batch):
+            try:
+                with self._db_engine.begin() as conn:
+                    conn.execute(SubmissionAttempt.__table__.insert().values(row))
+            except Exception as e:
+                if is_transient_error(e):
+                    logger.error(f"Failed to write {len(batch) - i} submission attempts", exc_info=e)
+                    self._put_back(batch[i:])
+                    return False
+                logger.error(f"Dropping submission attempt {row}", exc_info=e)
+                with self._condition:
+                    self.rejected += 1
+            else:
+                with self._condition:
+                    self.written += 1
+        return True
+
+    def _write(self, batch: List[Dict[str, Any]]) -> bool:
+        try:
+            with self._db_engine.begin() as conn:
+                conn.execute(SubmissionAttempt.__table__.insert().values(batch))
+        except Exception as e:
+            if not is_transient_error(e):
+                # Find the rows at fault instead of retrying the batch forever.
+                logger.warn(f"Failed to write {len(batch)} submission attempts, writing them one by one: {e}")
+                return self._write_rows(batch)
+            logger.error(f"Failed to write {len(batch)} submission attempts", exc_info=e)
+            self._put_back(batch)
+            return False
+        with self._condition:
+            self.written += len(batch)
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if len(self._buffer) < self._batch_size:
+                    self._condition.wait(self._flush_interval)
+                batch = self._take_batch()
+            if len(batch) > 0 and not self._write(batch):
+                with self._condition:
+                    # Back off before retrying.
+                    self._condition.wait(self._flush_interval)
+
+    def flush(self):
+        """ Write all buffered attempts synchronously. """
+        while True:
+            with self._condition:
+                batch = self._take_batch()
+            if len(batch) == 0 or not self._write(batch):
+                break
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._condition:
+            return {
+                "buffered": len(self._buffer),
+                "written": self.written,
+                "dropped": self.dropped,
+                "rejected": self.rejected,
+            }
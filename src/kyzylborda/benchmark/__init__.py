@@ -0,0 +1,251 @@
+import os
+import io
+import sys
+import csv
+import json
+import random
+import logging
+import tempfile
+import statistics
+from argparse import ArgumentParser
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+from typing import List, Dict, Callable, Any, Optional
+import yaml
+import sqlalchemy
+from flask import g, render_template, json as flask_json
+
+from ..db import Base, User
+from ..tasks import Task, Hint
+from ..cache import TasksCache, build_tasks_cache
+from ..scoring import Scoreboard, query_scores, aggregate_scores, rank_scores, score_users_sql
+from ..web.scoring import make_scoreboard_response
+from ..web.ctftime import make_standings_response
+
+
+logger = logging.getLogger(__name__)
+
+
+arg_parser = ArgumentParser(description="Benchmark the scoreboard on a synthetic contest.")
+arg_parser.add_argument("-d", "--database", required=True, help="database URL; it is wiped if seeding is enabled")
+arg_parser.add_argument("-o", "--output", help="path to JSON results (default: stdout)")
+arg_parser.add_argument("-l", "--label", default="", help="label stored with results, e.g. revision")
+arg_parser.add_argument("--users", type=int, default=50000, help="number of users")
+arg_parser.add_argument("--tasks", type=int, default=300, help="number of tasks")
+arg_parser.add_argument("--submissions", type=int, default=2000000, help="number of accepted flags")
+arg_parser.add_argument("--hints", type=int, default=200000, help="number of granted hints")
+arg_parser.add_argument("--tags", default="default,school,academic", help="comma-separated user tags")
+arg_parser.add_argument("--organizers", type=float, default=0.001, help="fraction of organizers")
+arg_parser.add_argument("--disqualified", type=float, default=0.01, help="fraction of disqualified users")
+arg_parser.add_argument("--seed", type=int, default=0, help="random seed")
+arg_parser.add_argument("--no-seed", action="store_true", help="reuse data already in the database")
+arg_parser.add_argument("--repeat", type=int, default=3, help="number of measurements per stage")
+arg_parser.add_argument("--events", type=int, default=10000, help="number of incremental events to apply")
+
+
+HINTS_PER_TASK = 2
+COPY_CHUNK = 100000
+
+
+def make_tasks(count: int, rnd: random.Random) -> TasksCache:
+    tasks = []
+    for i in range(count):
+        tasks.append(Task(
+            path=f"synthetic/task{i}.yaml",
+            name=f"task{i}",
+            title=f"Task {i}",
+            category=rnd.choice(["web", "crypto", "pwn", "reverse", "forensics"]),
+            points=rnd.randrange(50, 501, 50),
+            author="benchmark",
+            description="",
+            flags={f"flag_task{i}"},
+            hints=[Hint(name=f"hint{j}", points=rnd.randrange(10, 100, 10), text="") for j in range(HINTS_PER_TASK)],
+        ))
+    return build_tasks_cache(tasks)
+
+
+def copy_rows(connection, table: str, columns: List[str], rows):
+    cursor = connection.cursor()
+    chunk = io.StringIO()
+    writer = csv.writer(chunk)
+    count = 0
+
+    def flush():
+        chunk.seek(0)
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", chunk)
+        chunk.seek(0)
+        chunk.truncate()
+
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % COPY_CHUNK == 0:
+            flush()
+    flush()
+    connection.commit()
+
+
+def seed_database(db_engine, args, tasks_cache: TasksCache, rnd: random.Random):
+    Base.metadata.drop_all(db_engine)
+    Base.metadata.create_all(db_engine)
+
+    tags = args.tags.split(",")
+    start = datetime(2022, 4, 2, 10, 0)
+    task_names = list(tasks_cache.tasks.keys())
+
+    connection = db_engine.raw_connection()
+    try:
+        logger.info(f"Seeding {args.users} users")
+        def user_rows():
+            for i in range(1, args.users + 1):
+                user_tags = "{" + ",".join(rnd.sample(tags, rnd.randint(1, len(tags)))) + "}"
+                yield (i, f"user{i}", f"User {i}", user_tags, rnd.random() < args.organizers, rnd.random() < args.disqualified, start - timedelta(seconds=rnd.randrange(86400)))
+        copy_rows(connection, "users", ["id", "login", "name", "tags", "is_organizer", "is_disqualified", "signup_time"], user_rows())
+
+        pairs = args.users * len(task_names)
+        logger.info(f"Seeding {args.submissions} submitted flags")
+        def flag_rows():
+            for id, pair in enumerate(rnd.sample(range(pairs), min(args.submissions, pairs)), 1):
+                user, task = divmod(pair, len(task_names))
+                yield (id, task_names[task], f"flag_{task_names[task]}", user + 1, start + timedelta(seconds=rnd.randrange(8 * 3600)))
+        copy_rows(connection, "submitted_flags", ["id", "task_name", "flag", "submitter_id", "accept_time"], flag_rows())
+
+        logger.info(f"Seeding {args.hints} granted hints")
+        def hint_rows():
+            for id, pair in enumerate(rnd.sample(range(pairs * HINTS_PER_TASK), min(args.hints, pairs * HINTS_PER_TASK)), 1):
+                user_task, hint = divmod(pair, HINTS_PER_TASK)
+                user, task = divmod(user_task, len(task_names))
+                yield (id, task_names[task], f"hint{hint}", user + 1, start)
+        copy_rows(connection, "granted_hints", ["id", "task_name", "hint_name", "requester_id", "request_time"], hint_rows())
+
+        cursor = connection.cursor()
+        for table in ["users", "submitted_flags", "granted_hints"]:
+            cursor.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT max(id) FROM {table}))")
+            cursor.execute(f"ANALYZE {table}")
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def measure(results: Dict[str, Dict[str, Any]], name: str, repeat: int, func: Callable[[], Any]) -> Any:
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        ret = func()
+        timings.append(perf_counter() - start)
+    results[name] = {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "max": max(timings),
+        "runs": len(timings),
+    }
+    logger.info(f"{name}: {min(timings):.4f}s min, {statistics.median(timings):.4f}s median")
+    return ret
+
+
+def make_render_app(database: str, tmp_dir: str):
+    # Templates need the real application for routes, translations and globals.
+    from ..web import make_app
+
+    config_path = os.path.join(tmp_dir, "config.yaml")
+    with open(config_path, "w") as f:
+        yaml.dump({
+            "DATABASE": database,
+            "TZ": "UTC",
+            "TITLE": "Benchmark",
+            "SECRET_KEY": "benchmark",
+            "TASKS_PATH": tmp_dir,
+            "DYNAMIC_ATTACHMENTS_PATH": os.path.join(tmp_dir, "attachments"),
+        }, f)
+    return make_app(config_path)
+
+
+def run_benchmark(args, db, tasks_cache: TasksCache, tmp_dir: str) -> Dict[str, Dict[str, Any]]:
+    repeat = args.repeat
+    results: Dict[str, Dict[str, Any]] = {}
+    tasks = [task_cache.task for task_cache in tasks_cache.tasks.values()]
+
+    rows = measure(results, "python.query", repeat, lambda: query_scores(db, is_organizer=False))
+    aggregated = measure(results, "python.aggregation", repeat, lambda: aggregate_scores(tasks_cache, *rows))
+    # Ranking modifies scores in place, but only the ranks which are recomputed anyway.
+    scores = measure(results, "python.ranking", repeat, lambda: rank_scores(aggregated))
+
+    measure(results, "sql.query", repeat, lambda: score_users_sql(tasks_cache, db, is_organizer=False))
+
+    def rebuild():
+        scoreboard = Scoreboard()
+        scoreboard.refresh(tasks_cache, db)
+        return scoreboard
+    scoreboard = measure(results, "memory.rebuild", repeat, rebuild)
+    measure(results, "memory.catch_up", repeat, lambda: scoreboard.catch_up(db))
+    def snapshot():
+        # Invalidate cached snapshots.
+        scoreboard.version += 1
+        return scoreboard.score_users(tasks_cache, db, is_organizer=False)
+    measure(results, "memory.snapshot", repeat, snapshot)
+    measure(results, "memory.cached_read", repeat, lambda: scoreboard.score_users(tasks_cache, db, is_organizer=False))
+
+    rnd = random.Random(args.seed + 1)
+    users = db.query(User).all()
+    task_names = list(tasks_cache.tasks.keys())
+    def apply_events():
+        time = datetime.now(timezone.utc)
+        for _ in range(args.events):
+            user = rnd.choice(users)
+            scoreboard.add_flag(user, rnd.choice(task_names), time)
+    measure(results, "memory.events", 1, apply_events)
+    results["memory.events"]["per_event"] = results["memory.events"]["min"] / max(1, args.events)
+
+    app = make_render_app(args.database, tmp_dir)
+    with app.test_request_context("/scores"):
+        measure(results, "serialization.json", repeat, lambda: flask_json.dumps(make_scoreboard_response(scores, tasks)))
+        measure(results, "serialization.ctftime", repeat, lambda: flask_json.dumps(make_standings_response(scores, tasks)))
+        g.tasks_cache = tasks_cache
+        measure(results, "render.scores", repeat, lambda: render_template("scores.html", scores=scores, tasks=tasks, named_scoreboards=[]))
+        measure(results, "render.board", repeat, lambda: render_template("board.html", scores=scores, tasks=None, named_scoreboards=[], redirect=None))
+
+    return results
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+
+    args = arg_parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    tasks_cache = make_tasks(args.tasks, rnd)
+
+    db_engine = sqlalchemy.create_engine(args.database)
+    if not args.no_seed:
+        seed_database(db_engine, args, tasks_cache, rnd)
+    db = sqlalchemy.orm.sessionmaker(bind=db_engine)()
+
+    with tempfile.TemporaryDirectory(prefix="kyzylborda_benchmark_") as tmp_dir:
+        results = run_benchmark(args, db, tasks_cache, tmp_dir)
+
+    output = {
+        "label": args.label,
+        "time": datetime.now(timezone.utc).isoformat(),
+        "parameters": {
+            "users": args.users,
+            "tasks": args.tasks,
+            "submissions": args.submissions,
+            "hints": args.hints,
+            "tags": args.tags.split(","),
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "events": args.events,
+        },
+        "results": results,
+    }
+    if args.output is None:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -51,6 +51,8 @@ class TasksCache:
     tasks: Dict[TaskName, TaskCache]
     static_flags: Dict[Flag, TaskName]
     multi_generators: Dict[MultiGeneratorKey, MultiGeneratorCache]
+    hmac_flag_prefixes: Dict[str, List[TaskName]] = field(default_factory=dict)
+    flag_secret: Optional[bytes] = None
 
     def get_task(self, task_name: TaskName, user: Optional[User]=None):
         task_cache = self.tasks[task_name]
@@ -169,7 +171,7 @@ def validate_tasks_cache(tasks: Iterable[Task]) -> Dict[TaskName, TaskCache]:
     return tasks_dict
 
 
-def finalize_tasks_cache(tasks_dict: Dict[TaskName, TaskCache]) -> TasksCache:
+def finalize_tasks_cache(tasks_dict: Dict[TaskName, TaskCache], flag_secret: Optional[bytes]=None) -> TasksCache:
     tasks_list = list(tasks_dict.values())
     # We sort the list here because Python 3.6+ guarantees order in dictionaries;
     # hence we get a default sort.
@@ -187,16 +189,23 @@ def finalize_tasks_cache(tasks_dict: Dict[TaskName, TaskCache]) -> TasksCache:
             generator_cache = set_factory(multi_generators, task_cache.task.generator.multi_generator_key, lambda: MultiGeneratorCache(generator=task_cache.task.generator))
             generator_cache.tasks.add(name)
 
+    hmac_flag_prefixes: Dict[str, List[TaskName]] = {}
+    for name, task_cache in tasks_dict.items():
+        if task_cache.task.hmac_flag is not None:
+            hmac_flag_prefixes.setdefault(task_cache.task.hmac_flag.prefix, []).append(name)
+
     return TasksCache(
         tasks=tasks_dict,
         static_flags=static_flags,
         multi_generators=multi_generators,
+        hmac_flag_prefixes=hmac_flag_prefixes,
+        flag_secret=flag_secret,
     )
 
 
-def build_tasks_cache(tasks: Iterable[Task]) -> TasksCache:
+def build_tasks_cache(tasks: Iterable[Task], flag_secret: Optional[bytes]=None) -> TasksCache:
     tasks_dict = validate_tasks_cache(tasks)
-    return finalize_tasks_cache(tasks_dict)
+    return finalize_tasks_cache(tasks_dict, flag_secret=flag_secret)
 
 
 def db_sanity_check(tasks: TasksCache, db):
@@ -1,7 +1,7 @@
 from typing import Type, Any
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql.expression import text
-from sqlalchemy import Column, Integer, Text, Boolean, DateTime, ForeignKey, UniqueConstraint, CheckConstraint
+from sqlalchemy import Column, Integer, Text, Boolean, DateTime, ForeignKey, UniqueConstraint, CheckConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import JSONB, UUID, ARRAY
 
@@ -79,3 +79,41 @@ class GeneratedFlag(Base): # type: ignore
     flag = Column(Text, nullable=False, unique=True)
 
     task = relationship(GeneratedTask, lazy="raise")
+
+
+class SubmissionAttempt(Base): # type: ignore
+    __tablename__ = "submission_attempts"
+
+    id = Column(Integer, primary_key=True)
+    submitter_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    flag = Column(Text, nullable=False)
+    # One of "accepted", "exists", "not_found", "stolen", "wrong_task", "too_late" and "throttled".
+    result = Column(Text, nullable=False)
+    # Task the flag belongs to, when known.
+    task_name = Column(Text, nullable=True)
+    # Owner of a stolen flag.
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="SET NULL"), nullable=True)
+    remote_addr = Column(Text, nullable=True)
+    attempt_time = Column(DateTime, nullable=False)
+
+
+class QueuedGeneration(Base): # type: ignore
+    __tablename__ = "queued_generations"
+    # One job per user and generator; any number of pre-generation jobs.
+    __table_args__ = (Index("queued_generations_user_generator_key", "generator", "user_id", unique=True, postgresql_where=text("user_id IS NOT NULL")),)
+
+    id = Column(Integer, primary_key=True)
+    # Task to run the generator for.
+    task_name = Column(Text, nullable=False)
+    # Tasks generated together, see generate.generator_key.
+    generator = Column(Text, nullable=False)
+    # Null here means pre-generation.
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=True)
+    # Lower goes first.
+    priority = Column(Integer, nullable=False)
+    run_after = Column(DateTime, nullable=False, server_default=text("(now() at time zone 'utc')"))
+    attempts = Column(Integer, nullable=False, server_default=text("0"))
+    error = Column(Text, nullable=True)
+    # Worker running the job; it's available again if the worker doesn't renew the lease in time.
+    claimed_by = Column(Text, nullable=True)
+    lease_until = Column(DateTime, nullable=True)
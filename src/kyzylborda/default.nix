@@ -18,6 +18,7 @@
 , pytz
 , dateutil
 , pyyaml
+, sortedcontainers
 , watchdog
 , mypy
 , gunicorn
@@ -71,6 +72,7 @@ in buildPythonPackage {
     pytz
     dateutil
     pyyaml
+    sortedcontainers
     watchdog
     pyjwt
     aiohttp-xmlrpc
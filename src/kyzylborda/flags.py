@@ -1,24 +1,36 @@
 import logging
-from typing import Optional
+import hmac
+import hashlib
+import re
+from typing import Optional, Dict, List, Tuple, Any
+from threading import Lock
 from sqlalchemy.exc import IntegrityError
 
 from .utils import utc_now
 from .cache import TasksCache, task_can_submit
-from .tasks import TaskName, Task
+from .tasks import TaskName, Task, Flag
 from .db import User, SubmittedFlag, GeneratedTask, GeneratedFlag
+from .scoring import Scoreboard
+from .notify import NotifyListener
 
 
 logger = logging.getLogger(__name__)
 
 
+HMAC_FLAG_USER_REGEX = re.compile(r"([0-9]+)_")
+
+
 class FlagExistsError(Exception):
-    pass
+    def __init__(self, task_name):
+        super().__init__(task_name)
+        self.task_name = task_name
 
 
 class FlagStolenError(Exception):
-    def __init__(self, user_id):
-        super().__init__(user_id)
+    def __init__(self, user_id, task_name):
+        super().__init__(user_id, task_name)
         self.user_id = user_id
+        self.task_name = task_name
 
 
 class FlagNotFoundError(Exception):
@@ -32,20 +44,165 @@ class FlagForWrongTaskError(Exception):
 
 
 class FlagTooLateError(Exception):
-    pass
+    def __init__(self, task_name):
+        super().__init__(task_name)
+        self.task_name = task_name
 
 
-def submit_flag(db, tasks_cache: TasksCache, user: User, flag: str, accept_only_task: Optional[TaskName]=None) -> str:
+class FlagIndex:
+    """ In-memory index of generated flags, kept consistent with the database by notifications.
+
+        Notifications received while the index is being loaded are applied after the load. """
+
+    loaded: bool
+    _listener: Optional[NotifyListener]
+    _lock: Lock
+    # Generated task id -> (task name, user id).
+    _tasks: Dict[int, Tuple[TaskName, Optional[int]]]
+    _task_flags: Dict[int, List[Flag]]
+    _flags: Dict[Flag, int]
+    _pending: Optional[List[Dict[str, Any]]]
+
+    def __init__(self):
+        self.loaded = False
+        self._listener = None
+        self._lock = Lock()
+        self._tasks = {}
+        self._task_flags = {}
+        self._flags = {}
+        self._pending = None
+
+    def subscribe(self, listener: NotifyListener, db):
+        self._listener = listener
+        listener.add_handler("flags_added", self._handle)
+        listener.add_handler("tasks_claimed", self._handle)
+        listener.add_handler("tasks_deleted", self._handle)
+
+        def reload():
+            try:
+                self.load(db)
+            finally:
+                db.remove()
+        listener.add_connect_handler(reload)
+
+    def load(self, db):
+        with self._lock:
+            self._pending = []
+        try:
+            tasks: Dict[int, Tuple[TaskName, Optional[int]]] = {}
+            task_flags: Dict[int, List[Flag]] = {}
+            flags: Dict[Flag, int] = {}
+            for task_id, task_name, user_id in db.query(GeneratedTask.id, GeneratedTask.task_name, GeneratedTask.user_id):
+                tasks[task_id] = (task_name, user_id)
+            for task_id, flag in db.query(GeneratedFlag.task_id, GeneratedFlag.flag):
+                task_flags.setdefault(task_id, []).append(flag)
+                flags[flag] = task_id
+        except:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            self._tasks = tasks
+            self._task_flags = task_flags
+            self._flags = flags
+            pending = self._pending
+            self._pending = None
+            for payload in pending:
+                self._apply(payload)
+            self.loaded = True
+        logger.info(f"Flag index loaded, {len(flags)} flags total")
+
+    def is_current(self) -> bool:
+        """ Whether the index is loaded and no notifications can have been missed since, so that misses can be trusted. """
+        with self._lock:
+            return self.loaded and self._pending is None and self._listener is not None and self._listener.connected
+
+    def _handle(self, payload: Dict[str, Any]):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(payload)
+            else:
+                self._apply(payload)
+
+    def _apply(self, payload: Dict[str, Any]):
+        if payload["type"] == "flags_added":
+            task_id = payload["task_id"]
+            # The task might have been claimed before its generation has finished.
+            task_name, user_id = self._tasks.get(task_id, (payload["task_name"], None))
+            if user_id is None:
+                user_id = payload["user_id"]
+            self._tasks[task_id] = (task_name, user_id)
+            task_flags = self._task_flags.setdefault(task_id, [])
+            for flag in payload["flags"]:
+                task_flags.append(flag)
+                self._flags[flag] = task_id
+        elif payload["type"] == "tasks_claimed":
+            for raw_task_id, task_name in payload["tasks"].items():
+                self._tasks[int(raw_task_id)] = (task_name, payload["user_id"])
+        elif payload["type"] == "tasks_deleted":
+            for task_id in payload["task_ids"]:
+                self._tasks.pop(task_id, None)
+                for flag in self._task_flags.pop(task_id, []):
+                    self._flags.pop(flag, None)
+
+    def lookup(self, flag: Flag) -> Optional[Tuple[TaskName, Optional[int]]]:
+        """ Find task name and user id for a generated flag. User id is None for tasks which are not claimed yet. """
+        with self._lock:
+            task_id = self._flags.get(flag)
+            if task_id is None:
+                return None
+            return self._tasks.get(task_id)
+
+
+def derive_hmac_flag(tasks_cache: TasksCache, task: Task, user_id: int) -> Flag:
+    """ Derive per-user flag for a task with HMAC flags. User id is kept in the flag so that stolen flags can be attributed. """
+    assert task.hmac_flag is not None
+    if tasks_cache.flag_secret is None:
+        raise RuntimeError(f"Flag secret is not configured, cannot derive flag for task '{task.name}'")
+    mac = hmac.new(tasks_cache.flag_secret, f"{task.name}:{user_id}".encode("utf-8"), hashlib.sha256).hexdigest()
+    return f"{task.hmac_flag.prefix}{user_id}_{mac[:task.hmac_flag.length]}"
+
+
+def lookup_hmac_flag(tasks_cache: TasksCache, flag: Flag) -> Optional[Tuple[TaskName, int]]:
+    if tasks_cache.flag_secret is None:
+        return None
+    for prefix, task_names in tasks_cache.hmac_flag_prefixes.items():
+        if not flag.startswith(prefix):
+            continue
+        match = HMAC_FLAG_USER_REGEX.match(flag, len(prefix))
+        if match is None:
+            continue
+        user_id = int(match.group(1))
+        for task_name in task_names:
+            expected_flag = derive_hmac_flag(tasks_cache, tasks_cache.tasks[task_name].task, user_id)
+            if hmac.compare_digest(expected_flag, flag):
+                return (task_name, user_id)
+    return None
+
+
+def lookup_generated_flag(db, flag: Flag, flag_index: Optional[FlagIndex]=None) -> Optional[Tuple[TaskName, Optional[int]]]:
+    if flag_index is not None and flag_index.is_current():
+        task_row = flag_index.lookup(flag)
+        # Pre-generated tasks may have been claimed just now; only the database knows for sure.
+        if task_row is None or task_row[1] is not None:
+            return task_row
+    return db.query(GeneratedFlag).join(GeneratedTask).filter(GeneratedFlag.flag == flag).with_entities(GeneratedTask.task_name, GeneratedTask.user_id).one_or_none()
+
+
+def submit_flag(db, tasks_cache: TasksCache, user: User, flag: str, accept_only_task: Optional[TaskName]=None, scoreboard: Optional[Scoreboard]=None, flag_index: Optional[FlagIndex]=None) -> str:
     if flag in tasks_cache.static_flags:
         task_name = tasks_cache.static_flags[flag]
     else:
-        task_row = db.query(GeneratedFlag).join(GeneratedTask).filter(GeneratedFlag.flag == flag).with_entities(GeneratedTask.task_name, GeneratedTask.user_id).one_or_none()
+        task_row: Optional[Tuple[TaskName, Optional[int]]] = lookup_hmac_flag(tasks_cache, flag)
+        if task_row is None:
+            task_row = lookup_generated_flag(db, flag, flag_index=flag_index)
         if task_row is None:
             raise FlagNotFoundError()
         task_name = task_row[0]
         task_user = task_row[1]
         if task_user != user.id:
-            raise FlagStolenError(task_user)
+            raise FlagStolenError(task_user, task_name)
 
     try:
         # Check that task is not invisible.
@@ -70,10 +227,13 @@ def submit_flag(db, tasks_cache: TasksCache, user: User, flag: str, accept_only_
     except IntegrityError as e:
         logger.warn(f"Error while submitting flag '{flag}' for task '{task_name}' by user '{user.login}'", exc_info=e)
         db.rollback()
-        raise FlagExistsError()
+        raise FlagExistsError(task_name)
+
+    if scoreboard is not None:
+        scoreboard.add_flag(user, task_name, time)
 
     if not task_can_submit(time, task_cache.task):
         logger.warn(f"Flag '{flag}' for task '{task_name}' by user '{user.login}' is submitted too late (at {time}, after {task_cache.task.submit_not_after})")
-        raise FlagTooLateError()
+        raise FlagTooLateError(task_name)
 
     return task_name
@@ -1,5 +1,6 @@
-from typing import Dict, Set, List, Any, Optional, Callable, Iterable
+from typing import Dict, Set, List, Tuple, Any, Optional, Callable, Iterable, Iterator
 import logging
+import hashlib
 import errno
 import sys
 import os
@@ -9,18 +10,32 @@ from tempfile import TemporaryDirectory
 import json
 import shutil
 import uuid
+import time
+from contextlib import contextmanager
+from threading import Lock
 from dataclasses import dataclass, field
 from dataclasses_json import dataclass_json
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql.expression import text
 
 from .utils import get_factory, list_files
 from .cache import TasksCache, TaskCache, MultiGeneratorCache
 from .db import User, GeneratedTask, GeneratedFlag
 from .tasks import Task, TaskName, Flag
+from .notify import notify
+from .flags import derive_hmac_flag
+from .generator_workers import get_generator_workers
+from .attachments import move_to_trash, publish, get_scratch_path, dedupe_files
 
 
 logger = logging.getLogger(__name__)
 
 
+# Tasks generated together, as a sorted comma-separated list of names.
+GeneratorKey = str
+
+
 @dataclass_json
 @dataclass(frozen=True)
 class GeneratedTaskOutput:
@@ -52,35 +67,98 @@ def move_pregenerated(attachments_path: str, task_entries: Dict[TaskName, Genera
         pass
 
 
-def try_use_pregenerated_task(db, attachments_path: str, user: User, tasks: List[TaskName]) -> Optional[Dict[TaskName, GeneratedTask]]:
-    initial_task_name = tasks[0]
-    while True:
-        pregenerated_seed = db.query(GeneratedTask.random_seed).filter_by(user_id=None, task_name=initial_task_name).limit(1).scalar()
-        if pregenerated_seed is None:
-            break
+# Generated instances deleted in one transaction.
+FLUSH_BATCH_SIZE = 500
+
+# A claim may lose a race for some of the tasks of a multi-generator; it's retried with another seed.
+MAX_CLAIM_RETRIES = 3
+
+
+class ClaimStats:
+    """ Latency and outcomes of claims of pre-generated tasks in this process. """
+
+    claimed: int
+    missed: int
+    retries: int
+    total_latency: float
+    max_latency: float
+    _lock: Lock
+
+    def __init__(self):
+        self.claimed = 0
+        self.missed = 0
+        self.retries = 0
+        self.total_latency = 0
+        self.max_latency = 0
+        self._lock = Lock()
 
-        # Try and claim some tasks.
-        pregenerated_tasks = db.query(GeneratedTask).filter(GeneratedTask.random_seed == pregenerated_seed, GeneratedTask.task_name.in_(tasks)).with_for_update(skip_locked=True).all()
-        if len(pregenerated_tasks) < len(tasks):
-            if len(pregenerated_tasks) > 0:
+    def record(self, latency: float, retries: int, claimed: bool):
+        with self._lock:
+            if claimed:
+                self.claimed += 1
+            else:
+                self.missed += 1
+            self.retries += retries
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            attempts = self.claimed + self.missed
+            return {
+                "claimed": self.claimed,
+                "missed": self.missed,
+                "retries": self.retries,
+                "avg_latency": self.total_latency / attempts if attempts > 0 else None,
+                "max_latency": self.max_latency,
+            }
+
+
+claim_stats = ClaimStats()
+
+
+def try_use_pregenerated_task(db, attachments_path: str, user: User, tasks: List[TaskName]) -> Optional[Dict[TaskName, GeneratedTask]]:
+    start = time.perf_counter()
+    retries = 0
+    task_entries: Optional[Dict[TaskName, GeneratedTask]] = None
+    try:
+        # Claims of every task of a multi-generator lock the row of the same task, so they skip each other's seeds.
+        lock_task_name = min(tasks)
+        pregenerated = aliased(GeneratedTask)
+        seed_query = select(pregenerated.random_seed).where(pregenerated.user_id.is_(None), pregenerated.task_name == lock_task_name)
+        if len(tasks) > 1:
+            # Skip incomplete sets, e.g. after a task has been added to the multi-generator.
+            siblings = select(func.count()).where(GeneratedTask.random_seed == pregenerated.random_seed, GeneratedTask.user_id.is_(None), GeneratedTask.task_name.in_(tasks)).scalar_subquery()
+            seed_query = seed_query.where(siblings == len(tasks))
+        claim = update(GeneratedTask).where(
+            GeneratedTask.user_id.is_(None),
+            GeneratedTask.task_name.in_(tasks),
+            GeneratedTask.random_seed == seed_query.limit(1).with_for_update(skip_locked=True).scalar_subquery(),
+        ).values(user_id=user.id).returning(*GeneratedTask.__table__.c)
+
+        while True:
+            claimed = db.execute(select(GeneratedTask).from_statement(claim).execution_options(populate_existing=True)).scalars().all()
+            if len(claimed) == 0:
+                db.rollback()
+                return None
+            if len(claimed) < len(tasks):
+                # Some tasks of the seed have been claimed or deleted concurrently.
                 db.rollback()
-            continue
-        assert len(pregenerated_tasks) == len(tasks)
+                retries += 1
+                if retries > MAX_CLAIM_RETRIES:
+                    return None
+                continue
 
-        for task in pregenerated_tasks:
-            task.user_id = user.id
-        db.commit()
-        is_finished = db.query(GeneratedTask.substitutions.isnot(None)).filter_by(id=pregenerated_tasks[0].id).one_or_none()
-        if is_finished is None:
-            # Tasks have vanished (failed to generate?).
-            continue
-        else:
-            task_entries = {task.task_name: task for task in pregenerated_tasks}
-            if is_finished:
+            notify(db, "tasks_claimed", user_id=user.id, tasks={task.id: task.task_name for task in claimed})
+            db.commit()
+            task_entries = {task.task_name: task for task in claimed}
+            if all(task.substitutions is not None for task in claimed):
+                # Otherwise the generator moves files when it finishes.
                 # Race condition: files may still not be moved when other client gets this "finished" generated entry.
                 move_pregenerated(attachments_path, task_entries, user)
             return task_entries
-    return None
+    finally:
+        claim_stats.record(time.perf_counter() - start, retries, task_entries is not None)
 
 
 # Returns set of tasks with files.
@@ -90,7 +168,9 @@ def run_task_generator(
         tasks_cache: TasksCache,
         initial_task_cache: TaskCache,
         random_seed: uuid.UUID,
-        parent_dir: str
+        parent_dir: str,
+        flags: Optional[Dict[TaskName, Flag]]=None,
+        scratch_dir: Optional[str]=None
     ):
     initial_task = initial_task_cache.task
     if initial_task.generator is None:
@@ -111,27 +191,24 @@ def run_task_generator(
                 dirnames, filenames = list_files(top_dir)
                 for dirname in dirnames:
                     logger.warn(f"Generator for '{name}' created a directory '{dirname}' as an attachment; ignored")
+                    shutil.rmtree(os.path.join(top_dir, dirname))
                 if len(filenames) > 0:
-                    result_dir = os.path.join(parent_dir, name, "attachments")
-                    os.makedirs(result_dir)
-                    for filename in filenames:
-                        from_file = os.path.join(top_dir, filename)
-                        to_file = os.path.join(result_dir, filename)
-                        shutil.move(from_file, to_file)
+                    task_dir = os.path.join(parent_dir, name)
+                    os.makedirs(task_dir, exist_ok=True)
+                    publish(top_dir, os.path.join(task_dir, top_dirname))
             elif top_dirname == "static":
                 dirnames, filenames = list_files(top_dir)
                 if len(filenames) > 0 or len(dirnames) > 0:
                     task_dir = os.path.join(parent_dir, name)
                     os.makedirs(task_dir, exist_ok=True)
-                    to_dir = os.path.join(task_dir, top_dirname)
-                    shutil.move(top_dir, to_dir)
+                    publish(top_dir, os.path.join(task_dir, top_dirname))
             else:
                 logger.warn(f"Generator for '{name}' created an unknown directory '{top_dirname}'; ignored")
 
 
     def convert_task_result(task: Task, raw_output: Dict[TaskName, Any]):
         output = GeneratedTaskOutput.from_dict(raw_output) # type: ignore
-        if len(output.flags) == 0 and len(task.flags) == 0:
+        if len(output.flags) == 0 and len(task.flags) == 0 and task.hmac_flag is None:
             raise RuntimeError("Generator didn't return any flags")
         for raw_flag in output.flags:
             flag = raw_flag.lower()
@@ -141,7 +218,10 @@ def run_task_generator(
                 raise RuntimeError(f"Generator for {task.name} returned a flag which clashes with existing static one")
         return output
 
-    with TemporaryDirectory(prefix="kyzylborda_") as root_dir:
+    if scratch_dir is not None:
+        os.makedirs(scratch_dir, exist_ok=True)
+    # Output is published by rename, so it should be on the same filesystem as parent_dir.
+    with TemporaryDirectory(prefix="kyzylborda_", dir=scratch_dir) as root_dir:
         tmpdir = os.path.join(root_dir, "tmp")
         os.mkdir(tmpdir)
         out_dir = os.path.join(root_dir, "out")
@@ -159,28 +239,36 @@ def run_task_generator(
         env = os.environ.copy()
         # Don't change HOME; we might need it for Podman or other stuff.
         env["TMPDIR"] = tmpdir
+        if flags is not None:
+            # Derived flags for tasks with HMAC flags, by task name.
+            env["KYZYLBORDA_FLAGS"] = json.dumps(flags)
         if multi_generator is not None:
             tasks = ",".join(sorted(multi_generator.tasks))
         else:
             tasks = initial_task.name
-        process = subprocess.run(
-            initial_task.generator.exec + [str(random_seed), out_dir, tasks],
-            cwd=initial_task.generator.cwd,
-            env=env,
-            stdin=subprocess.DEVNULL,
-            stdout=subprocess.PIPE
-        )
-
+        args = [str(random_seed), out_dir, tasks]
+        stdout = b""
         try:
-            process.check_returncode()
-
-            raw_output = json.loads(process.stdout)
+            if initial_task.generator.persistent:
+                stdout = get_generator_workers(initial_task.generator).run(args, tmpdir, flags)
+            else:
+                process = subprocess.run(
+                    initial_task.generator.exec + args,
+                    cwd=initial_task.generator.cwd,
+                    env=env,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE
+                )
+                stdout = process.stdout
+                process.check_returncode()
+
+            raw_output = json.loads(stdout)
             if multi_generator is not None:
                 outputs = {name: convert_task_result(tasks_cache.tasks[name].task, raw_output[name]) for name in multi_generator.tasks}
             else:
                 outputs = {initial_task.name: convert_task_result(initial_task, raw_output)}
         except Exception as e:
-            sys.stdout.buffer.write(process.stdout)
+            sys.stdout.buffer.write(stdout)
             raise
 
         for name, output in outputs.items():
@@ -205,31 +293,105 @@ def generated_tasks_list(tasks_cache: TasksCache, initial_task_cache: TaskCache)
         return set([initial_task.name])
 
 
+def generator_key(tasks_cache: TasksCache, initial_task_cache: TaskCache) -> GeneratorKey:
+    return ",".join(sorted(generated_tasks_list(tasks_cache, initial_task_cache)))
+
+
+# Key -> lock and number of threads using it.
+_generation_thread_locks: Dict[str, Tuple[Lock, int]] = {}
+_generation_thread_locks_lock = Lock()
+
+
+@contextmanager
+def generation_lock(db, user_id: int, generator: GeneratorKey, blocking: bool=True) -> Iterator[bool]:
+    """ Make sure only one thread in all processes generates the tasks for the user.
+
+        Threads of one process wait on a local lock first, so that waiting doesn't take database connections.
+        Yields whether the lock has been acquired; it's always acquired when blocking. """
+    key = f"generate:{user_id}:{generator}"
+    with _generation_thread_locks_lock:
+        thread_lock, users = _generation_thread_locks.get(key, (Lock(), 0))
+        _generation_thread_locks[key] = (thread_lock, users + 1)
+    try:
+        if not thread_lock.acquire(blocking=blocking):
+            yield False
+            return
+        try:
+            lock_id = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+            # A separate connection, so that the lock doesn't depend on session transactions.
+            with db.get_bind().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                if blocking:
+                    conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": lock_id})
+                    acquired = True
+                else:
+                    acquired = conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": lock_id}).scalar()
+                if not acquired:
+                    yield False
+                    return
+                try:
+                    yield True
+                finally:
+                    conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": lock_id})
+        finally:
+            thread_lock.release()
+    finally:
+        with _generation_thread_locks_lock:
+            thread_lock, users = _generation_thread_locks[key]
+            if users == 1:
+                del _generation_thread_locks[key]
+            else:
+                _generation_thread_locks[key] = (thread_lock, users - 1)
+
+
+def clean_task_dirs(parent_dir: str, tasks: Iterable[TaskName]):
+    os.makedirs(parent_dir, exist_ok=True)
+    for name in tasks:
+        task_dir = os.path.join(parent_dir, name)
+        try:
+            shutil.rmtree(task_dir)
+        except FileNotFoundError:
+            pass
+
+
+def claim_pregenerated_task(db, attachments_path: str, tasks_cache: TasksCache, user: User, initial_task_cache: TaskCache) -> Optional[GeneratedTask]:
+    """ Try to give pre-generated tasks to the user. This doesn't run the generator. """
+    initial_task = initial_task_cache.task
+    tasks = generated_tasks_list(tasks_cache, initial_task_cache)
+
+    clean_task_dirs(os.path.join(attachments_path, str(user.id)), tasks)
+    pregen_task_entries = try_use_pregenerated_task(db, attachments_path, user, list(tasks))
+    if pregen_task_entries is None:
+        return None
+    initial_pregenerated = pregen_task_entries[initial_task.name]
+    logger.info(f"Using pre-generated tasks {list(pregen_task_entries.keys())} with random seed {initial_pregenerated.random_seed} for user '{user.login}'")
+    return initial_pregenerated
+
+
 def generate_task(db, attachments_path: str, tasks_cache: TasksCache, user: Optional[User], initial_task_cache: TaskCache) -> GeneratedTask:
     initial_task = initial_task_cache.task
     tasks = generated_tasks_list(tasks_cache, initial_task_cache)
 
+    hmac_tasks = [name for name in tasks if tasks_cache.tasks[name].task.hmac_flag is not None]
+    flags: Optional[Dict[TaskName, Flag]] = None
+    if user is not None:
+        flags = {name: derive_hmac_flag(tasks_cache, tasks_cache.tasks[name].task, user.id) for name in hmac_tasks}
+    elif len(hmac_tasks) > 0:
+        raise RuntimeError(f"Tasks {hmac_tasks} use HMAC flags and cannot be pre-generated")
+
     random_seed = uuid.uuid4()
 
     if user is not None:
         parent_dir = os.path.join(attachments_path, str(user.id))
     else:
         parent_dir = os.path.join(attachments_path, "pregenerated", str(random_seed))
-    os.makedirs(parent_dir, exist_ok=True)
-    for name in tasks:
-        task_dir = os.path.join(parent_dir, name)
-        try:
-            shutil.rmtree(task_dir)
-        except FileNotFoundError:
-            pass
 
     try:
         if user is not None:
-            pregen_task_entries = try_use_pregenerated_task(db, attachments_path, user, list(tasks))
-            if pregen_task_entries is not None:
-                initial_pregenerated = pregen_task_entries[initial_task.name]
-                logger.info(f"Using pre-generated tasks {list(pregen_task_entries.keys())} with random seed {initial_pregenerated.random_seed} for user '{user.login}'")
+            initial_pregenerated = claim_pregenerated_task(db, attachments_path, tasks_cache, user, initial_task_cache)
+            if initial_pregenerated is not None:
                 return initial_pregenerated
+        else:
+            clean_task_dirs(parent_dir, tasks)
 
         if user is not None:
             user_id = user.id
@@ -259,13 +421,14 @@ def generate_task(db, attachments_path: str, tasks_cache: TasksCache, user: Opti
             def add_task_result(name: TaskName, output: GeneratedTaskOutput):
                 task_entry = task_entries[name]
 
-                for raw_flag in output.flags:
-                    flag = raw_flag.lower()
+                flags = [raw_flag.lower() for raw_flag in output.flags]
+                for flag in flags:
                     flag_entry = GeneratedFlag(
                         task_id=task_entry.id,
                         flag=flag,
                     )
                     db.add(flag_entry)
+                notify(db, "flags_added", task_id=task_entry.id, task_name=name, user_id=user_id, flags=flags)
 
                 task_entry.substitutions = output.substitutions
                 task_entry.urls = output.urls
@@ -278,12 +441,19 @@ def generate_task(db, attachments_path: str, tasks_cache: TasksCache, user: Opti
                 initial_task_cache=initial_task_cache,
                 random_seed=random_seed,
                 parent_dir=parent_dir,
+                flags=flags,
+                scratch_dir=get_scratch_path(attachments_path),
             )
+            for name in tasks:
+                dedupe_files(attachments_path, os.path.join(parent_dir, name))
             db.commit()
         except Exception as e:
             db.rollback()
+            # Read ids before deleting; loading expired attributes would autoflush the deletes.
+            task_ids = [entry.id for entry in task_entries.values()]
             for entry in task_entries.values():
                 db.delete(entry)
+            notify(db, "tasks_deleted", task_ids=task_ids)
             db.commit()
             raise RuntimeError(f"Generator for {list(task_entries.keys())} failed for user '{user_name}'") from e
 
@@ -310,27 +480,50 @@ def get_or_generate_task(db, attachments_path: str, tasks_cache: TasksCache, use
     generated_task = db.query(GeneratedTask).filter_by(task_name=task_cache.task.name, user_id=user.id).one_or_none()
     if generated_task is not None:
         return generated_task
-    else:
+
+    with generation_lock(db, user.id, generator_key(tasks_cache, task_cache)):
+        # Concurrent request might have generated the task while we were waiting.
+        generated_task = db.query(GeneratedTask).filter_by(task_name=task_cache.task.name, user_id=user.id).one_or_none()
+        if generated_task is not None:
+            return generated_task
         return generate_task(db, attachments_path, tasks_cache, user, task_cache)
 
 
-def flush_task(db, attachments_path: str, tasks_cache: TasksCache, initial_task_cache: TaskCache):
-    initial_task = initial_task_cache.task
+def flush_task(db, attachments_path: str, tasks_cache: TasksCache, initial_task_cache: TaskCache, batch_size: int=FLUSH_BATCH_SIZE, progress: Optional[Callable[[int, int], None]]=None) -> int:
+    """ Delete all generated instances of the tasks, in batches of `batch_size` instances with a commit each.
+        Directories are moved to the trash, to be removed by TrashJanitor. `progress` gets deleted and total counts.
+        Returns the number of deleted instances. """
     tasks = generated_tasks_list(tasks_cache, initial_task_cache)
+    condition = (GeneratedTask.task_name.in_(tasks), GeneratedTask.substitutions.isnot(None))
 
-    for id, task_name, random_seed, user_id in db.query(GeneratedTask.id, GeneratedTask.task_name, GeneratedTask.random_seed, GeneratedTask.user_id).filter(GeneratedTask.task_name.in_(tasks), GeneratedTask.substitutions.isnot(None)):
-        # We delete tasks one by one to avoid inconsistent state (if shutil fails) as much as possible.
-        db.query(GeneratedFlag).filter_by(task_id=id).delete()
-        db.query(GeneratedTask).filter_by(id=id).delete()
-        db.commit()
+    total = db.query(func.count(GeneratedTask.id)).filter(*condition).scalar()
+    db.commit()
+    deleted = 0
+    if progress is not None:
+        progress(deleted, total)
 
-        if user_id is not None:
-            out_dir = os.path.join(attachments_path, str(user_id), task_name)
-        else:
-            out_dir = os.path.join(attachments_path, "pregenerated", str(random_seed), task_name)
+    while True:
+        batch = select(GeneratedTask.id).where(*condition).limit(batch_size).scalar_subquery()
+        # Flags are deleted by ON DELETE CASCADE.
+        rows = db.execute(delete(GeneratedTask).where(GeneratedTask.id.in_(batch)).returning(GeneratedTask.id, GeneratedTask.task_name, GeneratedTask.random_seed, GeneratedTask.user_id).execution_options(synchronize_session=False)).all()
+        if len(rows) == 0:
+            db.commit()
+            break
+        notify(db, "tasks_deleted", task_ids=[row.id for row in rows])
+        db.commit()
 
-        try:
-            shutil.rmtree(out_dir)
-        except FileNotFoundError:
-            # No attachments exist.
-            pass
+        pregenerated_seeds = set()
+        for row in rows:
+            if row.user_id is not None:
+                move_to_trash(attachments_path, os.path.join(attachments_path, str(row.user_id), row.task_name))
+            else:
+                pregenerated_seeds.add(row.random_seed)
+        for random_seed in pregenerated_seeds:
+            # All tasks generated with the seed are deleted together.
+            move_to_trash(attachments_path, os.path.join(attachments_path, "pregenerated", str(random_seed)))
+
+        deleted += len(rows)
+        if progress is not None:
+            # New instances might have been generated since counting.
+            progress(deleted, max(total, deleted))
+    return deleted
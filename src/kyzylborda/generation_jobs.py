@@ -0,0 +1,253 @@
+from typing import Optional, Dict, Set, Callable, Any
+import os
+import time
+import socket
+import logging
+from uuid import uuid4
+from datetime import timedelta
+from threading import Thread, Event, Lock
+from sqlalchemy import select, delete, update, func, and_, or_
+from sqlalchemy.dialects.postgresql import insert
+
+from .utils import utc_now
+from .cache import TasksCache, TaskCache
+from .db import User, QueuedGeneration
+from .notify import NotifyListener, notify
+from .generate import GeneratorKey, generator_key, generate_task, get_or_generate_task
+from .generation_queue import BaseGenerationQueue, GenerationFailure, USER_PRIORITY, PREGENERATE_PRIORITY
+
+
+logger = logging.getLogger(__name__)
+
+
+# Seconds a claimed job stays with a worker without being renewed.
+LEASE_DURATION = 60
+
+
+class DatabaseGenerationQueue(BaseGenerationQueue):
+    """ Queues generation jobs in the database; they are run by `kyzylborda.worker` processes,
+        possibly on other hosts sharing the attachments directory. """
+
+    _db_engine: Any
+
+    def __init__(self, db_engine, attachments_path: str):
+        self._db_engine = db_engine
+        self._attachments_path = attachments_path
+
+    def enqueue(self, tasks_cache: TasksCache, task_cache: TaskCache, user_id: Optional[int]=None) -> bool:
+        generator = generator_key(tasks_cache, task_cache)
+        statement = insert(QueuedGeneration.__table__).values(
+            task_name=task_cache.task.name,
+            generator=generator,
+            user_id=user_id,
+            priority=USER_PRIORITY if user_id is not None else PREGENERATE_PRIORITY,
+        ).on_conflict_do_nothing(
+            index_elements=["generator", "user_id"],
+            index_where=QueuedGeneration.user_id.isnot(None),
+        )
+        with self._db_engine.begin() as conn:
+            inserted = conn.execute(statement).rowcount > 0
+            if inserted:
+                notify(conn, "generation_queued", generator=generator, user_id=user_id)
+        return inserted
+
+    def is_queued(self, tasks_cache: TasksCache, task_cache: TaskCache, user_id: int) -> bool:
+        generator = generator_key(tasks_cache, task_cache)
+        with self._db_engine.connect() as conn:
+            return conn.execute(select(QueuedGeneration.id).where(QueuedGeneration.generator == generator, QueuedGeneration.user_id == user_id)).first() is not None
+
+    def pending_pregenerations(self, generator: GeneratorKey) -> int:
+        with self._db_engine.connect() as conn:
+            return conn.execute(select(func.count()).where(QueuedGeneration.generator == generator, QueuedGeneration.user_id.is_(None))).scalar()
+
+    def get_failure(self, tasks_cache: TasksCache, task_cache: TaskCache, user_id: int) -> Optional[GenerationFailure]:
+        generator = generator_key(tasks_cache, task_cache)
+        with self._db_engine.connect() as conn:
+            row = conn.execute(select(QueuedGeneration.attempts, QueuedGeneration.run_after).where(QueuedGeneration.generator == generator, QueuedGeneration.user_id == user_id, QueuedGeneration.attempts > 0)).first()
+        if row is None:
+            return None
+        retry_in = (row.run_after - utc_now().replace(tzinfo=None)).total_seconds()
+        return GenerationFailure(attempts=row.attempts, retry_in=max(0.0, retry_in))
+
+    def get_stats(self) -> Dict[str, Any]:
+        now = utc_now().replace(tzinfo=None)
+        with self._db_engine.connect() as conn:
+            row = conn.execute(select(
+                func.count().filter(QueuedGeneration.user_id.isnot(None)),
+                func.count().filter(QueuedGeneration.user_id.is_(None)),
+                func.count().filter(QueuedGeneration.attempts > 0),
+                func.count().filter(QueuedGeneration.lease_until > now),
+            )).one()
+        return {
+            "queued": row[0],
+            "pregenerations": row[1],
+            "failing": row[2],
+            "running": row[3],
+        }
+
+
+class GenerationWorker:
+    """ Runs jobs from the database queue in `threads` threads.
+
+        A job is leased in a short transaction (SELECT ... FOR UPDATE SKIP LOCKED) and deleted once generated;
+        no transaction is held while the generator runs. Leases are renewed in the background, so jobs of
+        a crashed worker become available again after `lease_duration`. Failed jobs are retried after
+        an exponentially growing delay and dropped after `max_attempts`. """
+
+    generated: int
+    failed: int
+    _worker_id: str
+    _db: Any
+    _db_engine: Any
+    _attachments_path: str
+    _get_tasks_cache: Callable[[], Optional[TasksCache]]
+    _threads: int
+    _poll_interval: float
+    _failure_backoff: float
+    _max_failure_backoff: float
+    _max_attempts: int
+    _lease_duration: float
+    _lock: Lock
+    # Claims of the running jobs, see QueuedGeneration.claimed_by.
+    _claims: Set[str]
+    _wakeup: Event
+
+    def __init__(self, db, db_engine, attachments_path: str, get_tasks_cache: Callable[[], Optional[TasksCache]], threads: int=4, poll_interval: float=5, failure_backoff: float=5, max_failure_backoff: float=300, max_attempts: int=10, lease_duration: float=LEASE_DURATION):
+        self.generated = 0
+        self.failed = 0
+        self._worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._db = db
+        self._db_engine = db_engine
+        self._attachments_path = attachments_path
+        self._get_tasks_cache = get_tasks_cache
+        self._threads = threads
+        self._poll_interval = poll_interval
+        self._failure_backoff = failure_backoff
+        self._max_failure_backoff = max_failure_backoff
+        self._max_attempts = max_attempts
+        self._lease_duration = lease_duration
+        self._lock = Lock()
+        self._claims = set()
+        self._wakeup = Event()
+
+    def subscribe(self, listener: NotifyListener):
+        listener.add_handler("generation_queued", lambda payload: self._wakeup.set())
+
+    def run(self):
+        Thread(target=self._renew_leases, name="kyzylborda-worker-leases", daemon=True).start()
+        threads = [Thread(target=self._run, name=f"kyzylborda-worker-{i}", daemon=True) for i in range(self._threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            try:
+                found = self._run_one()
+            except Exception as e:
+                logger.error("Failed to run a generation job", exc_info=e)
+                found = False
+            if not found:
+                self._wakeup.wait(self._poll_interval)
+                self._wakeup.clear()
+
+    def _renew_leases(self):
+        table = QueuedGeneration.__table__
+        while True:
+            time.sleep(self._lease_duration / 3)
+            with self._lock:
+                claims = list(self._claims)
+            if len(claims) == 0:
+                continue
+            try:
+                with self._db_engine.begin() as conn:
+                    conn.execute(update(table).where(table.c.claimed_by.in_(claims)).values(
+                        lease_until=utc_now().replace(tzinfo=None) + timedelta(seconds=self._lease_duration),
+                    ))
+            except Exception as e:
+                logger.error("Failed to renew generation job leases", exc_info=e)
+
+    def _claim(self) -> Optional[Any]:
+        """ Lease the next ready job. """
+        table = QueuedGeneration.__table__
+        now = utc_now().replace(tzinfo=None)
+        next_job = select(table.c.id).where(
+            table.c.run_after <= now,
+            or_(table.c.lease_until.is_(None), table.c.lease_until <= now),
+        ).order_by(table.c.priority, table.c.id).limit(1).with_for_update(skip_locked=True).scalar_subquery()
+        with self._db_engine.begin() as conn:
+            return conn.execute(update(table).where(table.c.id == next_job).values(
+                claimed_by=f"{self._worker_id}:{uuid4().hex}",
+                lease_until=now + timedelta(seconds=self._lease_duration),
+            ).returning(*table.c)).first()
+
+    def _finish(self, job, **values):
+        """ Delete the job, or update it with `values` and release the lease. Does nothing if the lease has expired
+            and the job has been claimed again. """
+        table = QueuedGeneration.__table__
+        claimed = and_(table.c.id == job.id, table.c.claimed_by == job.claimed_by)
+        with self._db_engine.begin() as conn:
+            if len(values) == 0:
+                conn.execute(delete(table).where(claimed))
+            else:
+                conn.execute(update(table).where(claimed).values(claimed_by=None, lease_until=None, **values))
+
+    def _run_one(self) -> bool:
+        """ Claim and run one job; returns False if there are no jobs ready. """
+        tasks_cache = self._get_tasks_cache()
+        if tasks_cache is None:
+            return False
+
+        job = self._claim()
+        if job is None:
+            return False
+        with self._lock:
+            self._claims.add(job.claimed_by)
+        try:
+            task_cache = tasks_cache.tasks.get(job.task_name)
+            if task_cache is None or task_cache.task.generator is None:
+                logger.warn(f"Dropping generation job for '{job.generator}': task '{job.task_name}' is not dynamic anymore")
+                self._finish(job)
+                return True
+
+            start = time.perf_counter()
+            try:
+                self._generate(tasks_cache, task_cache, job.user_id)
+            except Exception as e:
+                attempts = job.attempts + 1
+                with self._lock:
+                    self.failed += 1
+                if attempts >= self._max_attempts:
+                    logger.error(f"Generation job for '{job.generator}' failed, dropping it after {attempts} attempts", exc_info=e)
+                    self._finish(job)
+                else:
+                    backoff = min(self._max_failure_backoff, self._failure_backoff * 2 ** (attempts - 1))
+                    logger.error(f"Generation job for '{job.generator}' failed ({attempts} attempts), retrying in {backoff:.0f}s", exc_info=e)
+                    self._finish(job,
+                        attempts=attempts,
+                        error=str(e),
+                        run_after=utc_now().replace(tzinfo=None) + timedelta(seconds=backoff),
+                    )
+            else:
+                logger.info(f"Generation job for '{job.generator}' done in {time.perf_counter() - start:.2f}s")
+                with self._lock:
+                    self.generated += 1
+                self._finish(job)
+        finally:
+            with self._lock:
+                self._claims.discard(job.claimed_by)
+        return True
+
+    def _generate(self, tasks_cache: TasksCache, task_cache: TaskCache, user_id: Optional[int]):
+        db = self._db
+        try:
+            if user_id is not None:
+                user = db.query(User).get(user_id)
+                if user is None:
+                    return
+                get_or_generate_task(db, self._attachments_path, tasks_cache, user, task_cache)
+            else:
+                generate_task(db, self._attachments_path, tasks_cache, None, task_cache)
+        finally:
+            db.remove()
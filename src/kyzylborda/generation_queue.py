@@ -0,0 +1,256 @@
+from typing import Optional, Dict, Set, List, Tuple, Any
+import os
+import time
+import heapq
+import logging
+import itertools
+from abc import ABC, abstractmethod
+from queue import PriorityQueue
+from threading import Thread, Lock
+from dataclasses import dataclass
+
+from .cache import TasksCache, TaskCache
+from .db import User, GeneratedTask
+from .generate import GeneratorKey, generator_key, generation_lock, claim_pregenerated_task, generate_task, get_or_generate_task
+
+
+logger = logging.getLogger(__name__)
+
+
+USER_PRIORITY = 0
+PREGENERATE_PRIORITY = 1
+
+
+# User id (None for pre-generation) and generator key.
+JobKey = Tuple[Optional[int], GeneratorKey]
+
+
+@dataclass(frozen=True)
+class GenerationJob:
+    priority: int
+    user_id: Optional[int]
+    generator: GeneratorKey
+    tasks_cache: TasksCache
+    task_cache: TaskCache
+
+    @property
+    def key(self) -> JobKey:
+        return (self.user_id, self.generator)
+
+
+@dataclass(frozen=True)
+class GenerationFailure:
+    # Failed attempts of the job so far.
+    attempts: int
+    # Seconds until the next attempt.
+    retry_in: float
+
+
+class BaseGenerationQueue(ABC):
+    """ Generation of dynamic tasks outside of HTTP requests. """
+
+    _attachments_path: str
+
+    @abstractmethod
+    def enqueue(self, tasks_cache: TasksCache, task_cache: TaskCache, user_id: Optional[int]=None) -> bool:
+        """ Queue generation of a task for a user, or pre-generation if user is None.
+
+            Returns False if the same job is already queued or has failed recently. """
+
+    @abstractmethod
+    def is_queued(self, tasks_cache: TasksCache, task_cache: TaskCache, user_id: int) -> bool:
+        """ Whether the user's job is known to be queued or running. """
+
+    @abstractmethod
+    def pending_pregenerations(self, generator: GeneratorKey) -> int:
+        pass
+
+    @abstractmethod
+    def get_failure(self, tasks_cache: TasksCache, task_cache: TaskCache, user_id: int) -> Optional[GenerationFailure]:
+        """ Whether the user's job has failed and waits to be retried. """
+
+    @abstractmethod
+    def get_stats(self) -> Dict[str, Any]:
+        pass
+
+    def get_or_enqueue(self, db, tasks_cache: TasksCache, user: User, task_cache: TaskCache) -> Optional[GeneratedTask]:
+        """ Get user's generated task, claiming a pre-generated one if possible. Otherwise queue generation and return None. """
+        generated_task = db.query(GeneratedTask).filter_by(task_name=task_cache.task.name, user_id=user.id).one_or_none()
+        if generated_task is not None:
+            return generated_task
+        if self.is_queued(tasks_cache, task_cache, user.id):
+            return None
+
+        with generation_lock(db, user.id, generator_key(tasks_cache, task_cache), blocking=False) as acquired:
+            if not acquired:
+                # Another thread or process is generating the task right now.
+                return None
+            generated_task = db.query(GeneratedTask).filter_by(task_name=task_cache.task.name, user_id=user.id).one_or_none()
+            if generated_task is None:
+                generated_task = claim_pregenerated_task(db, self._attachments_path, tasks_cache, user, task_cache)
+        if generated_task is not None:
+            return generated_task
+
+        self.enqueue(tasks_cache, task_cache, user.id)
+        return None
+
+
+class GenerationQueue(BaseGenerationQueue):
+    """ Runs task generators in background threads, so that HTTP requests never wait for them.
+
+        Jobs for users go before pre-generation. No more than `generator_concurrency` jobs run
+        for the same generator at once; the rest wait in the queue. Failed jobs are not retried
+        for an exponentially growing time. """
+
+    generated: int
+    failed: int
+    _db: Any
+    _workers: int
+    _generator_concurrency: int
+    _failure_backoff: float
+    _max_failure_backoff: float
+    _lock: Lock
+    _counter: "itertools.count[int]"
+    _queue: "PriorityQueue[Tuple[int, int, GenerationJob]]"
+    # User jobs which are queued or running.
+    _queued: Set[JobKey]
+    # Pre-generation jobs which are queued or running.
+    _pregenerating: Dict[GeneratorKey, int]
+    _running: Dict[GeneratorKey, int]
+    # Jobs postponed because their generator is busy, as heaps.
+    _deferred: Dict[GeneratorKey, List[Tuple[int, int, GenerationJob]]]
+    # Failure count and time until which the job is not retried.
+    _failures: Dict[JobKey, Tuple[int, float]]
+    _pid: Optional[int]
+
+    def __init__(self, db, attachments_path: str, workers: int=4, generator_concurrency: int=2, failure_backoff: float=5, max_failure_backoff: float=300):
+        self.generated = 0
+        self.failed = 0
+        self._db = db
+        self._attachments_path = attachments_path
+        self._workers = workers
+        self._generator_concurrency = generator_concurrency
+        self._failure_backoff = failure_backoff
+        self._max_failure_backoff = max_failure_backoff
+        self._lock = Lock()
+        self._counter = itertools.count()
+        self._queue = PriorityQueue()
+        self._queued = set()
+        self._pregenerating = {}
+        self._running = {}
+        self._deferred = {}
+        self._failures = {}
+        self._pid = None
+
+    def _ensure_started(self):
+        # Threads don't survive fork(), start the workers in every process.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            for i in range(self._workers):
+                Thread(target=self._run, name=f"kyzylborda-generation-{i}", daemon=True).start()
+
+    def _is_backing_off(self, key: JobKey) -> bool:
+        failure = self._failures.get(key)
+        return failure is not None and failure[1] > time.monotonic()
+
+    def _put(self, job: GenerationJob):
+        self._queue.put((job.priority, next(self._counter), job))
+
+    def enqueue(self, tasks_cache: TasksCache, task_cache: TaskCache, user_id: Optional[int]=None) -> bool:
+        job = GenerationJob(
+            priority=USER_PRIORITY if user_id is not None else PREGENERATE_PRIORITY,
+            user_id=user_id,
+            generator=generator_key(tasks_cache, task_cache),
+            tasks_cache=tasks_cache,
+            task_cache=task_cache,
+        )
+        with self._lock:
+            self._ensure_started()
+            if self._is_backing_off(job.key):
+                return False
+            if user_id is not None:
+                if job.key in self._queued:
+                    return False
+                self._queued.add(job.key)
+            else:
+                self._pregenerating[job.generator] = self._pregenerating.get(job.generator, 0) + 1
+            self._put(job)
+        return True
+
+    def pending_pregenerations(self, generator: GeneratorKey) -> int:
+        with self._lock:
+            return self._pregenerating.get(generator, 0)
+
+    def is_queued(self, tasks_cache: TasksCache, task_cache: TaskCache, user_id: int) -> bool:
+        with self._lock:
+            return (user_id, generator_key(tasks_cache, task_cache)) in self._queued
+
+    def get_failure(self, tasks_cache: TasksCache, task_cache: TaskCache, user_id: int) -> Optional[GenerationFailure]:
+        with self._lock:
+            failure = self._failures.get((user_id, generator_key(tasks_cache, task_cache)))
+        if failure is None:
+            return None
+        return GenerationFailure(attempts=failure[0], retry_in=max(0.0, failure[1] - time.monotonic()))
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            job = entry[2]
+            with self._lock:
+                if self._running.get(job.generator, 0) >= self._generator_concurrency:
+                    heapq.heappush(self._deferred.setdefault(job.generator, []), entry)
+                    continue
+                self._running[job.generator] = self._running.get(job.generator, 0) + 1
+                skip = self._is_backing_off(job.key)
+
+            try:
+                if not skip:
+                    self._generate(job)
+            finally:
+                with self._lock:
+                    self._running[job.generator] -= 1
+                    if job.user_id is not None:
+                        self._queued.discard(job.key)
+                    else:
+                        self._pregenerating[job.generator] -= 1
+                        if self._pregenerating[job.generator] == 0:
+                            del self._pregenerating[job.generator]
+                    deferred = self._deferred.get(job.generator)
+                    if deferred:
+                        self._queue.put(heapq.heappop(deferred))
+                        if len(deferred) == 0:
+                            del self._deferred[job.generator]
+
+    def _generate(self, job: GenerationJob):
+        db = self._db
+        try:
+            if job.user_id is not None:
+                user = db.query(User).get(job.user_id)
+                if user is None:
+                    return
+                get_or_generate_task(db, self._attachments_path, job.tasks_cache, user, job.task_cache)
+            else:
+                generate_task(db, self._attachments_path, job.tasks_cache, None, job.task_cache)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+                count = self._failures.get(job.key, (0, 0.0))[0] + 1
+                backoff = min(self._max_failure_backoff, self._failure_backoff * 2 ** (count - 1))
+                self._failures[job.key] = (count, time.monotonic() + backoff)
+            logger.error(f"Generation job for '{job.generator}' failed ({count} attempts), retrying in {backoff:.0f}s", exc_info=e)
+        else:
+            with self._lock:
+                self.generated += 1
+                self._failures.pop(job.key, None)
+        finally:
+            db.remove()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "queued": self._queue.qsize() + sum(len(deferred) for deferred in self._deferred.values()),
+                "running": sum(self._running.values()),
+                "generated": self.generated,
+                "failed": self.failed,
+                "backing_off": sum(1 for key in self._failures if self._is_backing_off(key)),
+            }
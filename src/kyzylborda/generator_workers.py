@@ -0,0 +1,240 @@
+# Long-lived generator processes.
+#
+# A persistent generator is started without arguments and with KYZYLBORDA_GENERATOR_PROTOCOL=1 in its environment.
+# It reads requests from stdin and writes responses to stdout, both framed.
+#
+# Request: "<length>\n" followed by a JSON object of that many bytes, with keys "seed", "out_dir", "tasks"
+# (the same values as the command line arguments of an ordinary generator), "tmpdir" and "flags".
+#
+# Response: "ok <length>\n" followed by the same JSON an ordinary generator prints, or "error <length>\n"
+# followed by an error message. A generator which exits or breaks the framing is restarted. A generator which doesn't
+# respond within `job_timeout` seconds is killed.
+
+from typing import Optional, Dict, List, Tuple, Any, Callable, BinaryIO
+import os
+import sys
+import json
+import logging
+import subprocess
+from threading import Lock, Condition, Timer
+
+from .tasks import TaskGenerator, TaskName, Flag
+
+
+logger = logging.getLogger(__name__)
+
+
+class GeneratorWorkerError(Exception):
+    pass
+
+
+class GeneratorWorkerTimeoutError(Exception):
+    pass
+
+
+def write_frame(stream: BinaryIO, data: bytes, status: Optional[str]=None):
+    header = str(len(data)) if status is None else f"{status} {len(data)}"
+    stream.write(header.encode("ascii") + b"\n" + data)
+    stream.flush()
+
+
+def read_frame(stream: BinaryIO) -> Tuple[Optional[str], bytes]:
+    header = stream.readline()
+    if not header.endswith(b"\n"):
+        raise EOFError()
+    parts = header.decode("ascii").split()
+    if len(parts) == 1:
+        status = None
+        length = int(parts[0])
+    elif len(parts) == 2:
+        status = parts[0]
+        length = int(parts[1])
+    else:
+        raise ValueError(f"Invalid frame header: {header!r}")
+    data = stream.read(length)
+    if len(data) < length:
+        raise EOFError()
+    return status, data
+
+
+class GeneratorWorker:
+    process: subprocess.Popen
+    jobs: int
+    timed_out: bool
+
+    def __init__(self, generator: TaskGenerator):
+        env = os.environ.copy()
+        env["KYZYLBORDA_GENERATOR_PROTOCOL"] = "1"
+        self.process = subprocess.Popen(
+            generator.exec,
+            cwd=generator.cwd,
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.jobs = 0
+        self.timed_out = False
+
+    def _kill(self):
+        self.timed_out = True
+        self.process.kill()
+
+    def run(self, request: Dict[str, Any], timeout: Optional[float]=None) -> bytes:
+        assert self.process.stdin is not None and self.process.stdout is not None
+        self.jobs += 1
+        # Pipes can't be read with a timeout; a killed process closes them instead.
+        timer = Timer(timeout, self._kill) if timeout is not None else None
+        if timer is not None:
+            timer.daemon = True
+            timer.start()
+        try:
+            write_frame(self.process.stdin, json.dumps(request).encode("utf-8"))
+            status, data = read_frame(self.process.stdout)
+        except (EOFError, OSError):
+            if self.timed_out:
+                raise GeneratorWorkerTimeoutError(f"Generator hasn't responded in {timeout} seconds")
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+                # The timer may have fired right after the response; wait for the kill to complete then.
+                timer.join()
+        if self.timed_out:
+            raise GeneratorWorkerTimeoutError(f"Generator hasn't responded in {timeout} seconds")
+        if status == "ok":
+            return data
+        elif status == "error":
+            raise GeneratorWorkerError(data.decode("utf-8", errors="replace"))
+        else:
+            raise ValueError(f"Invalid response status: {status}")
+
+    def stop(self):
+        try:
+            assert self.process.stdin is not None
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+            self.process.wait()
+
+
+class GeneratorWorkerPool:
+    """ Up to `generator.workers` running processes of a persistent generator, each recycled after `generator.max_jobs` jobs. """
+
+    _generator: TaskGenerator
+    _condition: Condition
+    _idle: List[GeneratorWorker]
+    _count: int
+    # Replaced by a new pool; processes are stopped as soon as they are idle.
+    _retired: bool
+
+    def __init__(self, generator: TaskGenerator):
+        self._generator = generator
+        self._condition = Condition()
+        self._idle = []
+        self._count = 0
+        self._retired = False
+
+    def retire(self):
+        with self._condition:
+            self._retired = True
+            idle = self._idle
+            self._idle = []
+            self._count -= len(idle)
+            self._condition.notify_all()
+        for worker in idle:
+            worker.stop()
+
+    def _acquire(self) -> GeneratorWorker:
+        with self._condition:
+            while len(self._idle) == 0 and self._count >= self._generator.workers:
+                self._condition.wait()
+            if len(self._idle) > 0:
+                return self._idle.pop()
+            self._count += 1
+        try:
+            return GeneratorWorker(self._generator)
+        except:
+            with self._condition:
+                self._count -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, worker: GeneratorWorker, healthy: bool):
+        if not healthy or self._retired or worker.jobs >= self._generator.max_jobs or worker.process.poll() is not None:
+            worker.stop()
+            with self._condition:
+                self._count -= 1
+                self._condition.notify()
+        else:
+            with self._condition:
+                self._idle.append(worker)
+                self._condition.notify()
+
+    def run(self, args: List[str], tmpdir: str, flags: Optional[Dict[TaskName, Flag]]=None) -> bytes:
+        seed, out_dir, tasks = args
+        request = {
+            "seed": seed,
+            "out_dir": out_dir,
+            "tasks": tasks,
+            "tmpdir": tmpdir,
+            "flags": flags or {},
+        }
+        worker = self._acquire()
+        healthy = False
+        try:
+            output = worker.run(request, timeout=self._generator.job_timeout)
+            healthy = True
+            return output
+        except GeneratorWorkerError:
+            # The generator has reported the error and is ready for the next job.
+            healthy = True
+            raise
+        finally:
+            self._release(worker, healthy)
+
+
+_pools: Dict[Tuple[Any, ...], GeneratorWorkerPool] = {}
+_pools_lock = Lock()
+
+
+def get_generator_workers(generator: TaskGenerator) -> GeneratorWorkerPool:
+    key = (tuple(generator.exec), generator.cwd, generator.workers, generator.max_jobs, generator.job_timeout)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = GeneratorWorkerPool(generator)
+            _pools[key] = pool
+        return pool
+
+
+def retire_generator_workers():
+    """ Stop running generator processes once they finish their jobs; call when tasks are reloaded,
+        since the generators might have changed. """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.retire()
+
+
+def serve(generate: Callable[[str, str, str, str, Dict[TaskName, Flag]], Any]):
+    """ Run a persistent generator written in Python. `generate` gets seed, output directory, task names,
+        temporary directory and derived flags, and returns what an ordinary generator would print. """
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+    # Stray prints shouldn't break the framing.
+    sys.stdout = sys.stderr
+    while True:
+        try:
+            _, data = read_frame(stdin)
+        except EOFError:
+            break
+        request = json.loads(data)
+        try:
+            output = generate(request["seed"], request["out_dir"], request["tasks"], request["tmpdir"], request["flags"])
+        except Exception as e:
+            logger.error("Generator failed", exc_info=e)
+            write_frame(stdout, str(e).encode("utf-8"), status="error")
+        else:
+            write_frame(stdout, json.dumps(output).encode("utf-8"), status="ok")
@@ -1,10 +1,12 @@
 import logging
+from typing import Optional
 from sqlalchemy.exc import IntegrityError
 
 from .utils import utc_now
 from .cache import TasksCache, task_can_submit
 from .tasks import Hint
 from .db import SubmittedFlag, User, GrantedHint
+from .scoring import Scoreboard
 
 
 logger = logging.getLogger(__name__)
@@ -23,7 +25,7 @@ class HintNotNeededError(Exception):
 
 
 
-def grant_hint(db, tasks_cache: TasksCache, user: User, task_name: str, hint_name: str) -> Hint:
+def grant_hint(db, tasks_cache: TasksCache, user: User, task_name: str, hint_name: str, scoreboard: Optional[Scoreboard]=None) -> Hint:
     try:
         task_cache = tasks_cache.get_task(task_name, user=user)
         hint = task_cache.hints[hint_name]
@@ -52,4 +54,7 @@ def grant_hint(db, tasks_cache: TasksCache, user: User, task_name: str, hint_nam
         db.rollback()
         raise HintTakenError()
 
+    if scoreboard is not None:
+        scoreboard.add_hint(user, task_name, hint.name)
+
     return hint
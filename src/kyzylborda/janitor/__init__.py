@@ -0,0 +1,86 @@
+import os
+import sys
+import json
+import logging
+from argparse import ArgumentParser
+from typing import Dict, Any
+import yaml
+import sqlalchemy
+
+from ..db import Base
+from ..tasks import read_tasks
+from ..cache import build_tasks_cache
+from ..attachments import TrashJanitor
+from ..reconcile import AttachmentsJanitor, ORPHAN_MIN_AGE
+
+
+logger = logging.getLogger(__name__)
+
+
+arg_parser = ArgumentParser(description="Reclaim orphaned files of dynamic tasks and report disk usage.")
+arg_parser.add_argument("-n", "--dry-run", action="store_true", help="only report what would be done")
+arg_parser.add_argument("-r", "--rate", type=float, default=100, help="task directories to visit per second, 0 for no limit")
+arg_parser.add_argument("-m", "--min-age", type=float, default=ORPHAN_MIN_AGE, help="seconds before an orphan can be reclaimed")
+arg_parser.add_argument("--json", action="store_true", help="print the report as JSON")
+arg_parser.add_argument("config", metavar="CONFIG", help="path to web application config")
+
+
+def format_size(size: int) -> str:
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024 # type: ignore
+    return f"{size:.1f} TiB"
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"Orphans: {report['orphans']}, {format_size(report['reclaimed_bytes'])}")
+    print(f"Claimed tasks moved: {report['moved']}")
+    print()
+    print("Generators:")
+    for name, usage in sorted(report["generators"].items(), key=lambda item: -item[1]["bytes"]):
+        print(f"  {name}: {format_size(usage['bytes'])}")
+    print()
+    print("Tasks:")
+    for name, usage in sorted(report["tasks"].items(), key=lambda item: -item[1]["bytes"]):
+        print(f"  {name}: {usage['instances']} instances, {format_size(usage['bytes'])}")
+    blobs = report.get("blobs")
+    if blobs is not None:
+        print()
+        print(f"Blobs: {blobs['blobs']}, {format_size(blobs['bytes'])}; {format_size(blobs['bytes_saved'])} saved by deduplication")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+
+    args = arg_parser.parse_args()
+    with open(args.config) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    tasks_cache = build_tasks_cache(read_tasks(config["TASKS_PATH"], default_attrs=config.get("DEFAULT_TASK_ATTRS", {})))
+    db_engine = sqlalchemy.create_engine(config["DATABASE"])
+    Base.metadata.create_all(db_engine)
+    db = sqlalchemy.orm.scoped_session(sqlalchemy.orm.sessionmaker(bind=db_engine))
+    attachments_path = os.path.abspath(config["DYNAMIC_ATTACHMENTS_PATH"])
+    if not os.path.isdir(attachments_path):
+        logger.error(f"Attachments directory {attachments_path} doesn't exist")
+        sys.exit(1)
+
+    janitor = AttachmentsJanitor(db, db_engine, attachments_path, lambda: tasks_cache, min_age=args.min_age, rate=args.rate, dry_run=args.dry_run)
+    report = janitor.reconcile()
+    if not args.dry_run:
+        trash_janitor = TrashJanitor(attachments_path)
+        # Also collects unused blobs.
+        trash_janitor.clean()
+        report["blobs"] = trash_janitor.blobs
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import sys
+import logging
+from argparse import ArgumentParser
+import yaml
+
+from ..web.files import make_file_offload
+
+
+logger = logging.getLogger(__name__)
+
+
+arg_parser = ArgumentParser(description="Print nginx locations for serving files with X-Accel-Redirect (FILE_OFFLOAD: x-accel-redirect).")
+arg_parser.add_argument("config", metavar="CONFIG", help="path to web application config")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    args = arg_parser.parse_args()
+    with open(args.config) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+
+    offload = make_file_offload(config)
+    if offload is None:
+        # Print the snippet anyway, so that nginx can be configured first.
+        offload = make_file_offload(dict(config, FILE_OFFLOAD="x-accel-redirect"))
+        logger.warn("FILE_OFFLOAD is not set; files are sent by the application")
+    elif offload.mode != "x-accel-redirect":
+        logger.error(f"FILE_OFFLOAD is {offload.mode}, configure the web server to allow sending files from {', '.join(offload.roots.values())}")
+        sys.exit(1)
+
+    assert offload is not None
+    sys.stdout.write(offload.get_nginx_config())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+from typing import Dict, List, Callable, Any
+import json
+import select
+import logging
+from time import sleep, monotonic
+from uuid import uuid4
+from threading import Thread, Lock
+from sqlalchemy.sql.expression import text
+
+
+logger = logging.getLogger(__name__)
+
+
+NOTIFY_CHANNEL = "kyzylborda"
+RECONNECT_DELAY = 5
+# Even without notifications, wake up from time to time to detect broken connections. A ping is sent to ourselves
+# as often, and notifications are not trusted until it comes back.
+POLL_TIMEOUT = 60
+
+
+def notify(db, type: str, **payload):
+    """ Notify all processes listening to the database. Delivered only when (and if) the current transaction commits. """
+    db.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": NOTIFY_CHANNEL, "payload": json.dumps(dict(payload, type=type))})
+
+
+NotifyHandler = Callable[[Dict[str, Any]], None]
+
+
+class NotifyListener:
+    """ Receives notifications in a background thread and dispatches them by type.
+
+        Notifications sent while the connection is down are lost, so connect
+        handlers are run after each (re)connection to reload the state. """
+
+    connected: bool
+    _db_engine: Any
+    _lock: Lock
+    _handlers: Dict[str, List[NotifyHandler]]
+    _connect_handlers: List[Callable[[], None]]
+    _thread: Thread
+
+    def __init__(self, db_engine):
+        self.connected = False
+        self._db_engine = db_engine
+        self._lock = Lock()
+        self._handlers = {}
+        self._connect_handlers = []
+        self._thread = Thread(target=self._run, name="notify-listener", daemon=True)
+
+    def add_handler(self, type: str, handler: NotifyHandler):
+        with self._lock:
+            self._handlers.setdefault(type, []).append(handler)
+
+    def add_connect_handler(self, handler: Callable[[], None]):
+        with self._lock:
+            self._connect_handlers.append(handler)
+
+    def start(self):
+        self._thread.start()
+
+    def _dispatch(self, raw_payload: str):
+        try:
+            payload = json.loads(raw_payload)
+            with self._lock:
+                handlers = list(self._handlers.get(payload["type"], []))
+            for handler in handlers:
+                handler(payload)
+        except Exception as e:
+            logger.error(f"Error while handling notification {raw_payload}", exc_info=e)
+
+    def _listen(self):
+        connection = self._db_engine.raw_connection()
+        try:
+            connection.connection.autocommit = True
+            cursor = connection.cursor()
+            cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            with self._lock:
+                connect_handlers = list(self._connect_handlers)
+            for handler in connect_handlers:
+                handler()
+            ping_payload = None
+            ping_time = 0.0
+            while True:
+                if monotonic() - ping_time >= POLL_TIMEOUT:
+                    if ping_payload is not None and self.connected:
+                        # Can happen behind a transaction pooler, where LISTEN and NOTIFY go to different connections.
+                        logger.warn(f"Ping has not come back in {POLL_TIMEOUT} seconds; notifications are not trusted")
+                        self.connected = False
+                    ping_payload = json.dumps({"type": "ping", "id": uuid4().hex})
+                    ping_time = monotonic()
+                    cursor.execute("SELECT pg_notify(%s, %s)", (NOTIFY_CHANNEL, ping_payload))
+                select.select([connection.connection], [], [], max(0, ping_time + POLL_TIMEOUT - monotonic()))
+                connection.connection.poll()
+                while connection.connection.notifies:
+                    notification = connection.connection.notifies.pop(0)
+                    if notification.payload == ping_payload:
+                        ping_payload = None
+                        self.connected = True
+                    else:
+                        self._dispatch(notification.payload)
+        finally:
+            self.connected = False
+            connection.invalidate()
+
+    def _run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception as e:
+                logger.error(f"Notification listener failed; reconnecting in {RECONNECT_DELAY} seconds", exc_info=e)
+            sleep(RECONNECT_DELAY)
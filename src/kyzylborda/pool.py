@@ -0,0 +1,231 @@
+from typing import Optional, Dict, Deque, Callable, Tuple, Any
+import time
+from datetime import timedelta
+import logging
+from collections import deque
+from threading import Thread, Lock
+from sqlalchemy import func
+from sqlalchemy.sql.expression import text
+
+from .utils import utc_now
+from .cache import TasksCache, TaskCache
+from .tasks import TaskName, Task
+from .db import User, GeneratedTask, SubmissionAttempt
+from .notify import NotifyListener
+from .generate import GeneratorKey, generator_key
+from .generation_queue import BaseGenerationQueue
+
+
+logger = logging.getLogger(__name__)
+
+
+# Advisory lock held by the process which fills the pools.
+POOL_FILLER_LOCK_ID = 0x6b7a0001
+# Claim and fill rates are averaged over this many seconds.
+RATE_WINDOW = 300
+# Default cap on tasks pre-generated per task for upcoming releases.
+PREWARM_MAX = 100
+
+
+class PoolFiller:
+    """ Keeps pools of pre-generated tasks at their target sizes.
+
+        Every web process runs a filler, but only the one holding an advisory lock queues pre-generation.
+        Claims and fills are counted from notifications, so every process can report the rates.
+
+        Dynamic tasks which become visible within `prewarm_lead` seconds are pre-generated for every
+        active user in advance (but no more than `prewarm_max`), so that the first wave of visitors
+        doesn't wait for generators. Pre-warming is off with zero lead. """
+
+    is_leader: bool
+    _db: Any
+    _db_engine: Any
+    _generation_queue: BaseGenerationQueue
+    _get_tasks_cache: Callable[[], Optional[TasksCache]]
+    _check_interval: float
+    _prewarm_lead: float
+    _active_window: float
+    _prewarm_max: Optional[int]
+    _lock: Lock
+    _lock_conn: Any
+    _claims: Dict[TaskName, Deque[float]]
+    _fills: Dict[TaskName, Deque[float]]
+    # Pool sizes for tasks which are about to become visible.
+    _prewarming: Dict[TaskName, int]
+
+    def __init__(self, db, db_engine, generation_queue: BaseGenerationQueue, get_tasks_cache: Callable[[], Optional[TasksCache]], check_interval: float=5, prewarm_lead: float=0, active_window: float=3600, prewarm_max: Optional[int]=PREWARM_MAX):
+        self.is_leader = False
+        self._db = db
+        self._db_engine = db_engine
+        self._generation_queue = generation_queue
+        self._get_tasks_cache = get_tasks_cache
+        self._check_interval = check_interval
+        self._prewarm_lead = prewarm_lead
+        self._active_window = active_window
+        self._prewarm_max = prewarm_max
+        self._lock = Lock()
+        self._lock_conn = None
+        self._claims = {}
+        self._fills = {}
+        self._prewarming = {}
+
+    def subscribe(self, listener: NotifyListener):
+        listener.add_handler("tasks_claimed", self._handle_claimed)
+        listener.add_handler("flags_added", self._handle_flags_added)
+
+    def _record(self, events: Dict[TaskName, Deque[float]], task_name: TaskName):
+        now = time.monotonic()
+        with self._lock:
+            times = events.setdefault(task_name, deque())
+            times.append(now)
+            while times[0] < now - RATE_WINDOW:
+                times.popleft()
+
+    def _handle_claimed(self, payload: Dict[str, Any]):
+        for task_name in payload["tasks"].values():
+            self._record(self._claims, task_name)
+
+    def _handle_flags_added(self, payload: Dict[str, Any]):
+        # Sent once for every generated task.
+        if payload["user_id"] is None:
+            self._record(self._fills, payload["task_name"])
+
+    def start(self):
+        Thread(target=self._run, name="kyzylborda-pool-filler", daemon=True).start()
+
+    def _try_lead(self) -> bool:
+        if self._lock_conn is not None:
+            try:
+                self._lock_conn.execute(text("SELECT 1"))
+                return True
+            except Exception as e:
+                logger.warn("Lost connection holding the pool filler lock", exc_info=e)
+                try:
+                    self._lock_conn.close()
+                except Exception:
+                    pass
+                self._lock_conn = None
+
+        # Don't keep a transaction open while holding the lock.
+        conn = self._db_engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        try:
+            acquired = conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": POOL_FILLER_LOCK_ID}).scalar()
+        except:
+            conn.close()
+            raise
+        if acquired:
+            logger.info("This process is now filling pre-generated task pools")
+            self._lock_conn = conn
+            return True
+        else:
+            conn.close()
+            return False
+
+    def _count_available(self, db) -> Dict[TaskName, int]:
+        """ Count unclaimed pre-generated tasks, including ones being generated right now. """
+        return dict(db.query(GeneratedTask.task_name, func.count()).filter(GeneratedTask.user_id.is_(None)).group_by(GeneratedTask.task_name).all())
+
+    def _count_active_users(self, db) -> int:
+        """ Count users who have submitted anything recently; before the first submissions, count everyone. """
+        since = (utc_now() - timedelta(seconds=self._active_window)).replace(tzinfo=None)
+        count = db.query(func.count(func.distinct(SubmissionAttempt.submitter_id))).filter(SubmissionAttempt.attempt_time >= since).scalar()
+        if count == 0:
+            count = db.query(func.count(User.id)).filter(User.is_organizer == False, User.is_disqualified == False).scalar()
+        if self._prewarm_max is not None:
+            count = min(count, self._prewarm_max)
+        return count
+
+    def _is_upcoming(self, task: Task) -> bool:
+        if task.not_before is None or self._prewarm_lead <= 0:
+            return False
+        now = utc_now()
+        return now < task.not_before <= now + timedelta(seconds=self._prewarm_lead)
+
+    def _fill(self, tasks_cache: TasksCache):
+        db = self._db
+        try:
+            available = self._count_available(db)
+            if any(task_cache.task.generator is not None and self._is_upcoming(task_cache.task) for task_cache in tasks_cache.tasks.values()):
+                active_users: Optional[int] = self._count_active_users(db)
+            else:
+                active_users = None
+        finally:
+            db.remove()
+
+        # Generator key -> task to pre-generate, low and high watermarks.
+        # All tasks of a multi-generator are pre-generated together.
+        targets: Dict[GeneratorKey, Tuple[TaskCache, int, int]] = {}
+        prewarming: Dict[TaskName, int] = {}
+        for name, task_cache in tasks_cache.tasks.items():
+            task = task_cache.task
+            if task.generator is None or task.hmac_flag is not None:
+                continue
+            low = 0
+            high = 0
+            if task.pool is not None:
+                low = task.pool.low_watermark
+                high = task.pool.high_watermark
+            if active_users is not None and self._is_upcoming(task):
+                prewarming[name] = active_users
+                low = max(low, active_users)
+                high = max(high, active_users)
+            if high == 0:
+                continue
+            generator = generator_key(tasks_cache, task_cache)
+            if generator in targets:
+                prev_task_cache, prev_low, prev_high = targets[generator]
+                targets[generator] = (prev_task_cache, max(low, prev_low), max(high, prev_high))
+            else:
+                targets[generator] = (task_cache, low, high)
+
+        with self._lock:
+            self._prewarming = prewarming
+
+        for generator, (task_cache, low, high) in targets.items():
+            name = task_cache.task.name
+            count = available.get(name, 0) + self._generation_queue.pending_pregenerations(generator)
+            if count < low:
+                missing = high - count
+                logger.info(f"Pool of task '{name}' has {count} instances, pre-generating {missing} more")
+                for _ in range(missing):
+                    self._generation_queue.enqueue(tasks_cache, task_cache)
+
+    def _run(self):
+        while True:
+            try:
+                self.is_leader = self._try_lead()
+                tasks_cache = self._get_tasks_cache()
+                if self.is_leader and tasks_cache is not None:
+                    self._fill(tasks_cache)
+            except Exception as e:
+                logger.error("Failed to fill pre-generated task pools", exc_info=e)
+            time.sleep(self._check_interval)
+
+    def get_stats(self, db, tasks_cache: TasksCache) -> Dict[str, Any]:
+        available = self._count_available(db)
+        now = time.monotonic()
+
+        def rate(events: Dict[TaskName, Deque[float]], task_name: TaskName) -> float:
+            count = sum(1 for event_time in events.get(task_name, ()) if event_time >= now - RATE_WINDOW)
+            return count * 60 / RATE_WINDOW
+
+        tasks = {}
+        with self._lock:
+            for name, task_cache in tasks_cache.tasks.items():
+                pool = task_cache.task.pool
+                if pool is None or task_cache.task.generator is None:
+                    continue
+                tasks[name] = {
+                    "available": available.get(name, 0),
+                    "target": pool.target,
+                    "low": pool.low_watermark,
+                    "high": pool.high_watermark,
+                    "claims_per_minute": rate(self._claims, name),
+                    "fills_per_minute": rate(self._fills, name),
+                }
+            prewarming = dict(self._prewarming)
+        return {
+            "leader": self.is_leader,
+            "tasks": tasks,
+            "prewarming": prewarming,
+        }
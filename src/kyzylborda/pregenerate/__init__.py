@@ -0,0 +1,147 @@
+import os
+import sys
+import time
+import logging
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Dict, Tuple, Optional, Any
+import yaml
+import sqlalchemy
+from sqlalchemy import func
+
+from ..db import Base, GeneratedTask
+from ..tasks import TaskName, read_tasks
+from ..cache import TasksCache, TaskCache, build_tasks_cache
+from ..generate import generator_key, generate_task
+
+
+logger = logging.getLogger(__name__)
+
+
+arg_parser = ArgumentParser(description="Pre-generate dynamic tasks in parallel.")
+arg_parser.add_argument("-n", "--count", type=int, required=True, help="number of unclaimed instances to have for every task; existing ones are counted, so interrupted runs can be resumed")
+arg_parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of generators to run in parallel")
+arg_parser.add_argument("-a", "--all", action="store_true", help="pre-generate all dynamic tasks")
+arg_parser.add_argument("config", metavar="CONFIG", help="path to web application config")
+arg_parser.add_argument("tasks", metavar="TASK", nargs="*", help="task names")
+
+
+# State of a pool process.
+_db: Any = None
+_tasks_cache: Optional[TasksCache] = None
+_attachments_path: Optional[str] = None
+
+
+def read_config(config_path: str) -> Dict[str, Any]:
+    with open(config_path) as f:
+        return yaml.load(f, Loader=yaml.FullLoader)
+
+
+def load_tasks(config: Dict[str, Any]) -> TasksCache:
+    return build_tasks_cache(read_tasks(config["TASKS_PATH"], default_attrs=config.get("DEFAULT_TASK_ATTRS", {})))
+
+
+def init_worker(config_path: str):
+    global _db, _tasks_cache, _attachments_path
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+    config = read_config(config_path)
+    db_engine = sqlalchemy.create_engine(config["DATABASE"])
+    _db = sqlalchemy.orm.scoped_session(sqlalchemy.orm.sessionmaker(bind=db_engine))
+    _tasks_cache = load_tasks(config)
+    _attachments_path = os.path.abspath(config["DYNAMIC_ATTACHMENTS_PATH"])
+
+
+def pregenerate_one(task_name: TaskName) -> Tuple[TaskName, float, Optional[str]]:
+    assert _tasks_cache is not None and _attachments_path is not None
+    start = time.perf_counter()
+    try:
+        generate_task(_db, _attachments_path, _tasks_cache, None, _tasks_cache.tasks[task_name])
+        error = None
+    except Exception as e:
+        logger.error(f"Failed to pre-generate task '{task_name}'", exc_info=e)
+        error = str(e)
+    finally:
+        _db.remove()
+    return task_name, time.perf_counter() - start, error
+
+
+def select_tasks(tasks_cache: TasksCache, names: List[TaskName], all_tasks: bool) -> Dict[str, TaskCache]:
+    """ Pick one task for every generator which should be run. """
+    if all_tasks:
+        candidates = [task_cache for task_cache in tasks_cache.tasks.values() if task_cache.task.generator is not None]
+    else:
+        candidates = []
+        for name in names:
+            if name not in tasks_cache.tasks:
+                raise RuntimeError(f"Task {name} doesn't exist")
+            task_cache = tasks_cache.tasks[name]
+            if task_cache.task.generator is None:
+                raise RuntimeError(f"Task {name} is not dynamic")
+            candidates.append(task_cache)
+
+    selected: Dict[str, TaskCache] = {}
+    for task_cache in candidates:
+        if task_cache.task.hmac_flag is not None:
+            logger.warn(f"Task {task_cache.task.name} uses HMAC flags and cannot be pre-generated, skipping")
+            continue
+        selected.setdefault(generator_key(tasks_cache, task_cache), task_cache)
+    return selected
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+
+    args = arg_parser.parse_args()
+    if not args.all and len(args.tasks) == 0:
+        arg_parser.error("specify task names or --all")
+
+    config = read_config(args.config)
+    tasks_cache = load_tasks(config)
+    try:
+        selected = select_tasks(tasks_cache, args.tasks, args.all)
+    except RuntimeError as e:
+        logger.error(str(e))
+        sys.exit(1)
+
+    db_engine = sqlalchemy.create_engine(config["DATABASE"])
+    Base.metadata.create_all(db_engine)
+    with db_engine.connect() as conn:
+        available = dict(conn.execute(sqlalchemy.select(GeneratedTask.task_name, func.count()).where(GeneratedTask.user_id.is_(None)).group_by(GeneratedTask.task_name)).all())
+    db_engine.dispose()
+
+    jobs: List[TaskName] = []
+    for task_cache in selected.values():
+        name = task_cache.task.name
+        missing = max(0, args.count - available.get(name, 0))
+        logger.info(f"Task {name}: {available.get(name, 0)} instances exist, generating {missing}")
+        jobs.extend([name] * missing)
+    if len(jobs) == 0:
+        logger.info("Nothing to do")
+        return
+
+    done = 0
+    failures: Dict[TaskName, int] = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker, initargs=(args.config,)) as executor:
+        futures = [executor.submit(pregenerate_one, name) for name in jobs]
+        for future in as_completed(futures):
+            name, elapsed, error = future.result()
+            done += 1
+            if error is not None:
+                failures[name] = failures.get(name, 0) + 1
+            throughput = done / (time.perf_counter() - start)
+            status = "ok" if error is None else "failed"
+            logger.info(f"[{done}/{len(jobs)}] {name}: {status} in {elapsed:.2f}s; {throughput:.2f} tasks/s, {sum(failures.values())} failures")
+
+    total_time = time.perf_counter() - start
+    logger.info(f"Generated {len(jobs) - sum(failures.values())} of {len(jobs)} instances in {total_time:.1f}s ({len(jobs) / total_time:.2f} tasks/s)")
+    if len(failures) > 0:
+        for name, count in failures.items():
+            logger.error(f"Task {name}: {count} failures")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
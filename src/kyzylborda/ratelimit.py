@@ -0,0 +1,135 @@
+from typing import Optional, Dict, List, Tuple
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+import time
+import logging
+from threading import Lock
+from dataclasses import dataclass
+from dataclasses_json import dataclass_json
+
+
+logger = logging.getLogger(__name__)
+
+
+# Key hash, tokens, last update time.
+SLOT_FORMAT = struct.Struct("<Qdd")
+COUNTER_FORMAT = struct.Struct("<Q")
+# Throttled attempts, per kind of limit.
+COUNTERS = ["user", "ip"]
+HEADER_SIZE = COUNTER_FORMAT.size * len(COUNTERS)
+DEFAULT_SLOTS = 65536
+# How many neighbouring slots are checked before a bucket is evicted.
+PROBE_LENGTH = 8
+
+
+@dataclass_json
+@dataclass(frozen=True)
+class RateLimit:
+    # Tokens per second.
+    rate: float
+    burst: int
+
+
+def key_hash(key: str) -> int:
+    # Zero marks an empty slot.
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little") or 1
+
+
+class SubmitRateLimiter:
+    """ Per-user and per-IP token buckets for flag submissions.
+
+        Buckets live in a memory-mapped file, so that all worker processes on the host share them.
+        The table has a fixed size; when it's full, buckets which were not used for the longest time are evicted. """
+
+    user_limit: Optional[RateLimit]
+    ip_limit: Optional[RateLimit]
+    _slots: int
+    _fd: int
+    _mmap: mmap.mmap
+    _lock: Lock
+
+    def __init__(self, path: str, user_limit: Optional[RateLimit]=None, ip_limit: Optional[RateLimit]=None, slots: int=DEFAULT_SLOTS):
+        self.user_limit = user_limit
+        self.ip_limit = ip_limit
+        self._slots = slots
+        self._lock = Lock()
+
+        size = HEADER_SIZE + SLOT_FORMAT.size * slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            # Never shrink the file: processes of a previous configuration may still have it mapped and would
+            # crash on access past the end. Slots keep key hashes, so different slot counts can share the file.
+            if os.fstat(self._fd).st_size < size:
+                logger.info(f"Initializing rate limiter state in {path}")
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, bytes(HEADER_SIZE), 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._mmap = mmap.mmap(self._fd, size)
+
+    def _slot_offset(self, index: int) -> int:
+        return HEADER_SIZE + SLOT_FORMAT.size * (index % self._slots)
+
+    def _take_slot(self, key: str, limit: RateLimit, now: float) -> Tuple[int, int, float]:
+        """ Find or allocate a bucket and refill it. Returns slot offset, key hash and current tokens. """
+        hash = key_hash(key)
+        victim_offset = None
+        victim_time = None
+        for i in range(PROBE_LENGTH):
+            offset = self._slot_offset(hash + i)
+            slot_hash, tokens, updated = SLOT_FORMAT.unpack_from(self._mmap, offset)
+            if slot_hash == hash:
+                tokens = min(float(limit.burst), tokens + max(0.0, now - updated) * limit.rate)
+                SLOT_FORMAT.pack_into(self._mmap, offset, hash, tokens, now)
+                return offset, hash, tokens
+            if slot_hash == 0:
+                updated = -1.0
+            if victim_time is None or updated < victim_time:
+                victim_offset = offset
+                victim_time = updated
+        assert victim_offset is not None
+        tokens = float(limit.burst)
+        SLOT_FORMAT.pack_into(self._mmap, victim_offset, hash, tokens, now)
+        return victim_offset, hash, tokens
+
+    def _increment(self, counter: str):
+        offset = COUNTER_FORMAT.size * COUNTERS.index(counter)
+        value, = COUNTER_FORMAT.unpack_from(self._mmap, offset)
+        COUNTER_FORMAT.pack_into(self._mmap, offset, value + 1)
+
+    def check(self, user_id: int, ip: Optional[str]) -> Optional[str]:
+        """ Take a token from every applicable bucket. Returns kind of the exceeded limit, if any; no tokens are taken then. """
+        limits: List[Tuple[str, str, RateLimit]] = []
+        if self.user_limit is not None:
+            limits.append(("user", f"user:{user_id}", self.user_limit))
+        if self.ip_limit is not None and ip is not None:
+            limits.append(("ip", f"ip:{ip}", self.ip_limit))
+        if len(limits) == 0:
+            return None
+
+        # flock() doesn't exclude threads of the same process.
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                buckets = []
+                for kind, key, limit in limits:
+                    offset, hash, tokens = self._take_slot(key, limit, now)
+                    if tokens < 1:
+                        self._increment(kind)
+                        return kind
+                    buckets.append((offset, hash, tokens))
+                for offset, hash, tokens in buckets:
+                    SLOT_FORMAT.pack_into(self._mmap, offset, hash, tokens - 1, now)
+                return None
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def get_stats(self) -> Dict[str, int]:
+        """ Throttled attempts since the state was initialized, by kind of limit. """
+        with self._lock:
+            return {f"throttled_{counter}": COUNTER_FORMAT.unpack_from(self._mmap, COUNTER_FORMAT.size * i)[0] for i, counter in enumerate(COUNTERS)}
@@ -0,0 +1,70 @@
+from typing import Dict, Tuple, Any
+import logging
+from threading import Lock
+
+from .tasks import TaskName
+from .notify import NotifyListener
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReadyTasks:
+    """ Generated tasks known to be finished, so that serving their files doesn't need the database.
+
+        Every process remembers tasks it has seen finished; deletions (flushes) reach all processes through
+        notifications. Notifications are lost while the listener reconnects, so then everything is forgotten. """
+
+    _lock: Lock
+    # (user id, task name) -> generated task id.
+    _ready: Dict[Tuple[int, TaskName], int]
+    _keys: Dict[int, Tuple[int, TaskName]]
+    # Incremented on every invalidation.
+    _version: int
+
+    def __init__(self):
+        self._lock = Lock()
+        self._ready = {}
+        self._keys = {}
+        self._version = 0
+
+    def subscribe(self, listener: NotifyListener):
+        listener.add_handler("tasks_deleted", self._handle_deleted)
+        listener.add_connect_handler(self.clear)
+
+    def _handle_deleted(self, payload: Dict[str, Any]):
+        with self._lock:
+            self._version += 1
+            for task_id in payload["task_ids"]:
+                key = self._keys.pop(task_id, None)
+                if key is not None:
+                    del self._ready[key]
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._ready = {}
+            self._keys = {}
+
+    def get_version(self) -> int:
+        """ Take before looking the task up in the database, and pass to `add`. """
+        with self._lock:
+            return self._version
+
+    def is_ready(self, user_id: int, task_name: TaskName) -> bool:
+        with self._lock:
+            return (user_id, task_name) in self._ready
+
+    def add(self, version: int, user_id: int, task_name: TaskName, task_id: int):
+        with self._lock:
+            # The task might have been deleted after it has been looked up.
+            if version != self._version:
+                return
+            self._ready[(user_id, task_name)] = task_id
+            self._keys[task_id] = (user_id, task_name)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "ready": len(self._ready),
+            }
@@ -0,0 +1,256 @@
+from typing import Optional, Dict, Set, Tuple, Callable, Any
+import os
+import os.path
+import time
+import errno
+import uuid
+import logging
+from threading import Thread, Lock
+from sqlalchemy.sql.expression import text
+
+from .cache import TasksCache
+from .tasks import TaskName
+from .db import GeneratedTask
+from .generate import generator_key
+from .attachments import move_to_trash, get_scratch_path
+
+
+logger = logging.getLogger(__name__)
+
+
+# Advisory lock held by the process which reconciles the attachments tree.
+JANITOR_LOCK_ID = 0x6b7a0002
+# Younger entries may belong to generations in progress.
+ORPHAN_MIN_AGE = 3600
+# Scratch directories are only touched when generators start, and some generators run for long.
+SCRATCH_MIN_AGE = 24 * 3600
+
+
+def get_tree_size(path: str) -> int:
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+class AttachmentsJanitor:
+    """ Reconciles DYNAMIC_ATTACHMENTS_PATH against generated tasks in the database.
+
+        Orphans are directories of tasks which don't exist anymore: ones of deleted users, pre-generated ones
+        left by crashed generations and stale scratch directories. They are moved to the trash. Pre-generated
+        directories of claimed tasks which haven't been moved to the user are moved now.
+
+        Entries younger than `min_age` are left alone, and no more than `rate` task directories are visited
+        per second, so that the janitor doesn't compete with serving files. Disk usage is reported
+        by task and by generator. """
+
+    last_report: Optional[Dict[str, Any]]
+    _db: Any
+    _db_engine: Any
+    _attachments_path: str
+    _get_tasks_cache: Callable[[], Optional[TasksCache]]
+    _interval: float
+    _min_age: float
+    _rate: float
+    _dry_run: bool
+    _lock: Lock
+
+    def __init__(self, db, db_engine, attachments_path: str, get_tasks_cache: Callable[[], Optional[TasksCache]], interval: float=3600, min_age: float=ORPHAN_MIN_AGE, rate: float=100, dry_run: bool=False):
+        self.last_report = None
+        self._db = db
+        self._db_engine = db_engine
+        self._attachments_path = attachments_path
+        self._get_tasks_cache = get_tasks_cache
+        self._interval = interval
+        self._min_age = min_age
+        self._rate = rate
+        self._dry_run = dry_run
+        self._lock = Lock()
+
+    def _throttle(self):
+        if self._rate > 0:
+            time.sleep(1 / self._rate)
+
+    def _is_old(self, path: str, min_age: Optional[float]=None) -> bool:
+        if min_age is None:
+            min_age = self._min_age
+        try:
+            return os.lstat(path).st_mtime < time.time() - max(min_age, self._min_age)
+        except FileNotFoundError:
+            return False
+
+    def _reclaim(self, path: str, report: Dict[str, Any]):
+        size = get_tree_size(path)
+        logger.info(f"Reclaiming orphaned '{os.path.relpath(path, self._attachments_path)}', {size} bytes")
+        if not self._dry_run and not move_to_trash(self._attachments_path, path):
+            return
+        report["orphans"] += 1
+        report["reclaimed_bytes"] += size
+
+    def _remove_if_empty(self, path: str, was_old: bool):
+        # Age is checked before reconciling the contents, which changes it.
+        if self._dry_run or not was_old:
+            return
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                raise
+
+    def _add_usage(self, report: Dict[str, Any], task_name: TaskName, size: int):
+        usage = report["tasks"].setdefault(task_name, {"instances": 0, "bytes": 0})
+        usage["instances"] += 1
+        usage["bytes"] += size
+
+    def _user_task_exists(self, user_id: int, task_name: TaskName) -> bool:
+        db = self._db
+        try:
+            return db.query(GeneratedTask.id).filter_by(user_id=user_id, task_name=task_name).first() is not None
+        finally:
+            db.remove()
+
+    def _pregenerated_owner(self, random_seed: str, task_name: TaskName) -> Tuple[bool, Optional[int], bool]:
+        """ Whether the row exists, its user id and whether it's finished. """
+        db = self._db
+        try:
+            row = db.query(GeneratedTask.user_id, GeneratedTask.substitutions.isnot(None)).filter_by(random_seed=random_seed, task_name=task_name).one_or_none()
+        finally:
+            db.remove()
+        if row is None:
+            return False, None, False
+        return True, row[0], row[1]
+
+    def _reconcile_user(self, user_dir: str, user_id: int, user_tasks: Set[Tuple[int, TaskName]], report: Dict[str, Any]):
+        was_old = self._is_old(user_dir)
+        for entry in os.scandir(user_dir):
+            self._throttle()
+            if (user_id, entry.name) in user_tasks:
+                self._add_usage(report, entry.name, get_tree_size(entry.path))
+            elif self._is_old(entry.path) and not self._user_task_exists(user_id, entry.name):
+                # Checked again right before removal: the task might have been claimed since loading.
+                self._reclaim(entry.path, report)
+        self._remove_if_empty(user_dir, was_old)
+
+    def _reconcile_pregenerated(self, seed_dir: str, random_seed: str, pregenerated_tasks: Set[Tuple[str, TaskName]], report: Dict[str, Any]):
+        was_old = self._is_old(seed_dir)
+        for entry in os.scandir(seed_dir):
+            self._throttle()
+            if (random_seed, entry.name) in pregenerated_tasks or not self._is_old(entry.path):
+                self._add_usage(report, entry.name, get_tree_size(entry.path))
+                continue
+            # Either an orphan or claimed by now.
+            exists, user_id, finished = self._pregenerated_owner(random_seed, entry.name)
+            if not exists:
+                self._reclaim(entry.path, report)
+            elif user_id is None or not finished:
+                self._add_usage(report, entry.name, get_tree_size(entry.path))
+            else:
+                # Claimed, but the files haven't been moved (see move_pregenerated).
+                to_dir = os.path.join(self._attachments_path, str(user_id), entry.name)
+                if os.path.exists(to_dir):
+                    self._reclaim(entry.path, report)
+                else:
+                    logger.info(f"Moving claimed pre-generated task '{entry.name}' with random seed {random_seed} to user {user_id}")
+                    if not self._dry_run:
+                        os.makedirs(os.path.dirname(to_dir), exist_ok=True)
+                        try:
+                            os.rename(entry.path, to_dir)
+                        except OSError as e:
+                            # Moved concurrently by move_pregenerated.
+                            if e.errno not in (errno.ENOENT, errno.EEXIST, errno.ENOTEMPTY):
+                                raise
+                            continue
+                    report["moved"] += 1
+                    self._add_usage(report, entry.name, get_tree_size(to_dir if not self._dry_run else entry.path))
+        self._remove_if_empty(seed_dir, was_old)
+
+    def reconcile(self) -> Dict[str, Any]:
+        start = time.monotonic()
+        db = self._db
+        try:
+            user_tasks: Set[Tuple[int, TaskName]] = set()
+            # Unclaimed ones.
+            pregenerated_tasks: Set[Tuple[str, TaskName]] = set()
+            for user_id, task_name, random_seed in db.query(GeneratedTask.user_id, GeneratedTask.task_name, GeneratedTask.random_seed):
+                if user_id is not None:
+                    user_tasks.add((user_id, task_name))
+                else:
+                    pregenerated_tasks.add((str(random_seed), task_name))
+        finally:
+            db.remove()
+
+        report: Dict[str, Any] = {
+            "orphans": 0,
+            "reclaimed_bytes": 0,
+            "moved": 0,
+            "tasks": {},
+            "generators": {},
+        }
+        # Entries starting with a dot are internal (trash, blobs and so on) or not ours.
+        for entry in os.scandir(self._attachments_path):
+            if entry.name.startswith(".") or not entry.is_dir(follow_symlinks=False):
+                continue
+            if entry.name == "pregenerated":
+                for seed_entry in os.scandir(entry.path):
+                    if not seed_entry.is_dir(follow_symlinks=False):
+                        continue
+                    try:
+                        uuid.UUID(seed_entry.name)
+                    except ValueError:
+                        logger.warn(f"Unknown entry 'pregenerated/{seed_entry.name}' in the attachments directory; ignored")
+                    else:
+                        self._reconcile_pregenerated(seed_entry.path, seed_entry.name, pregenerated_tasks, report)
+            elif entry.name.isdigit():
+                self._reconcile_user(entry.path, int(entry.name), user_tasks, report)
+            else:
+                logger.warn(f"Unknown entry '{entry.name}' in the attachments directory; ignored")
+
+        try:
+            scratch_entries = list(os.scandir(get_scratch_path(self._attachments_path)))
+        except FileNotFoundError:
+            scratch_entries = []
+        for entry in scratch_entries:
+            self._throttle()
+            # Left by generators which have crashed along with their process.
+            if self._is_old(entry.path, SCRATCH_MIN_AGE):
+                self._reclaim(entry.path, report)
+
+        tasks_cache = self._get_tasks_cache()
+        for task_name, usage in report["tasks"].items():
+            if tasks_cache is not None and task_name in tasks_cache.tasks and tasks_cache.tasks[task_name].task.generator is not None:
+                generator = generator_key(tasks_cache, tasks_cache.tasks[task_name])
+            else:
+                generator = task_name
+            generator_usage = report["generators"].setdefault(generator, {"bytes": 0})
+            generator_usage["bytes"] += usage["bytes"]
+
+        report["time"] = time.monotonic() - start
+        with self._lock:
+            self.last_report = report
+        return report
+
+    def start(self):
+        Thread(target=self._run, name="kyzylborda-attachments-janitor", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                # Only one process reconciles at a time; it's an expensive operation.
+                with self._db_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                    if conn.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": JANITOR_LOCK_ID}).scalar():
+                        try:
+                            report = self.reconcile()
+                            logger.info(f"Attachments reconciled in {report['time']:.1f}s: {report['orphans']} orphans, {report['reclaimed_bytes']} bytes reclaimed, {report['moved']} tasks moved")
+                        finally:
+                            conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": JANITOR_LOCK_ID})
+            except Exception as e:
+                logger.error("Failed to reconcile attachments", exc_info=e)
+            time.sleep(self._interval)
+
+    def get_stats(self) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self.last_report
@@ -1,11 +1,16 @@
-from typing import Set, List, Dict, Set, Optional, Iterator
+from typing import Set, List, Dict, Set, Optional, Iterator, Tuple, Callable
 from datetime import MINYEAR, datetime, timezone
 from dataclasses import dataclass, field
+from threading import Lock
+from time import monotonic
 import logging
+from sqlalchemy.sql.expression import text
+from sortedcontainers import SortedList
 
+from .utils import set_factory, utc_now
 from .db import User, SubmittedFlag, GrantedHint
 from .tasks import TaskName, HintName
-from .cache import TasksCache
+from .cache import TasksCache, task_is_visible
 
 
 logger = logging.getLogger(__name__)
@@ -39,22 +44,30 @@ def user_score_sort_key(score):
     return (-score.points, last_flag_time)
 
 
-def score_users(cache: TasksCache, db, tags: Optional[List[str]]=None, is_organizer: Optional[bool]=None, filter_zero=False) -> List[UserScore]:
-    scores: Dict[int, UserScore] = {}
-
+def query_scores(db, tags: Optional[List[str]]=None, is_organizer: Optional[bool]=None) -> Tuple[List[Tuple], List[Tuple], List[Tuple]]:
     # This whole query is crazy ineffective.
     user_query = db.query(User.id, User.login, User.name, User.tags, User.is_organizer, User.is_disqualified)
     if tags is not None:
         user_query = user_query.filter(User.tags.overlap(tags))
     if is_organizer is not None:
         user_query = user_query.filter_by(is_organizer=is_organizer)
+    users = user_query.order_by(User.signup_time.desc()).all()
+    user_ids = [row[0] for row in users]
+
+    flags = db.query(SubmittedFlag.id, SubmittedFlag.submitter_id, SubmittedFlag.task_name, SubmittedFlag.accept_time).filter(SubmittedFlag.submitter_id.in_(user_ids)).all()
+    hints = db.query(GrantedHint.id, GrantedHint.requester_id, GrantedHint.task_name, GrantedHint.hint_name).filter(GrantedHint.requester_id.in_(user_ids)).all()
+    return users, flags, hints
 
-    for id, login, name, user_tags, user_is_organizer, user_is_disqualified in user_query.order_by(User.signup_time.desc()):
+
+def aggregate_scores(cache: TasksCache, users: List[Tuple], flags: List[Tuple], hints: List[Tuple]) -> Dict[int, UserScore]:
+    scores: Dict[int, UserScore] = {}
+
+    for id, login, name, user_tags, user_is_organizer, user_is_disqualified in users:
         initial_rank = None if user_is_disqualified else 0
         tag_ranks = {tag: initial_rank for tag in user_tags}
         scores[id] = UserScore(login=login, name=name, total_rank=initial_rank, tag_ranks=tag_ranks, is_organizer=user_is_organizer)
 
-    for id, submitter_id, task_name, raw_accept_time in db.query(SubmittedFlag.id, SubmittedFlag.submitter_id, SubmittedFlag.task_name, SubmittedFlag.accept_time).filter(SubmittedFlag.submitter_id.in_(scores.keys())):
+    for id, submitter_id, task_name, raw_accept_time in flags:
         task_cache = cache.tasks.get(task_name)
         if task_cache is None:
             logger.warn(f"Flag for unknown task '{task_name}' with id {id} found; skipping")
@@ -72,7 +85,7 @@ def score_users(cache: TasksCache, db, tags: Optional[List[str]]=None, is_organi
         task_score = UserTaskScore(flag_time=accept_time, points=task_cache.task.points)
         user_score.tasks[task_name] = task_score
 
-    for id, requester_id, task_name, hint_name in db.query(GrantedHint.id, GrantedHint.requester_id, GrantedHint.task_name, GrantedHint.hint_name).filter(GrantedHint.requester_id.in_(scores.keys())):
+    for id, requester_id, task_name, hint_name in hints:
         task_cache = cache.tasks.get(task_name)
         if task_cache is None:
             logger.warn(f"Hint for unknown task '{task_name}' with id {id} found; skipping")
@@ -90,6 +103,10 @@ def score_users(cache: TasksCache, db, tags: Optional[List[str]]=None, is_organi
     for user_score in scores.values():
         user_score.points = sum(map(lambda x: x.points, user_score.tasks.values()))
 
+    return scores
+
+
+def rank_scores(scores: Dict[int, UserScore], filter_zero=False) -> List[UserScore]:
     # Why is type annotation needed here???
     score_values_i: Iterator[UserScore] = scores.values() # type: ignore
     if filter_zero:
@@ -105,3 +122,450 @@ def score_users(cache: TasksCache, db, tags: Optional[List[str]]=None, is_organi
             current_tag_ranks[tag] = rank + 1
 
     return score_values
+
+
+def score_users(cache: TasksCache, db, tags: Optional[List[str]]=None, is_organizer: Optional[bool]=None, filter_zero=False) -> List[UserScore]:
+    users, flags, hints = query_scores(db, tags=tags, is_organizer=is_organizer)
+    return rank_scores(aggregate_scores(cache, users, flags, hints), filter_zero=filter_zero)
+
+SCORE_USERS_QUERY = text("""
+    WITH task_points(task_name, points, submit_not_after) AS (
+        SELECT * FROM unnest(CAST(:task_names AS text[]), CAST(:task_points AS integer[]), CAST(:task_deadlines AS timestamp[]))
+    ), hint_points(task_name, hint_name, points) AS (
+        SELECT * FROM unnest(CAST(:hint_tasks AS text[]), CAST(:hint_names AS text[]), CAST(:hint_points AS integer[]))
+    ), scored_users AS (
+        SELECT id, login, name, tags, is_organizer, is_disqualified, signup_time FROM users
+        WHERE (CAST(:tags AS text[]) IS NULL OR tags && CAST(:tags AS text[]))
+          AND (CAST(:is_organizer AS boolean) IS NULL OR is_organizer = CAST(:is_organizer AS boolean))
+    ), penalties AS (
+        SELECT g.requester_id, g.task_name, sum(h.points) AS points, array_agg(g.hint_name) AS hints
+        FROM granted_hints g JOIN hint_points h ON h.task_name = g.task_name AND h.hint_name = g.hint_name
+        GROUP BY g.requester_id, g.task_name
+    ), solves AS (
+        SELECT f.submitter_id, f.task_name, f.accept_time,
+               CAST(greatest(0, t.points - coalesce(p.points, 0)) AS integer) AS points, coalesce(p.hints, '{}') AS hints
+        FROM submitted_flags f
+        JOIN scored_users u ON u.id = f.submitter_id
+        JOIN task_points t ON t.task_name = f.task_name
+        LEFT JOIN penalties p ON p.requester_id = f.submitter_id AND p.task_name = f.task_name
+        WHERE t.submit_not_after IS NULL OR f.accept_time <= t.submit_not_after
+    ), totals AS (
+        SELECT u.id, u.login, u.name, u.tags, u.is_organizer, u.is_disqualified, u.signup_time,
+               CAST(coalesce(sum(s.points), 0) AS integer) AS points, max(s.accept_time) AS last_flag_time,
+               coalesce(jsonb_object_agg(s.task_name, jsonb_build_array(s.points, s.accept_time, s.hints)) FILTER (WHERE s.task_name IS NOT NULL), '{}') AS tasks
+        FROM scored_users u LEFT JOIN solves s ON s.submitter_id = u.id
+        GROUP BY u.id, u.login, u.name, u.tags, u.is_organizer, u.is_disqualified, u.signup_time
+    ), ordered AS (
+        SELECT *, row_number() OVER (ORDER BY points DESC, last_flag_time ASC NULLS LAST, signup_time DESC, id) AS position
+        FROM totals
+        WHERE NOT CAST(:filter_zero AS boolean) OR points > 0
+    ), ranked AS (
+        SELECT *, CASE WHEN is_disqualified THEN NULL ELSE row_number() OVER (PARTITION BY is_disqualified ORDER BY position) END AS total_rank
+        FROM ordered
+    ), tag_ranks AS (
+        SELECT id, jsonb_object_agg(tag, rank) AS tag_ranks
+        FROM (
+            SELECT r.id, t.tag, CASE WHEN r.is_disqualified THEN NULL ELSE row_number() OVER (PARTITION BY t.tag, r.is_disqualified ORDER BY r.position) END AS rank
+            FROM ranked r CROSS JOIN LATERAL unnest(r.tags) AS t(tag)
+        ) AS user_tags
+        GROUP BY id
+    )
+    SELECT r.login, r.name, r.is_organizer, r.total_rank, coalesce(t.tag_ranks, '{}'), r.tasks, r.last_flag_time, r.points
+    FROM ranked r LEFT JOIN tag_ranks t ON t.id = r.id
+    ORDER BY r.position
+""")
+
+
+def naive_utc(time: Optional[datetime]) -> Optional[datetime]:
+    return None if time is None else time.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def score_users_sql(cache: TasksCache, db, tags: Optional[List[str]]=None, is_organizer: Optional[bool]=None, filter_zero=False) -> List[UserScore]:
+    """ Same as `score_users`, but sums, penalties and ranks are computed by PostgreSQL in a single query. """
+    tasks = [task_cache.task for task_cache in cache.tasks.values()]
+    hints = [(task_cache.task.name, hint) for task_cache in cache.tasks.values() for hint in task_cache.hints.values()]
+    params = {
+        "task_names": [task.name for task in tasks],
+        "task_points": [task.points for task in tasks],
+        "task_deadlines": [naive_utc(task.submit_not_after) for task in tasks],
+        "hint_tasks": [task_name for task_name, hint in hints],
+        "hint_names": [hint.name for task_name, hint in hints],
+        "hint_points": [hint.points for task_name, hint in hints],
+        "tags": tags,
+        "is_organizer": is_organizer,
+        "filter_zero": filter_zero,
+    }
+
+    scores = []
+    for login, name, user_is_organizer, total_rank, tag_ranks, raw_tasks, last_flag_time, points in db.execute(SCORE_USERS_QUERY, params):
+        task_scores = {}
+        for task_name, (task_points, raw_flag_time, task_hints) in raw_tasks.items():
+            flag_time = datetime.fromisoformat(raw_flag_time).replace(tzinfo=timezone.utc)
+            task_scores[task_name] = UserTaskScore(flag_time=flag_time, points=task_points, hints=set(task_hints))
+        scores.append(UserScore(
+            login=login,
+            name=name,
+            is_organizer=user_is_organizer,
+            total_rank=total_rank,
+            tag_ranks=tag_ranks,
+            tasks=task_scores,
+            last_flag_time=None if last_flag_time is None else last_flag_time.replace(tzinfo=timezone.utc),
+            points=points,
+        ))
+    return scores
+
+
+# Rows may become visible out of id order when transactions commit concurrently,
+# so catch-up queries re-read a tail of already seen rows. Applying them again is a no-op.
+CATCH_UP_OVERLAP = 100
+
+
+@dataclass(frozen=True)
+class ScoreboardEvent:
+    # "solve", "score" (points changed without a new solve) or "reload" (everything may have changed).
+    type: str
+    user: Optional[str] = None
+    task: Optional[TaskName] = None
+    points: Optional[int] = None
+    # Place among non-organizers which aren't disqualified.
+    rank: Optional[int] = None
+    previous_rank: Optional[int] = None
+    # Enough to update a scoreboard table in place: points for visible tasks, time of the last flag and user tags.
+    tasks: Optional[Dict[TaskName, int]] = None
+    last_flag_time: Optional[datetime] = None
+    tags: Optional[List[str]] = None
+
+
+@dataclass
+class ScoreboardUser:
+    id: int
+    login: str
+    name: str
+    tags: List[str]
+    is_organizer: bool
+    is_disqualified: bool
+    signup_time: datetime
+    flags: Dict[TaskName, datetime] = field(default_factory=dict)
+    hints: Dict[TaskName, Set[HintName]] = field(default_factory=dict)
+    # Derived from the fields above and current tasks cache.
+    points: int = 0
+    last_flag_time: Optional[datetime] = None
+
+    def is_ranked(self) -> bool:
+        return not self.is_disqualified and not self.is_organizer
+
+    def sort_key(self):
+        last_flag_time = self.last_flag_time if self.last_flag_time is not None else LAST_MOMENT
+        # Ties are broken by the newest signup first, as in score_users.
+        return (-self.points, last_flag_time, -self.signup_time.timestamp(), self.id)
+
+    def task_scores(self, cache: TasksCache) -> Dict[TaskName, UserTaskScore]:
+        tasks: Dict[TaskName, UserTaskScore] = {}
+        for task_name, accept_time in self.flags.items():
+            task_cache = cache.tasks.get(task_name)
+            if task_cache is None:
+                continue
+            if task_cache.task.submit_not_after and accept_time > task_cache.task.submit_not_after:
+                continue
+            hints = {hint_name for hint_name in self.hints.get(task_name, ()) if hint_name in task_cache.hints}
+            penalty = sum(task_cache.hints[hint_name].points for hint_name in hints)
+            tasks[task_name] = UserTaskScore(flag_time=accept_time, points=max(0, task_cache.task.points - penalty), hints=hints)
+        return tasks
+
+    def derive(self, cache: TasksCache):
+        task_scores = self.task_scores(cache)
+        self.points = sum(task_score.points for task_score in task_scores.values())
+        self.last_flag_time = max((task_score.flag_time for task_score in task_scores.values()), default=None)
+
+
+class Scoreboard:
+    """ In-memory scoreboard which is updated incrementally by flag and hint events.
+
+        The state is loaded from the database once, then kept up to date by
+        `add_flag` and `add_hint` and by cheap catch-up queries for rows
+        written by other processes. Snapshots in `score_users` format are
+        cached until the next change. """
+
+    version: int
+    _lock: Lock
+    _rebuild_interval: Optional[float]
+    _rebuild_time: float
+    _refresh_interval: float
+    _catch_up_time: float
+    _tasks_cache: Optional[TasksCache]
+    _users: Dict[int, ScoreboardUser]
+    # Sorted lists keep insertions, removals and rank lookups logarithmic.
+    _order: SortedList
+    _ranked_order: SortedList
+    _listeners: List[Callable[[ScoreboardEvent], None]]
+    _last_user_id: int
+    _last_flag_id: int
+    _last_hint_id: int
+    _snapshots: Dict[Tuple, List[UserScore]]
+    _snapshots_version: int
+
+    def __init__(self, rebuild_interval: Optional[float]=None, refresh_interval: float=0):
+        self.version = 0
+        self._lock = Lock()
+        # Full reload from the database catches changes done outside of the platform, like disqualifications.
+        self._rebuild_interval = rebuild_interval
+        self._rebuild_time = 0
+        # Changes from other processes are looked up at most once per this interval.
+        self._refresh_interval = refresh_interval
+        self._catch_up_time = 0
+        self._tasks_cache = None
+        self._users = {}
+        self._order = SortedList()
+        # Only users who get a place on the public scoreboard.
+        self._ranked_order = SortedList()
+        self._listeners = []
+        self._last_user_id = 0
+        self._last_flag_id = 0
+        self._last_hint_id = 0
+        self._snapshots = {}
+        self._snapshots_version = -1
+
+    def _insert_user(self, user: ScoreboardUser, cache: TasksCache):
+        user.derive(cache)
+        key = user.sort_key()
+        self._order.add(key)
+        if user.is_ranked():
+            self._ranked_order.add(key)
+
+    def _remove_user(self, user: ScoreboardUser):
+        key = user.sort_key()
+        self._order.remove(key)
+        if user.is_ranked():
+            self._ranked_order.remove(key)
+
+    def _public_rank(self, user: ScoreboardUser) -> Optional[int]:
+        if not user.is_ranked():
+            return None
+        return self._ranked_order.bisect_left(user.sort_key()) + 1
+
+    def _emit(self, event: ScoreboardEvent):
+        for listener in self._listeners:
+            listener(event)
+
+    def _update_user(self, user: ScoreboardUser, cache: TasksCache, solved_task: Optional[TaskName]=None):
+        old_points = user.points
+        old_rank = self._public_rank(user)
+        self._remove_user(user)
+        self._insert_user(user, cache)
+        if not user.is_organizer:
+            if solved_task is not None:
+                # Don't reveal hidden tasks and flags which are submitted too late.
+                task_cache = cache.tasks.get(solved_task)
+                if task_cache is None or not task_is_visible(utc_now(), task_cache.task) or user.points == old_points:
+                    solved_task = None
+            if solved_task is not None or user.points != old_points:
+                now = utc_now()
+                tasks = {task_name: task_score.points for task_name, task_score in user.task_scores(cache).items() if task_is_visible(now, cache.tasks[task_name].task)}
+                self._emit(ScoreboardEvent(
+                    type="solve" if solved_task is not None else "score",
+                    user=user.name,
+                    task=solved_task,
+                    points=user.points,
+                    rank=self._public_rank(user),
+                    previous_rank=old_rank,
+                    tasks=tasks,
+                    last_flag_time=user.last_flag_time,
+                    tags=user.tags,
+                ))
+
+    def _set_user(self, cache: TasksCache, id: int, login: str, name: str, tags: List[str], is_organizer: bool, is_disqualified: bool, signup_time: datetime) -> bool:
+        signup_time = signup_time.replace(tzinfo=timezone.utc)
+        self._last_user_id = max(self._last_user_id, id)
+        user = self._users.get(id)
+        if user is None:
+            user = ScoreboardUser(id=id, login=login, name=name, tags=list(tags), is_organizer=is_organizer, is_disqualified=is_disqualified, signup_time=signup_time)
+            self._users[id] = user
+            self._insert_user(user, cache)
+            return True
+        if (user.login, user.name, user.tags, user.is_organizer, user.is_disqualified, user.signup_time) == (login, name, list(tags), is_organizer, is_disqualified, signup_time):
+            return False
+        self._remove_user(user)
+        user.login, user.name, user.tags, user.is_organizer, user.is_disqualified, user.signup_time = login, name, list(tags), is_organizer, is_disqualified, signup_time
+        self._insert_user(user, cache)
+        return True
+
+    def _set_flag(self, cache: TasksCache, user_id: int, task_name: TaskName, accept_time: datetime) -> bool:
+        user = self._users.get(user_id)
+        if user is None or task_name in user.flags:
+            return False
+        user.flags[task_name] = accept_time.replace(tzinfo=timezone.utc)
+        self._update_user(user, cache, solved_task=task_name)
+        return True
+
+    def _set_hint(self, cache: TasksCache, user_id: int, task_name: TaskName, hint_name: HintName) -> bool:
+        user = self._users.get(user_id)
+        if user is None:
+            return False
+        hints = set_factory(user.hints, task_name, set)
+        if hint_name in hints:
+            return False
+        hints.add(hint_name)
+        self._update_user(user, cache)
+        return True
+
+    def _query_users(self, db, min_id: int):
+        return db.query(User.id, User.login, User.name, User.tags, User.is_organizer, User.is_disqualified, User.signup_time).filter(User.id > min_id)
+
+    def _catch_up(self, cache: TasksCache, db) -> bool:
+        changed = False
+        for row in self._query_users(db, self._last_user_id - CATCH_UP_OVERLAP):
+            changed = self._set_user(cache, *row) or changed
+        for id, submitter_id, task_name, accept_time in db.query(SubmittedFlag.id, SubmittedFlag.submitter_id, SubmittedFlag.task_name, SubmittedFlag.accept_time).filter(SubmittedFlag.id > self._last_flag_id - CATCH_UP_OVERLAP):
+            self._last_flag_id = max(self._last_flag_id, id)
+            changed = self._set_flag(cache, submitter_id, task_name, accept_time) or changed
+        for id, requester_id, task_name, hint_name in db.query(GrantedHint.id, GrantedHint.requester_id, GrantedHint.task_name, GrantedHint.hint_name).filter(GrantedHint.id > self._last_hint_id - CATCH_UP_OVERLAP):
+            self._last_hint_id = max(self._last_hint_id, id)
+            changed = self._set_hint(cache, requester_id, task_name, hint_name) or changed
+        return changed
+
+    def _public_state(self) -> List[Tuple]:
+        return [(key, self._users[key[-1]].name, self._users[key[-1]].tags, self._users[key[-1]].is_organizer, self._users[key[-1]].is_disqualified) for key in self._order]
+
+    def _rebuild(self, cache: TasksCache, db):
+        old_tasks_cache = self._tasks_cache
+        old_state = self._public_state()
+        # Load raw state first and derive scores once per user.
+        self._users = {}
+        self._last_user_id = 0
+        for id, login, name, tags, is_organizer, is_disqualified, signup_time in self._query_users(db, 0):
+            self._users[id] = ScoreboardUser(id=id, login=login, name=name, tags=list(tags), is_organizer=is_organizer, is_disqualified=is_disqualified, signup_time=signup_time.replace(tzinfo=timezone.utc))
+            self._last_user_id = max(self._last_user_id, id)
+        self._last_flag_id = 0
+        for id, submitter_id, task_name, accept_time in db.query(SubmittedFlag.id, SubmittedFlag.submitter_id, SubmittedFlag.task_name, SubmittedFlag.accept_time):
+            self._last_flag_id = max(self._last_flag_id, id)
+            user = self._users.get(submitter_id)
+            if user is not None:
+                user.flags[task_name] = accept_time.replace(tzinfo=timezone.utc)
+        self._last_hint_id = 0
+        for id, requester_id, task_name, hint_name in db.query(GrantedHint.id, GrantedHint.requester_id, GrantedHint.task_name, GrantedHint.hint_name):
+            self._last_hint_id = max(self._last_hint_id, id)
+            user = self._users.get(requester_id)
+            if user is not None:
+                set_factory(user.hints, task_name, set).add(hint_name)
+        self._rederive(cache)
+        # Rebuilds are periodic; don't make every client reload when nothing has changed.
+        if cache is not old_tasks_cache or self._public_state() != old_state:
+            self._emit(ScoreboardEvent(type="reload"))
+        self._rebuild_time = monotonic()
+        logger.info(f"Scoreboard rebuilt, {len(self._users)} users total")
+
+    def _rederive(self, cache: TasksCache):
+        # Task points or deadlines might have changed; raw flags and hints are still valid.
+        self._tasks_cache = cache
+        for user in self._users.values():
+            user.derive(cache)
+        self._order = SortedList(user.sort_key() for user in self._users.values())
+        self._ranked_order = SortedList(user.sort_key() for user in self._users.values() if user.is_ranked())
+
+    def refresh(self, cache: TasksCache, db) -> int:
+        """ Bring the scoreboard up to date with the tasks cache and the database and return its version. """
+        with self._lock:
+            now = monotonic()
+            if self._tasks_cache is None or (self._rebuild_interval is not None and now - self._rebuild_time > self._rebuild_interval):
+                self._rebuild(cache, db)
+                self._catch_up_time = now
+                changed = True
+            else:
+                changed = False
+                if cache is not self._tasks_cache:
+                    self._rederive(cache)
+                    self._emit(ScoreboardEvent(type="reload"))
+                    changed = True
+                if now - self._catch_up_time >= self._refresh_interval:
+                    changed = self._catch_up(cache, db) or changed
+                    self._catch_up_time = now
+            if changed:
+                self.version += 1
+            return self.version
+
+    def catch_up(self, db) -> int:
+        """ Look up changes from other processes if the scoreboard is loaded, and return its version. """
+        with self._lock:
+            if self._tasks_cache is not None and self._catch_up(self._tasks_cache, db):
+                self.version += 1
+                self._catch_up_time = monotonic()
+            return self.version
+
+    def add_listener(self, listener: Callable[[ScoreboardEvent], None]):
+        """ Subscribe to public score changes. The listener is called with the scoreboard lock held. """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[ScoreboardEvent], None]):
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def add_flag(self, user: User, task_name: TaskName, accept_time: datetime):
+        with self._lock:
+            if self._tasks_cache is None:
+                # Not loaded yet; the flag will be read from the database.
+                return
+            changed = self._set_user(self._tasks_cache, user.id, user.login, user.name, user.tags, user.is_organizer, user.is_disqualified, user.signup_time)
+            changed = self._set_flag(self._tasks_cache, user.id, task_name, accept_time) or changed
+            if changed:
+                self.version += 1
+
+    def add_hint(self, user: User, task_name: TaskName, hint_name: HintName):
+        with self._lock:
+            if self._tasks_cache is None:
+                return
+            changed = self._set_user(self._tasks_cache, user.id, user.login, user.name, user.tags, user.is_organizer, user.is_disqualified, user.signup_time)
+            changed = self._set_hint(self._tasks_cache, user.id, task_name, hint_name) or changed
+            if changed:
+                self.version += 1
+
+    def _make_snapshot(self, tags: Optional[List[str]], is_organizer: Optional[bool], filter_zero: bool) -> List[UserScore]:
+        assert self._tasks_cache is not None
+        tags_set = None if tags is None else set(tags)
+        score_values: List[UserScore] = []
+        total_rank = 1
+        current_tag_ranks: Dict[str, int] = {}
+        for key in self._order:
+            user = self._users[key[-1]]
+            if tags_set is not None and tags_set.isdisjoint(user.tags):
+                continue
+            if is_organizer is not None and user.is_organizer != is_organizer:
+                continue
+            if filter_zero and user.points <= 0:
+                continue
+            if user.is_disqualified:
+                user_total_rank = None
+                tag_ranks: Dict[str, Optional[int]] = {tag: None for tag in user.tags}
+            else:
+                user_total_rank = total_rank
+                total_rank += 1
+                tag_ranks = {}
+                for tag in user.tags:
+                    rank = current_tag_ranks.get(tag, 1)
+                    tag_ranks[tag] = rank
+                    current_tag_ranks[tag] = rank + 1
+            score_values.append(UserScore(
+                login=user.login,
+                name=user.name,
+                is_organizer=user.is_organizer,
+                total_rank=user_total_rank,
+                tag_ranks=tag_ranks,
+                tasks=user.task_scores(self._tasks_cache),
+                last_flag_time=user.last_flag_time,
+                points=user.points,
+            ))
+        return score_values
+
+    def score_users(self, cache: TasksCache, db, tags: Optional[List[str]]=None, is_organizer: Optional[bool]=None, filter_zero=False) -> List[UserScore]:
+        """ Same as `score_users`, but served from the snapshot cache. Returned values must not be modified. """
+        self.refresh(cache, db)
+        with self._lock:
+            if self._snapshots_version != self.version:
+                self._snapshots = {}
+                self._snapshots_version = self.version
+            key = (None if tags is None else tuple(sorted(tags)), is_organizer, filter_zero)
+            snapshot = self._snapshots.get(key)
+            if snapshot is None:
+                snapshot = self._make_snapshot(tags, is_organizer, filter_zero)
+                self._snapshots[key] = snapshot
+            return snapshot
@@ -63,6 +63,53 @@ class TaskGenerator:
     exec: List[str]
     cwd: str
     multi_generator_key: Optional[MultiGeneratorKey] = None
+    # Keep generator processes running between jobs; see generator_workers.py for the protocol.
+    persistent: bool = False
+    workers: int = 1
+    # Restart a persistent generator process after this many jobs.
+    max_jobs: int = 100
+    # Kill a persistent generator process which doesn't respond to a job in this many seconds.
+    job_timeout: Optional[float] = 600
+
+    def __post_init__(self):
+        if self.workers < 1 or self.max_jobs < 1:
+            raise RuntimeError("Persistent generator should have at least one worker and job")
+        if self.job_timeout is not None and self.job_timeout <= 0:
+            raise RuntimeError("Persistent generator job timeout should be positive")
+
+
+@dataclass_json
+@dataclass(frozen=True)
+class HmacFlag:
+    prefix: str
+    length: int = 32
+
+    def __post_init__(self):
+        if self.prefix != self.prefix.lower():
+            raise RuntimeError("HMAC flag prefix should be lowercase; flags are case-insensitive")
+        if self.length < 16 or self.length > 64:
+            raise RuntimeError("HMAC flag length should be between 16 and 64")
+
+
+@dataclass_json
+@dataclass(frozen=True)
+class TaskPool:
+    """ Number of pre-generated instances to keep. The pool is refilled up to `high` once it drops below `low`. """
+    target: int
+    low: Optional[int] = None
+    high: Optional[int] = None
+
+    @property
+    def low_watermark(self) -> int:
+        return self.low if self.low is not None else self.target
+
+    @property
+    def high_watermark(self) -> int:
+        return self.high if self.high is not None else self.target
+
+    def __post_init__(self):
+        if not (0 <= self.low_watermark <= self.high_watermark):
+            raise RuntimeError("Pool watermarks should satisfy 0 <= low <= high")
 
 
 @dataclass_json
@@ -82,6 +129,8 @@ class Task:
     attachments_path: Optional[str] = None
     static_path: Optional[str] = None
     generator: Optional[TaskGenerator] = None
+    hmac_flag: Optional[HmacFlag] = None
+    pool: Optional[TaskPool] = None
     daemon: Optional[TaskDaemon] = None
     not_before: Optional[datetime] = None
     submit_not_after: Optional[datetime] = None
@@ -91,7 +140,7 @@ class Task:
     def __post_init__(self):
         if NAME_REGEX.fullmatch(self.name) is None:
             raise RuntimeError("Invalid name")
-        if self.generator is None and len(self.flags) == 0:
+        if self.generator is None and self.hmac_flag is None and len(self.flags) == 0:
             raise RuntimeError("Non-dynamic tasks should have flags defined")
 
 
@@ -162,6 +211,10 @@ def do_read_task(path: str, default_attrs: Optional[Dict[str, Any]]=None) -> Opt
         task_data["name"] = name
     if task_data.get("generator") is not None:
         task_data["generator"] = convert_task_generator(base_dir, task_data["generator"])
+    if isinstance(task_data.get("pool"), int):
+        task_data["pool"] = {"target": task_data["pool"]}
+    if isinstance(task_data.get("hmac_flag"), str):
+        task_data["hmac_flag"] = {"prefix": task_data["hmac_flag"]}
     if task_data.get("daemon") is not None:
         task_data["daemon"] = convert_task_daemon(name, base_dir, task_data["daemon"])
     if task_data.get("attachments_path") is not None:
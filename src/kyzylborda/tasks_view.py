@@ -2,12 +2,15 @@ import os.path
 import logging
 import datetime
 from dataclasses import dataclass
-from typing import Tuple, List, Dict, Any
+from typing import Tuple, List, Dict, Any, Optional
 from copy import copy
 from jinja2 import Template
 
 from .utils import utc_now
 from .generate import get_or_generate_task
+from .flags import derive_hmac_flag
+from .generation_queue import BaseGenerationQueue
+from .ready_tasks import ReadyTasks
 from .utils import list_files
 from .cache import TasksCache, TaskCache, task_can_submit
 from .tasks import Hint, Task
@@ -43,19 +46,31 @@ class TaskNotFoundError(Exception):
     pass
 
 
-def get_task_for_user(db, dynamic_attachments_path: str, tasks_cache: TasksCache, user: User, task_cache: TaskCache, substitutions: Dict[str, Any]) -> UserTask:
+def get_task_for_user(db, dynamic_attachments_path: str, tasks_cache: TasksCache, user: User, task_cache: TaskCache, substitutions: Dict[str, Any], generation_queue: Optional[BaseGenerationQueue]=None, ready_tasks: Optional[ReadyTasks]=None) -> UserTask:
     task = task_cache.task
 
     attachments = []
 
+    if task.hmac_flag is not None:
+        # Lets descriptions and URLs embed the flag without running a generator.
+        substitutions = copy(substitutions)
+        substitutions["flag"] = derive_hmac_flag(tasks_cache, task, user.id)
+
     if task.generator is None:
         urls = task.urls
         bullets = task.bullets
     else:
-        generated_task = get_or_generate_task(db, dynamic_attachments_path, tasks_cache, user, task_cache)
-        if generated_task.substitutions is None:
+        version = ready_tasks.get_version() if ready_tasks is not None else 0
+        if generation_queue is not None:
+            generated_task = generation_queue.get_or_enqueue(db, tasks_cache, user, task_cache)
+        else:
+            generated_task = get_or_generate_task(db, dynamic_attachments_path, tasks_cache, user, task_cache)
+        if generated_task is None or generated_task.substitutions is None:
             # Task is still being generated.
             raise TaskNotReadyError()
+        if ready_tasks is not None:
+            # Files of the task are requested right after the page.
+            ready_tasks.add(version, user.id, task.name, generated_task.id)
         substitutions = copy(substitutions)
         substitutions.update(generated_task.substitutions)
 
@@ -1,4 +1,5 @@
 import os
+from typing import Optional, Dict
 from argparse import ArgumentParser
 import sys
 import uuid
@@ -7,7 +8,8 @@ import tempfile
 
 from ..tasks import read_tasks
 from ..cache import build_tasks_cache
-from ..generate import GeneratedTaskOutput, run_task_generator
+from ..generate import GeneratedTaskOutput, run_task_generator, generated_tasks_list
+from ..flags import derive_hmac_flag
 
 
 logger = logging.getLogger(__name__)
@@ -15,6 +17,8 @@ logger = logging.getLogger(__name__)
 
 arg_parser = ArgumentParser(description='Run a task generator.')
 arg_parser.add_argument("-d", "--out-dir", default=tempfile.gettempdir(), help="path to task output directory")
+arg_parser.add_argument("-u", "--user-id", type=int, help="user id to derive HMAC flags for")
+arg_parser.add_argument("-s", "--flag-secret-path", help="path to the flag secret for HMAC flags")
 arg_parser.add_argument("tasks_path", metavar="TASKS_PATH", help="path to task definitions directory")
 arg_parser.add_argument("name", metavar="NAME", help="task name")
 
@@ -24,11 +28,24 @@ def main():
 
     args = arg_parser.parse_args()
 
-    tasks_cache = build_tasks_cache(read_tasks(args.tasks_path))
+    if args.flag_secret_path is not None:
+        with open(args.flag_secret_path, "rb") as f:
+            flag_secret: Optional[bytes] = f.read().strip()
+    else:
+        flag_secret = None
+
+    tasks_cache = build_tasks_cache(read_tasks(args.tasks_path), flag_secret=flag_secret)
 
     if args.name not in tasks_cache.tasks:
         logger.error(f"Task {args.name} doesn't exist")
         sys.exit(1)
+    initial_task_cache = tasks_cache.tasks[args.name]
+
+    flags: Optional[Dict[str, str]] = None
+    if args.user_id is not None:
+        tasks = generated_tasks_list(tasks_cache, initial_task_cache)
+        flags = {name: derive_hmac_flag(tasks_cache, tasks_cache.tasks[name].task, args.user_id) for name in tasks if tasks_cache.tasks[name].task.hmac_flag is not None}
+        logger.info(f"Derived flags: {flags}")
 
     def add_task_result(name: str, output: GeneratedTaskOutput):
         print(f"{name}: {output}")
@@ -40,9 +57,12 @@ def main():
     run_task_generator(
         add_task_result=add_task_result,
         tasks_cache=tasks_cache,
-        initial_task_cache=tasks_cache.tasks[args.name],
+        initial_task_cache=initial_task_cache,
         random_seed=random_seed,
         parent_dir=out_dir,
+        flags=flags,
+        # Next to the output, so that it's moved by rename.
+        scratch_dir=os.path.dirname(out_dir),
     )
 
 
@@ -1,5 +1,6 @@
 import sys
 import os
+import tempfile
 import logging
 import yaml
 import pytz
@@ -8,7 +9,7 @@ from datetime import datetime, timezone
 import dateutil.parser
 from functools import wraps
 from werkzeug.middleware.proxy_fix import ProxyFix
-from flask import Flask, render_template, redirect, url_for, current_app, request, g, abort
+from flask import Flask, render_template, redirect, url_for, current_app, request, g, abort, jsonify
 from flask_login import current_user, login_required, logout_user
 from flask_babel import Babel, format_datetime, lazy_gettext as _
 from flask_accept import accept_fallback
@@ -17,14 +18,25 @@ from sqlalchemy.exc import IntegrityError
 
 from ..mail import SMTPServer
 from ..utils import get_factory
+from ..scoring import Scoreboard, score_users, score_users_sql
+from ..flags import FlagIndex
+from ..notify import NotifyListener
+from ..ready_tasks import ReadyTasks
+from ..attempts import AttemptLog
+from ..generation_queue import BaseGenerationQueue, GenerationQueue
+from ..generation_jobs import DatabaseGenerationQueue
+from ..pool import PoolFiller, PREWARM_MAX
+from ..reconcile import AttachmentsJanitor, ORPHAN_MIN_AGE
+from ..ratelimit import RateLimit, SubmitRateLimiter, DEFAULT_SLOTS
 from ..tasks_view import get_task_summaries_for_user, get_dummy_task_summaries
 from .users import AppUser, KyzylUsers
 from .tasks import KyzylTasks
 from .utils import DateTimeJSONEncoder
 from .db import set_up_database
-from .files import get_attachment_route, get_static_route
+from .files import get_attachment_route, get_attachments_zip_route, get_static_route, make_file_offload
 from .scoring import NamedScoreboard, KyzylScoreboards
 from .ctftime import get_scoreboard_ctftime_api
+from .events import KyzylScoreEvents, can_hold_requests
 
 
 logger = logging.getLogger(__name__)
@@ -43,14 +55,38 @@ def make_app(config_path: str):
         logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
 
     babel = Babel(app)
-    cors = CORS(app, resources={"/scores": {"origins": "*"}})
+    cors = CORS(app, resources={"/scores": {"origins": "*"}, "/scores/events": {"origins": "*"}})
 
     tz = pytz.timezone(app.config["TZ"])
     app.config["BABEL_DEFAULT_TIMEZONE"] = app.config["TZ"]
     app.jinja_env.globals["tz"] = tz
 
     is_anonymous_allowed = app.config.get("ALLOW_ANONYMOUS", False)
-    set_up_database(app, app.config["DATABASE"])
+    generation_queue_mode = app.config.get("GENERATION_QUEUE", True)
+    pool_size = app.config.get("DATABASE_POOL_SIZE", 5)
+    if generation_queue_mode is True or generation_queue_mode == "local":
+        # While generating, a thread holds a session and an advisory lock connection.
+        pool_size += 2 * app.config.get("GENERATION_WORKERS", 4)
+    set_up_database(app, app.config["DATABASE"], pool_size=pool_size)
+    app.scoreboard = Scoreboard(
+        rebuild_interval=app.config.get("SCOREBOARD_REBUILD_INTERVAL", 300),
+        refresh_interval=app.config.get("SCOREBOARD_REFRESH_INTERVAL", 1),
+    )
+
+    notify_listener = NotifyListener(app.db_engine)
+    app.flag_index = FlagIndex() if app.config.get("FLAG_INDEX", True) else None
+    if app.flag_index is not None:
+        app.flag_index.subscribe(notify_listener, app.db)
+
+    if app.config.get("READY_TASKS_CACHE", True):
+        ready_tasks: Optional[ReadyTasks] = ReadyTasks()
+        ready_tasks.subscribe(notify_listener)
+    else:
+        ready_tasks = None
+
+    @app.before_first_request
+    def start_notify_listener():
+        notify_listener.start()
 
     def allow_anonymous(func):
         def wrapped(*args, **kwargs):
@@ -84,6 +120,52 @@ def make_app(config_path: str):
     else:
         external_key = None
 
+    flag_secret_path = app.config.get("FLAG_SECRET_PATH", None)
+    if flag_secret_path:
+        with open(flag_secret_path, "rb") as f:
+            flag_secret: Optional[bytes] = f.read().strip()
+    else:
+        flag_secret = None
+
+    raw_user_rate_limit = app.config.get("SUBMIT_RATE_LIMIT_USER")
+    raw_ip_rate_limit = app.config.get("SUBMIT_RATE_LIMIT_IP")
+    if raw_user_rate_limit is not None or raw_ip_rate_limit is not None:
+        rate_limiter: Optional[SubmitRateLimiter] = SubmitRateLimiter(
+            app.config.get("SUBMIT_RATE_LIMIT_PATH", os.path.join(tempfile.gettempdir(), "kyzylborda_rate_limit")),
+            user_limit=None if raw_user_rate_limit is None else RateLimit.from_dict(raw_user_rate_limit), # type: ignore
+            ip_limit=None if raw_ip_rate_limit is None else RateLimit.from_dict(raw_ip_rate_limit), # type: ignore
+            slots=app.config.get("SUBMIT_RATE_LIMIT_SLOTS", DEFAULT_SLOTS),
+        )
+    else:
+        rate_limiter = None
+
+    if app.config.get("SUBMISSION_LOG", True):
+        attempt_log: Optional[AttemptLog] = AttemptLog(
+            app.db_engine,
+            batch_size=app.config.get("SUBMISSION_LOG_BATCH_SIZE", 500),
+            flush_interval=app.config.get("SUBMISSION_LOG_FLUSH_INTERVAL", 1),
+        )
+    else:
+        attempt_log = None
+
+    # Generators run from different cwd.
+    dynamic_attachments_path = os.path.abspath(app.config["DYNAMIC_ATTACHMENTS_PATH"])
+    if generation_queue_mode is True or generation_queue_mode == "local":
+        generation_queue: Optional[BaseGenerationQueue] = GenerationQueue(
+            app.db,
+            dynamic_attachments_path,
+            workers=app.config.get("GENERATION_WORKERS", 4),
+            generator_concurrency=app.config.get("GENERATOR_CONCURRENCY", 2),
+            failure_backoff=app.config.get("GENERATION_FAILURE_BACKOFF", 5),
+        )
+    elif generation_queue_mode == "database":
+        # Jobs are run by kyzylborda.worker processes.
+        generation_queue = DatabaseGenerationQueue(app.db_engine, dynamic_attachments_path)
+    elif generation_queue_mode is False or generation_queue_mode is None:
+        generation_queue = None
+    else:
+        raise RuntimeError(f"Unknown GENERATION_QUEUE mode: {generation_queue_mode}")
+
     users = KyzylUsers(
         app,
         smtp_server=smtp_server,
@@ -99,8 +181,55 @@ def make_app(config_path: str):
         tasks_path=app.config["TASKS_PATH"],
         dynamic_attachments_path=app.config["DYNAMIC_ATTACHMENTS_PATH"],
         default_attrs=app.config.get("DEFAULT_TASK_ATTRS", {}),
+        flag_secret=flag_secret,
+        rate_limiter=rate_limiter,
+        attempt_log=attempt_log,
+        generation_queue=generation_queue,
+        ready_tasks=ready_tasks,
     )
 
+    if generation_queue is not None:
+        pool_filler: Optional[PoolFiller] = PoolFiller(
+            app.db,
+            app.db_engine,
+            generation_queue,
+            lambda: tasks.tasks_cache,
+            check_interval=app.config.get("POOL_CHECK_INTERVAL", 5),
+            # Pre-warming is off unless enabled, and then capped, since it can queue a generation per user.
+            prewarm_lead=app.config.get("PREWARM_LEAD", 0),
+            active_window=app.config.get("PREWARM_ACTIVE_WINDOW", 3600),
+            prewarm_max=app.config.get("PREWARM_MAX", PREWARM_MAX),
+        )
+        pool_filler.subscribe(notify_listener)
+
+        @app.before_first_request
+        def start_pool_filler():
+            pool_filler.start()
+    else:
+        pool_filler = None
+
+    file_offload = make_file_offload(app.config)
+    # Static files of tasks (styles, images) are cached by browsers; attachments are revalidated with ETags.
+    static_max_age = app.config.get("TASK_STATIC_MAX_AGE", 86400)
+
+    janitor_interval = app.config.get("ATTACHMENTS_JANITOR_INTERVAL", 3600)
+    if janitor_interval:
+        attachments_janitor: Optional[AttachmentsJanitor] = AttachmentsJanitor(
+            app.db,
+            app.db_engine,
+            tasks.dynamic_attachments_path,
+            lambda: tasks.tasks_cache,
+            interval=janitor_interval,
+            min_age=app.config.get("ATTACHMENTS_JANITOR_MIN_AGE", ORPHAN_MIN_AGE),
+            rate=app.config.get("ATTACHMENTS_JANITOR_RATE", 100),
+        )
+
+        @app.before_first_request
+        def start_attachments_janitor():
+            attachments_janitor.start()
+    else:
+        attachments_janitor = None
+
     filter_zero_scores = app.config.get("FILTER_ZERO_SCORES", False)
     raw_named_scoreboards = app.config.get("NAMED_SCOREBOARDS", {})
     if isinstance(raw_named_scoreboards, dict):
@@ -110,10 +239,38 @@ def make_app(config_path: str):
     if "default" not in named_scoreboards:
         named_scoreboards["default"] = NamedScoreboard(_("Default"))
 
-    scoreboards = KyzylScoreboards(
-        app,
-        named_scoreboards=named_scoreboards,
-    )
+    scoring_backend = app.config.get("SCORING_BACKEND", "memory")
+    if scoring_backend == "memory":
+        scoreboards = KyzylScoreboards(app, named_scoreboards=named_scoreboards, scoreboard=app.scoreboard)
+    elif scoring_backend == "sql":
+        scoreboards = KyzylScoreboards(app, named_scoreboards=named_scoreboards, score_users=score_users_sql)
+    elif scoring_backend == "python":
+        scoreboards = KyzylScoreboards(app, named_scoreboards=named_scoreboards, score_users=score_users)
+    else:
+        raise RuntimeError(f"Unknown scoring backend: {scoring_backend}")
+
+    # Every subscriber holds a request open for as long as the scores page is, which would exhaust
+    # sync workers. With "auto", the stream is offered only by servers which can afford that.
+    score_events_mode = app.config.get("SCOREBOARD_EVENTS", "auto")
+    if score_events_mode not in (True, False, "auto"):
+        raise RuntimeError(f"Unknown scoreboard events mode: {score_events_mode}")
+    if score_events_mode:
+        score_events: Optional[KyzylScoreEvents] = KyzylScoreEvents(
+            app,
+            app.scoreboard,
+            poll_interval=app.config.get("SCOREBOARD_REFRESH_INTERVAL", 1),
+        )
+    else:
+        score_events = None
+
+    def score_events_enabled() -> bool:
+        if score_events is None:
+            return False
+        return score_events_mode is True or can_hold_requests(request.environ)
+
+    @app.context_processor
+    def inject_score_events():
+        return {"scoreboard_events": score_events_enabled()}
 
     @app.template_filter()
     def format_locale_datetime(value):
@@ -204,6 +361,13 @@ def make_app(config_path: str):
         else:
             return scoreboards.get_scoreboard_api(filter_zero=filter_zero_scores, tags=tags)
 
+    @app.route("/scores/events")
+    @allow_anonymous
+    def scoreboard_events():
+        if not score_events_enabled():
+            abort(404)
+        return score_events.events_route()
+
     @app.route("/tasks/")
     @allow_anonymous
     def tasks_list():
@@ -226,7 +390,7 @@ def make_app(config_path: str):
         def error_view(**kwargs):
             return render_template("ask_hint_error.html", **kwargs)
 
-        return tasks.flush_task_route(url_for("root"), error_view, task_name)
+        return tasks.flush_task_route(url_for("get_task", task_name=task_name), error_view, task_name)
 
     @app.route("/tasks/<task_name>/pregenerate", methods=["POST"])
     @login_required
@@ -245,15 +409,33 @@ def make_app(config_path: str):
 
         return tasks.ask_hint_route(referrer, error_view, task_name, hint_name)
 
+    @app.route("/tasks/<task_name>/attachments.zip")
+    @login_required
+    def get_attachments_zip(task_name):
+        return get_attachments_zip_route(tasks.dynamic_attachments_path, task_name, generation_queue=tasks.generation_queue, ready_tasks=tasks.ready_tasks)
+
     @app.route("/tasks/<task_name>/attachments/<file_name>")
     @login_required
     def get_attachment(task_name, file_name):
-        return get_attachment_route(tasks.dynamic_attachments_path, task_name, file_name)
+        return get_attachment_route(tasks.dynamic_attachments_path, task_name, file_name, generation_queue=tasks.generation_queue, offload=file_offload, ready_tasks=tasks.ready_tasks)
 
     @app.route("/tasks/<task_name>/static/<path:file_path>")
     @login_required
     def get_static(task_name, file_path):
-        return get_static_route(tasks.dynamic_attachments_path, task_name, file_path)
+        return get_static_route(tasks.dynamic_attachments_path, task_name, file_path, generation_queue=tasks.generation_queue, offload=file_offload, max_age=static_max_age, ready_tasks=tasks.ready_tasks)
+
+    @app.route("/stats")
+    @login_required
+    def stats():
+        if not current_user.user.is_organizer:
+            abort(403)
+        stats = tasks.get_stats()
+        if pool_filler is not None:
+            stats["pool"] = pool_filler.get_stats(current_app.db, g.tasks_cache)
+        if attachments_janitor is not None:
+            # Only in the process which has run the last reconciliation.
+            stats["attachments"] = attachments_janitor.get_stats()
+        return jsonify(stats)
 
     @app.route("/flags/send", methods=["POST"])
     @login_required
@@ -30,13 +30,16 @@ def convert_standing(user_score):
     )
 
 
-def convert_scoreboard_ctftime_api(scores, tasks):
+def make_standings_response(scores, tasks):
     standings = [convert_standing(user_score) for user_score in scores if user_score.total_rank is not None]
-    response = StandingsResponse(
+    return StandingsResponse(
         standings=standings,
     )
-    return jsonify(response)
+
+
+def convert_scoreboard_ctftime_api(scores, tasks):
+    return jsonify(make_standings_response(scores, tasks))
 
 
 def get_scoreboard_ctftime_api(scoreboards: KyzylScoreboards, **kwargs):
-    return scoreboards.scoreboard_route(lambda scores, tasks, **kwargs: convert_scoreboard_ctftime_api(scores, tasks), **kwargs)
+    return scoreboards.serialized_scoreboard_route("ctftime", make_standings_response, **kwargs)
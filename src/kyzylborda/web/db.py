@@ -4,10 +4,11 @@ from flask import g
 from ..db import Base
 
 
-def set_up_database(app, url):
-    db_engine = sqlalchemy.create_engine(url)
+def set_up_database(app, url, pool_size: int=5):
+    db_engine = sqlalchemy.create_engine(url, pool_size=pool_size)
     db_factory = sqlalchemy.orm.sessionmaker(bind=db_engine)
     db = sqlalchemy.orm.scoped_session(db_factory)
+    app.db_engine = db_engine
     app.db = db
 
     @app.before_first_request
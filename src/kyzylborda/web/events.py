@@ -0,0 +1,119 @@
+import sys
+import logging
+from queue import Queue, Empty, Full
+from threading import Thread, Lock, Event
+from time import sleep
+from typing import Set, Dict, Optional, Any
+from flask import Response, json, g
+
+from ..scoring import Scoreboard, ScoreboardEvent
+
+
+logger = logging.getLogger(__name__)
+
+
+# Slow subscribers are disconnected instead of buffering events forever.
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+
+def can_hold_requests(environ: Dict[str, Any]) -> bool:
+    """ Whether a request which stays open doesn't take a whole worker process: threaded or gevent workers. """
+    if environ.get("wsgi.multithread"):
+        return True
+    gevent_monkey = sys.modules.get("gevent.monkey")
+    return gevent_monkey is not None and gevent_monkey.is_module_patched("socket")
+
+
+class KyzylScoreEvents:
+    """ Server-Sent Events stream of scoreboard changes.
+
+        All subscribers of the process are fed from one scoreboard listener.
+        While anyone is subscribed, a background thread looks up changes made
+        by other processes. """
+
+    scoreboard: Scoreboard
+    keepalive_interval: float
+    poll_interval: float
+    _lock: Lock
+    _subscribers: Set[Queue]
+    _poller: Optional[Thread]
+    _has_subscribers: Event
+    _db: Any
+
+    def __init__(self, app, scoreboard: Scoreboard, poll_interval: float=1, keepalive_interval: float=15):
+        self.scoreboard = scoreboard
+        self.poll_interval = poll_interval
+        self.keepalive_interval = keepalive_interval
+        self._lock = Lock()
+        self._subscribers = set()
+        self._poller = None
+        self._has_subscribers = Event()
+        self._db = app.db
+        scoreboard.add_listener(self._publish)
+
+    def _publish(self, event: ScoreboardEvent):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for queue in subscribers:
+            try:
+                queue.put_nowait(event)
+            except Full:
+                logger.warn("Scoreboard events subscriber is too slow; disconnecting")
+                self._unsubscribe(queue)
+                # Make room for the end of stream marker.
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    pass
+                queue.put_nowait(None)
+
+    def _poll(self):
+        while True:
+            self._has_subscribers.wait()
+            try:
+                self.scoreboard.catch_up(self._db)
+            except Exception as e:
+                logger.error("Error while looking up scoreboard changes", exc_info=e)
+            finally:
+                self._db.remove()
+            sleep(self.poll_interval)
+
+    def _subscribe(self) -> Queue:
+        queue: Queue = Queue(SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add(queue)
+            self._has_subscribers.set()
+            if self._poller is None:
+                self._poller = Thread(target=self._poll, name="scoreboard-events", daemon=True)
+                self._poller.start()
+        return queue
+
+    def _unsubscribe(self, queue: Queue):
+        with self._lock:
+            self._subscribers.discard(queue)
+            if len(self._subscribers) == 0:
+                self._has_subscribers.clear()
+
+    def _stream(self, queue: Queue):
+        try:
+            yield f"retry: {int(self.poll_interval * 1000)}\n\n"
+            while True:
+                try:
+                    event = queue.get(timeout=self.keepalive_interval)
+                except Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    break
+                yield f"event: {event.type}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            self._unsubscribe(queue)
+
+    def events_route(self):
+        # Make sure the scoreboard is loaded even if it's not used for scoring.
+        self.scoreboard.refresh(g.tasks_cache, self._db)
+        response = Response(self._stream(self._subscribe()), mimetype="text/event-stream")
+        response.cache_control.no_cache = True
+        # Don't let nginx buffer the stream.
+        response.headers["X-Accel-Buffering"] = "no"
+        return response
@@ -1,13 +1,157 @@
+from typing import Optional, Dict, List, Iterator, Any
+import io
 import os
 import os.path
-from flask import abort, send_file, current_app, g
+import zipfile
+import unicodedata
+from urllib.parse import quote
+from werkzeug.utils import send_file as werkzeug_send_file
+from flask import abort, send_file, current_app, request, redirect, url_for, g, Response
 from flask_login import current_user, login_required
 
 from ..generate import get_or_generate_task
+from ..utils import list_files
+from ..ready_tasks import ReadyTasks
+from ..attachments import DEDUPE_MIN_SIZE, hash_file, get_stored_hash
+
+
+# Files which don't get smaller when compressed again; they are stored in archives as is.
+COMPRESSED_EXTENSIONS = {
+    ".zip", ".gz", ".tgz", ".bz2", ".tbz2", ".xz", ".txz", ".zst", ".7z", ".rar", ".lz4",
+    ".jar", ".apk", ".docx", ".xlsx", ".pptx", ".odt", ".ods",
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".avif",
+    ".mp3", ".ogg", ".opus", ".flac", ".mp4", ".mkv", ".webm", ".mov",
+}
+ZIP_CHUNK_SIZE = 256 * 1024
+
+OFFLOAD_MODES = ["x-accel-redirect", "x-sendfile"]
+DEFAULT_OFFLOAD_PREFIX = "/_kyzylborda/files"
+
+
+class FileOffload:
+    """ Leaves sending files to the web server; we only check access and find the file.
+
+        With X-Sendfile the header contains the full path. With X-Accel-Redirect (nginx) it contains
+        an URI under `prefix`, which should be mapped back to the directories by internal locations. """
+
+    mode: str
+    prefix: str
+    # Location name -> directory.
+    roots: Dict[str, str]
+
+    def __init__(self, mode: str, roots: Dict[str, str], prefix: str=DEFAULT_OFFLOAD_PREFIX):
+        if mode not in OFFLOAD_MODES:
+            raise RuntimeError(f"Unknown file offload mode: {mode}")
+        self.mode = mode
+        self.prefix = prefix.rstrip("/")
+        self.roots = {name: os.path.abspath(path) for name, path in roots.items()}
+
+    def get_header(self, full_path: str) -> Optional[str]:
+        """ Value of the header for a file, or None if the web server can't access it. """
+        if self.mode == "x-sendfile":
+            return full_path
+        for name, root in self.roots.items():
+            if full_path.startswith(root + os.sep):
+                return f"{self.prefix}/{name}/{quote(os.path.relpath(full_path, root))}"
+        return None
+
+    def get_nginx_config(self) -> str:
+        lines = ["# Internal locations for X-Accel-Redirect; include into the server block which proxies to kyzylborda."]
+        for name, root in self.roots.items():
+            lines += [
+                f"location {self.prefix}/{name}/ {{",
+                "    internal;",
+                f"    alias {root}/;",
+                "}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+def make_file_offload(config: Dict[str, Any]) -> Optional[FileOffload]:
+    mode = config.get("FILE_OFFLOAD")
+    if mode is None:
+        return None
+    return FileOffload(
+        mode,
+        {
+            "dynamic": config["DYNAMIC_ATTACHMENTS_PATH"],
+            # Attachments and static files of tasks are inside task directories.
+            "tasks": config["TASKS_PATH"],
+        },
+        prefix=config.get("FILE_OFFLOAD_PREFIX", DEFAULT_OFFLOAD_PREFIX),
+    )
+
+
+def get_file_etag(path: str) -> str:
+    """ Strong ETag, from the contents where it's cheap: large generated files have their hash stored when they are
+        deduplicated, and small files are hashed right away. Other files are identified by inode, mtime and size,
+        since task files are published by rename and never changed in place; such ETags differ between hosts
+        which don't share the filesystem, e.g. with a checkout of the tasks on every host. """
+    file_hash = get_stored_hash(path)
+    if file_hash is not None:
+        return file_hash
+    info = os.stat(path)
+    if info.st_size < DEDUPE_MIN_SIZE:
+        return hash_file(path)
+    return f"{info.st_ino:x}-{info.st_mtime_ns:x}-{info.st_size:x}"
+
+
+def send_task_file(full_path: str, as_attachment: bool, offload: Optional[FileOffload]=None, max_age: Optional[int]=None):
+    """ Send a file with a strong ETag. Files may be cached for `max_age` seconds; otherwise they are revalidated every time.
+        Conditional and range requests are handled by send_file, or by the web server when offloading. """
+    etag = get_file_etag(full_path)
+    header = offload.get_header(full_path) if offload is not None else None
+    if header is None:
+        response = send_file(full_path, as_attachment=as_attachment, etag=etag, max_age=max_age)
+        # Let clients know that interrupted downloads can be resumed.
+        response.accept_ranges = "bytes"
+    else:
+        assert offload is not None
+        environ = dict(request.environ)
+        # There is no body to take a range of; the web server does it.
+        environ.pop("HTTP_RANGE", None)
+        environ.pop("HTTP_IF_RANGE", None)
+        # Same headers as send_file, but without the body.
+        response = werkzeug_send_file(
+            full_path,
+            environ,
+            as_attachment=as_attachment,
+            etag=etag,
+            max_age=max_age,
+            use_x_sendfile=True,
+            response_class=current_app.response_class,
+        )
+        if offload.mode == "x-accel-redirect" and "X-Sendfile" in response.headers:
+            del response.headers["X-Sendfile"]
+            response.headers["X-Accel-Redirect"] = header
+
+    # Files are only accessible to logged in users, and generated ones are different for everyone.
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+
+def ensure_generated(dynamic_attachments_path: str, task_cache, generation_queue=None, ready_tasks: Optional[ReadyTasks]=None) -> bool:
+    """ Generate the user's task (or queue generation) unless it's known to be ready. Returns whether it's ready. """
+    user = current_user.user
+    task = task_cache.task
+    if ready_tasks is not None and ready_tasks.is_ready(user.id, task.name):
+        return True
+
+    version = ready_tasks.get_version() if ready_tasks is not None else 0
+    if generation_queue is not None:
+        generated_task = generation_queue.get_or_enqueue(current_app.db, g.tasks_cache, user, task_cache)
+    else:
+        generated_task = get_or_generate_task(current_app.db, dynamic_attachments_path, g.tasks_cache, user, task_cache)
+    if generated_task is None or generated_task.substitutions is None:
+        return False
+    if ready_tasks is not None:
+        ready_tasks.add(version, user.id, task.name, generated_task.id)
+    return True
 
 
 @login_required
-def generic_get_file_route(get_files_path, dynamic_subdir, dynamic_attachments_path, task_name, file_path, as_attachment=True):
+def generic_get_file_route(get_files_path, dynamic_subdir, dynamic_attachments_path, task_name, file_path, as_attachment=True, generation_queue=None, offload=None, max_age=None, ready_tasks=None):
     norm_path = os.path.normpath(file_path)
     if norm_path != file_path or norm_path.split(os.sep)[0] == os.pardir:
         abort(404)
@@ -20,21 +164,124 @@ def generic_get_file_route(get_files_path, dynamic_subdir, dynamic_attachments_p
 
     if task.generator is not None:
         # Generate task if it's not there yet. Ignore the result.
-        get_or_generate_task(current_app.db, dynamic_attachments_path, g.tasks_cache, current_user.user, task_cache)
+        ensure_generated(dynamic_attachments_path, task_cache, generation_queue=generation_queue, ready_tasks=ready_tasks)
         full_path = os.path.abspath(os.path.join(dynamic_attachments_path, str(current_user.user.id), task.name, dynamic_subdir, file_path))
         if os.path.isfile(full_path):
-            return send_file(full_path, as_attachment=True)
+            # Generated files change when the task is flushed, so they are always revalidated.
+            return send_task_file(full_path, True, offload)
 
     attachments_path = get_files_path(task)
     if attachments_path is not None:
         full_path = os.path.abspath(os.path.join(attachments_path, file_path))
         if os.path.isfile(full_path):
-            return send_file(full_path, as_attachment=as_attachment)
+            return send_task_file(full_path, as_attachment, offload, max_age)
 
     abort(404)
 
-def get_static_route(dynamic_attachments_path, task_name, file_path):
-    return generic_get_file_route(lambda task: task.static_path, "static", dynamic_attachments_path, task_name, file_path, as_attachment=False)
+def get_static_route(dynamic_attachments_path, task_name, file_path, generation_queue=None, offload=None, max_age=None, ready_tasks=None):
+    return generic_get_file_route(lambda task: task.static_path, "static", dynamic_attachments_path, task_name, file_path, as_attachment=False, generation_queue=generation_queue, offload=offload, max_age=max_age, ready_tasks=ready_tasks)
+
+def get_attachment_route(dynamic_attachments_path, task_name, file_name, generation_queue=None, offload=None, ready_tasks=None):
+    return generic_get_file_route(lambda task: task.attachments_path, "attachments", dynamic_attachments_path, task_name, file_name, generation_queue=generation_queue, offload=offload, ready_tasks=ready_tasks)
+
+
+class ZipStream(io.RawIOBase):
+    """ Unseekable file which collects what ZipFile writes, to be sent in chunks. """
+
+    _chunks: List[bytes]
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def set_download_name(response: Response, name: str):
+    """ Content-Disposition the way send_file does it: the name is quoted if needed, and non-ASCII names are
+        also given in RFC 5987 form, with an ASCII approximation for older clients. """
+    try:
+        name.encode("ascii")
+    except UnicodeEncodeError:
+        names = {
+            "filename": unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii"),
+            "filename*": f"UTF-8''{quote(name, safe='!#$&+^`|~')}",
+        }
+    else:
+        names = {"filename": name}
+    response.headers.set("Content-Disposition", "attachment", **names)
+
+
+def stream_zip(files: Dict[str, str]) -> Iterator[bytes]:
+    """ Stream a ZIP archive of files by archive names, never holding more than a chunk in memory. """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, "w") as archive:
+        for name, path in files.items():
+            info = zipfile.ZipInfo.from_file(path, arcname=name)
+            if os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, "rb") as source, archive.open(info, "w") as target:
+                while True:
+                    chunk = source.read(ZIP_CHUNK_SIZE)
+                    if len(chunk) == 0:
+                        break
+                    target.write(chunk)
+                    data = stream.take()
+                    if len(data) > 0:
+                        yield data
+    # Rest of the last entry and the central directory.
+    yield stream.take()
+
+
+@login_required
+def get_attachments_zip_route(dynamic_attachments_path, task_name, generation_queue=None, ready_tasks=None):
+    try:
+        task_cache = g.tasks_cache.get_task(task_name, user=current_user.user)
+        task = task_cache.task
+    except KeyError:
+        abort(404)
+
+    # Generated files take precedence, like in generic_get_file_route.
+    files: Dict[str, str] = {}
+    if task.attachments_path is not None:
+        try:
+            dirnames, filenames = list_files(task.attachments_path)
+        except FileNotFoundError:
+            filenames = []
+        for filename in filenames:
+            files[filename] = os.path.join(task.attachments_path, filename)
+
+    if task.generator is not None:
+        if not ensure_generated(dynamic_attachments_path, task_cache, generation_queue=generation_queue, ready_tasks=ready_tasks):
+            # The task page waits for generation.
+            return redirect(url_for("get_task", task_name=task_name), code=303)
+        generated_path = os.path.join(dynamic_attachments_path, str(current_user.user.id), task.name, "attachments")
+        try:
+            dirnames, filenames = list_files(generated_path)
+        except FileNotFoundError:
+            filenames = []
+        for filename in filenames:
+            files[filename] = os.path.join(generated_path, filename)
+
+    if len(files) == 0:
+        abort(404)
 
-def get_attachment_route(dynamic_attachments_path, task_name, file_name):
-    return generic_get_file_route(lambda task: task.attachments_path, "attachments", dynamic_attachments_path, task_name, file_name)
+    response = Response(
+        stream_zip(dict(sorted(files.items()))),
+        mimetype="application/zip",
+        headers={"Cache-Control": "no-cache, private"},
+    )
+    set_download_name(response, f"{task_name}.zip")
+    return response
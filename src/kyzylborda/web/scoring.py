@@ -1,13 +1,16 @@
 from datetime import datetime
 import logging
-from typing import Dict, Optional, List
-from flask import current_app, g, jsonify, abort
+import gzip
+import hashlib
+from threading import Lock
+from typing import Dict, Optional, List, Callable, Tuple, Any
+from flask import current_app, g, jsonify, abort, json, request, Response
 from flask_login import current_user
 from dataclasses import dataclass, field
 from dataclasses_json import dataclass_json
 
-from ..scoring import UserScore, score_users
-from ..tasks import TaskName
+from ..scoring import UserScore, Scoreboard, score_users
+from ..tasks import TaskName, Task
 
 
 logger = logging.getLogger(__name__)
@@ -55,6 +58,18 @@ class NamedScoreboard:
     filter_zero: bool = False
 
 
+@dataclass(frozen=True)
+class SerializedScoreboard:
+    version: int
+    data: bytes
+    gzip_data: bytes
+    etag: str
+
+
+# Keys include user-provided tags, so the cache is bounded.
+MAX_SERIALIZED_SCOREBOARDS = 256
+
+
 def convert_task(task):
     return TaskResponse(
         name=task.name,
@@ -82,21 +97,46 @@ def convert_user_score(user_score: UserScore):
     )
 
 
+def make_scoreboard_response(scores, tasks):
+    return ScoreboardResponse(
+        tasks=[convert_task(task) for task in tasks],
+        users=[convert_user_score(user) for user in scores],
+    )
+
+
 class KyzylScoreboards:
     named_scoreboards: Dict[str, NamedScoreboard]
+    score_users: Callable[..., List[UserScore]]
+    scoreboard: Optional[Scoreboard]
+    _serialized_lock: Lock
+    _serialized: Dict[Tuple, SerializedScoreboard]
 
-    def __init__(self, app, named_scoreboards: Optional[Dict[str, NamedScoreboard]]=None):
+    def __init__(self, app, named_scoreboards: Optional[Dict[str, NamedScoreboard]]=None, score_users: Callable[..., List[UserScore]]=score_users, scoreboard: Optional[Scoreboard]=None):
         if named_scoreboards is None:
             self.named_scoreboards = {}
         else:
             self.named_scoreboards = named_scoreboards
+        # API responses are cached only if the scores are versioned.
+        self.scoreboard = scoreboard
+        if scoreboard is not None:
+            self.score_users = scoreboard.score_users
+        else:
+            self.score_users = score_users
+        self._serialized_lock = Lock()
+        self._serialized = {}
+
+    def _scoreboard_args(self):
+        user = current_user.user if current_user.is_authenticated else None
+        tasks = [x.task for name, x in g.tasks_cache.get_tasks(user=user)]
+        is_organizer = False if not (user is not None and user.is_organizer) else None
+        return tasks, is_organizer
 
     def scoreboard_route(self, success_view, filter_zero: bool=False, tags: Optional[List[str]]=None):
-        tasks = [x.task for name, x in g.tasks_cache.get_tasks(user=current_user.user if current_user.is_authenticated else None)]
-        is_organizer = False if not (current_user.is_authenticated and current_user.user.is_organizer) else None
-        scores = score_users(g.tasks_cache, current_app.db, is_organizer=is_organizer, filter_zero=filter_zero, tags=tags)
+        tasks, is_organizer = self._scoreboard_args()
+        scores = self.score_users(g.tasks_cache, current_app.db, is_organizer=is_organizer, filter_zero=filter_zero, tags=tags)
         named_scoreboards = [(name, board.caption) for name, board in self.named_scoreboards.items()]
-        return success_view(scores=scores, tasks=tasks, named_scoreboards=named_scoreboards)
+        # Live updates of the page need to know which users it shows.
+        return success_view(scores=scores, tasks=tasks, named_scoreboards=named_scoreboards, scoreboard_tags=tags, scoreboard_filter_zero=filter_zero)
 
     def named_scoreboard_route(self, success_view, name: str):
         if name not in self.named_scoreboards:
@@ -106,14 +146,51 @@ class KyzylScoreboards:
         wrapped_success_view = lambda **kwargs: success_view(current_named_scoreboard=name, **kwargs)
         return self.scoreboard_route(wrapped_success_view, filter_zero=scoreboard.filter_zero, tags=scoreboard.tags)
 
-    def convert_scoreboard_api(self, scores, tasks, **kwargs):
-        tasks = [convert_task(task) for task in tasks]
-        users = [convert_user_score(user) for user in scores]
-        response = ScoreboardResponse(
-            tasks=tasks,
-            users=users,
+    def _get_serialized(self, format: str, make_response: Callable[[List[UserScore], List[Task]], Any], filter_zero: bool, tags: Optional[List[str]]) -> SerializedScoreboard:
+        assert self.scoreboard is not None
+        tasks, is_organizer = self._scoreboard_args()
+        version = self.scoreboard.refresh(g.tasks_cache, current_app.db)
+        key = (format, None if tags is None else tuple(sorted(tags)), filter_zero, is_organizer, tuple(task.name for task in tasks))
+        with self._serialized_lock:
+            serialized = self._serialized.get(key)
+        if serialized is not None and serialized.version == version:
+            return serialized
+
+        scores = self.score_users(g.tasks_cache, current_app.db, is_organizer=is_organizer, filter_zero=filter_zero, tags=tags)
+        data = json.dumps(make_response(scores, tasks)).encode("utf-8")
+        serialized = SerializedScoreboard(
+            version=version,
+            data=data,
+            gzip_data=gzip.compress(data),
+            etag=hashlib.sha1(data).hexdigest(),
         )
-        return jsonify(response)
+        with self._serialized_lock:
+            if len(self._serialized) >= MAX_SERIALIZED_SCOREBOARDS:
+                self._serialized = {key: value for key, value in self._serialized.items() if value.version == version}
+                if len(self._serialized) >= MAX_SERIALIZED_SCOREBOARDS:
+                    self._serialized = {}
+            self._serialized[key] = serialized
+        return serialized
+
+    def serialized_scoreboard_route(self, format: str, make_response: Callable[[List[UserScore], List[Task]], Any], filter_zero: bool=False, tags: Optional[List[str]]=None):
+        if self.scoreboard is None:
+            return self.scoreboard_route(lambda scores, tasks, **kwargs: jsonify(make_response(scores, tasks)), filter_zero=filter_zero, tags=tags)
+
+        serialized = self._get_serialized(format, make_response, filter_zero, tags)
+        response = Response(mimetype="application/json")
+        response.vary.add("Accept-Encoding")
+        response.cache_control.no_cache = True
+        if "gzip" in request.accept_encodings:
+            response.set_data(serialized.gzip_data)
+            response.headers["Content-Encoding"] = "gzip"
+            response.set_etag(serialized.etag + "-gzip")
+        else:
+            response.set_data(serialized.data)
+            response.set_etag(serialized.etag)
+        return response.make_conditional(request)
+
+    def convert_scoreboard_api(self, scores, tasks, **kwargs):
+        return jsonify(make_scoreboard_response(scores, tasks))
 
     def get_scoreboard_api(self, **kwargs):
-            return self.scoreboard_route(self.convert_scoreboard_api, **kwargs)
+        return self.serialized_scoreboard_route("json", make_scoreboard_response, **kwargs)
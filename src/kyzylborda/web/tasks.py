@@ -1,7 +1,10 @@
 from typing import Optional, Any, Dict
 import os
+import math
 import logging
 import os.path
+from threading import Thread, Lock
+from dataclasses import dataclass
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from flask import current_app, g, request, abort, redirect
@@ -14,16 +17,26 @@ from wtforms.validators import InputRequired
 from ..db import GeneratedTask, User
 from ..utils import debounce
 from ..tasks import read_tasks
-from ..cache import build_tasks_cache, db_sanity_check
+from ..cache import TasksCache, build_tasks_cache, db_sanity_check
 from ..tasks_view import TaskNotReadyError, UserTask, get_task_for_user
 from ..flags import FlagStolenError, FlagExistsError, FlagNotFoundError, FlagForWrongTaskError, FlagTooLateError, submit_flag
 from ..hints import HintNotFoundError, HintTakenError, HintNotNeededError, grant_hint
-from ..generate import generate_task, flush_task
+from ..generate import generate_task, flush_task, claim_stats
+from ..ratelimit import SubmitRateLimiter
+from ..attempts import AttemptLog
+from ..attachments import TrashJanitor, publish_stats, dedupe_stats
+from ..generation_queue import BaseGenerationQueue
+from ..generator_workers import retire_generator_workers
+from ..ready_tasks import ReadyTasks
 
 
 logger = logging.getLogger(__name__)
 
 
+# Seconds between reloads of a task page while the task is being generated.
+TASK_NOT_READY_REFRESH = 3
+
+
 class AskHintForm(FlaskForm):
     pass
 
@@ -40,21 +53,47 @@ class SendFlagForm(FlaskForm):
     flag = StringField(_("Flag"), validators=[InputRequired()])
 
 
+@dataclass
+class FlushProgress:
+    deleted: int = 0
+    total: int = 0
+    finished: bool = False
+    failed: bool = False
+
+
 class KyzylTasks:
     dynamic_attachments_path: str
-
-    def __init__(self, app, tasks_path: str, dynamic_attachments_path: str, default_attrs: Optional[Dict[str, Any]]=None):
+    tasks_cache: Optional[TasksCache]
+    rate_limiter: Optional[SubmitRateLimiter]
+    attempt_log: Optional[AttemptLog]
+    generation_queue: Optional[BaseGenerationQueue]
+    ready_tasks: Optional[ReadyTasks]
+    trash_janitor: TrashJanitor
+    _flushes_lock: Lock
+    # Flushes started by this process.
+    _flushes: Dict[str, FlushProgress]
+
+    def __init__(self, app, tasks_path: str, dynamic_attachments_path: str, default_attrs: Optional[Dict[str, Any]]=None, flag_secret: Optional[bytes]=None, rate_limiter: Optional[SubmitRateLimiter]=None, attempt_log: Optional[AttemptLog]=None, generation_queue: Optional[BaseGenerationQueue]=None, ready_tasks: Optional[ReadyTasks]=None):
         # We need abspath here; this path is passed to generators which run from different cwd.
         self.dynamic_attachments_path = os.path.abspath(dynamic_attachments_path)
+        self.rate_limiter = rate_limiter
+        self.attempt_log = attempt_log
+        self.generation_queue = generation_queue
+        self.ready_tasks = ready_tasks
+        self.trash_janitor = TrashJanitor(self.dynamic_attachments_path)
+        self._flushes_lock = Lock()
+        self._flushes = {}
 
         # Be careful - this variable is updated from another thread.
-        tasks_cache = None
+        self.tasks_cache = None
         def reload_tasks():
-            nonlocal tasks_cache
-            new_tasks = build_tasks_cache(read_tasks(tasks_path, default_attrs=default_attrs))
+            new_tasks = build_tasks_cache(read_tasks(tasks_path, default_attrs=default_attrs), flag_secret=flag_secret)
             logger.info(f"Tasks reloaded, {len(new_tasks.tasks)} tasks total")
+            if flag_secret is None and len(new_tasks.hmac_flag_prefixes) > 0:
+                logger.error("Some tasks use HMAC flags, but FLAG_SECRET_PATH is not set; their flags won't be accepted")
             db_sanity_check(new_tasks, app.db)
-            tasks_cache = new_tasks
+            self.tasks_cache = new_tasks
+            retire_generator_workers()
 
         class ReloadTasksEventHandler(FileSystemEventHandler):
             @debounce(2)
@@ -64,6 +103,7 @@ class KyzylTasks:
         @app.before_first_request
         def init_stuff():
             os.makedirs(self.dynamic_attachments_path, exist_ok=True)
+            self.trash_janitor.start()
 
             reload_tasks()
             tasks_observer = Observer()
@@ -72,7 +112,7 @@ class KyzylTasks:
 
         @app.before_request
         def set_tasks():
-            g.tasks_cache = tasks_cache
+            g.tasks_cache = self.tasks_cache
             if current_user.is_authenticated:
                 # Add it to session context because it's used in different views.
                 g.flag_form = SendFlagForm()
@@ -86,25 +126,39 @@ class KyzylTasks:
             abort(404)
 
         redirect = None
+        generation_failure = None
         try:
             substitutions = {
                 "hostname": request.host,
             }
-            user_task: Optional[UserTask] = get_task_for_user(current_app.db, self.dynamic_attachments_path, g.tasks_cache, current_user.user, task_cache, substitutions)
+            user_task: Optional[UserTask] = get_task_for_user(current_app.db, self.dynamic_attachments_path, g.tasks_cache, current_user.user, task_cache, substitutions, generation_queue=self.generation_queue, ready_tasks=self.ready_tasks)
         except TaskNotReadyError:
             user_task = None
             redirect = ""
+            if self.generation_queue is not None:
+                generation_failure = self.generation_queue.get_failure(g.tasks_cache, task_cache, current_user.user.id)
 
         params = {
             "task": task_cache.task,
             "redirect": redirect,
+            # Poll until the task is generated.
+            "refresh": TASK_NOT_READY_REFRESH if user_task is None else None,
             "summary": user_task,
+            "generation_failure": generation_failure,
             "hint_form": AskHintForm(),
         }
         if current_user.user.is_organizer:
             params["flush_task_form"] = FlushTaskForm()
             params["pregenerate_task_form"] = PregenerateTaskForm()
             params["pregenerated_count"] = current_app.db.query(GeneratedTask).filter_by(user_id=None, task_name=task_name).count()
+            with self._flushes_lock:
+                flush_progress = self._flushes.get(task_name)
+                params["flush_progress"] = None if flush_progress is None else FlushProgress(**flush_progress.__dict__)
+            if params["flush_progress"] is not None and not params["flush_progress"].finished:
+                params["refresh"] = TASK_NOT_READY_REFRESH
+        if generation_failure is not None and params["refresh"] is not None:
+            # Nothing changes until the next attempt.
+            params["refresh"] = max(params["refresh"], math.ceil(generation_failure.retry_in))
 
         return success_view(**params)
 
@@ -115,23 +169,41 @@ class KyzylTasks:
             logger.warn(f"Flag posted by user '{current_user.user.login}' didn't pass validation")
             return error_view(form=form)
 
+        flag = form.flag.data.strip().lower()
+        def record_attempt(result: str, **kwargs):
+            if self.attempt_log is not None:
+                self.attempt_log.record(current_user.user.id, flag, result, remote_addr=request.remote_addr, **kwargs)
+
+        if self.rate_limiter is not None:
+            exceeded = self.rate_limiter.check(current_user.user.id, request.remote_addr)
+            if exceeded is not None:
+                logger.warn(f"Flag '{form.flag.data}' posted by user '{current_user.user.login}' from {request.remote_addr} is throttled by {exceeded} rate limit")
+                record_attempt("throttled")
+                return error_view(errors=[_("Too many attempts, try again later.")], form=form), 429
+
         try:
-            task_name = submit_flag(current_app.db, g.tasks_cache, current_user.user, form.flag.data.strip().lower(), accept_only_task=accept_only_task)
+            task_name = submit_flag(current_app.db, g.tasks_cache, current_user.user, flag, accept_only_task=accept_only_task, scoreboard=current_app.scoreboard, flag_index=current_app.flag_index)
         except FlagStolenError as e:
+            record_attempt("stolen", task_name=e.task_name, owner_id=e.user_id)
             victim_user = current_app.db.query(User).get(e.user_id)
             logger.warn(f"Flag '{form.flag.data}' posted by user '{current_user.user.login}' is stolen from user '{victim_user.login}'")
             return error_view(errors=[_("Invalid flag.")], form=form)
         except FlagNotFoundError:
+            record_attempt("not_found")
             logger.warn(f"Unknown flag '{form.flag.data}' posted by user '{current_user.user.login}'")
             return error_view(errors=[_("Invalid flag.")], form=form)
-        except FlagExistsError:
+        except FlagExistsError as e:
+            record_attempt("exists", task_name=e.task_name)
             return error_view(errors=[_("Task has already been solved.")], form=form)
         except FlagForWrongTaskError as e:
+            record_attempt("wrong_task", task_name=e.task_name)
             logger.warn(f"Flag '{form.flag.data}' posted by user '{current_user.user.login}' is from task '{e.task_name}', not '{accept_only_task}'")
             return error_view(errors=[_("Your task is in another castle, go submit there.")], form=form)
-        except FlagTooLateError:
+        except FlagTooLateError as e:
+            record_attempt("too_late", task_name=e.task_name)
             return error_view(errors=[_("The flag is correct, but the contest has ended.")], form=form)
 
+        record_attempt("accepted", task_name=task_name)
         logger.info(f"Flag '{form.flag.data}' for task '{task_name}' has been submitted by user '{current_user.user.login}'")
         return redirect(success_url, code=303)
 
@@ -143,7 +215,7 @@ class KyzylTasks:
             return error_view(form=form)
 
         try:
-            grant_hint(current_app.db, g.tasks_cache, current_user.user, task_name, hint_name)
+            grant_hint(current_app.db, g.tasks_cache, current_user.user, task_name, hint_name, scoreboard=current_app.scoreboard)
         except HintNotFoundError:
             logger.warn(f"Unknown hint '{hint_name}' for task '{task_name}' requested by user '{current_user.user.login}'")
             return error_view(errors=[_("Hint not found.")], form=form)
@@ -155,6 +227,25 @@ class KyzylTasks:
         logger.info(f"Hint '{hint_name}' for task '{task_name}' requested by user '{current_user.user.login}' has been granted")
         return redirect(success_url, code=303)
 
+    def get_stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {
+            "claims": claim_stats.get_stats(),
+            "publish": publish_stats.get_stats(),
+            "dedupe": dedupe_stats.get_stats(),
+        }
+        if self.rate_limiter is not None:
+            stats["rate_limit"] = self.rate_limiter.get_stats()
+        if self.attempt_log is not None:
+            stats["attempt_log"] = self.attempt_log.get_stats()
+        if self.generation_queue is not None:
+            stats["generation_queue"] = self.generation_queue.get_stats()
+        if self.ready_tasks is not None:
+            stats["ready_tasks"] = self.ready_tasks.get_stats()
+        stats["trash"] = self.trash_janitor.get_stats()
+        with self._flushes_lock:
+            stats["flushes"] = {name: progress.__dict__.copy() for name, progress in self._flushes.items()}
+        return stats
+
     @login_required
     def flush_task_route(self, success_url, error_view, task_name):
         form = FlushTaskForm()
@@ -172,8 +263,40 @@ class KyzylTasks:
             logger.warn(f"Trying to access task '{task_name}' which is not available yet")
             abort(404)
 
-        flush_task(current_app.db, self.dynamic_attachments_path, g.tasks_cache, task_cache)
-        logger.info(f"Task {task_name}' has been flushed by user '{current_user.user.login}")
+        with self._flushes_lock:
+            progress = self._flushes.get(task_name)
+            if progress is not None and not progress.finished:
+                logger.warn(f"Task '{task_name}' is already being flushed")
+                return redirect(success_url, code=303)
+            progress = FlushProgress()
+            self._flushes[task_name] = progress
+
+        db = current_app.db
+        tasks_cache = g.tasks_cache
+        login = current_user.user.login
+        def report(deleted: int, total: int):
+            with self._flushes_lock:
+                progress.deleted = deleted
+                progress.total = total
+
+        def run_flush():
+            try:
+                deleted = flush_task(db, self.dynamic_attachments_path, tasks_cache, task_cache, progress=report)
+            except Exception as e:
+                logger.error(f"Failed to flush task '{task_name}'", exc_info=e)
+                with self._flushes_lock:
+                    progress.failed = True
+            else:
+                logger.info(f"Task '{task_name}' has been flushed by user '{login}', {deleted} instances deleted")
+                self.trash_janitor.wake_up()
+            finally:
+                db.remove()
+                with self._flushes_lock:
+                    progress.finished = True
+
+        # Don't block the request; progress is shown on the task page.
+        Thread(target=run_flush, name=f"kyzylborda-flush-{task_name}", daemon=True).start()
+        logger.info(f"Flushing task '{task_name}' requested by user '{login}'")
         return redirect(success_url, code=303)
 
     @login_required
@@ -193,7 +316,12 @@ class KyzylTasks:
             logger.warn(f"Trying to access task '{task_name}' which is not available yet")
             abort(404)
 
-        for _ in range(form.count.data):
-            generate_task(current_app.db, self.dynamic_attachments_path, g.tasks_cache, None, task_cache)
-        logger.info(f"Task {task_name}' has been pregenerated {form.count.data} times by user '{current_user.user.login}")
+        if self.generation_queue is not None:
+            for _ in range(form.count.data):
+                self.generation_queue.enqueue(g.tasks_cache, task_cache)
+            logger.info(f"Task {task_name}' has been queued for pregeneration {form.count.data} times by user '{current_user.user.login}")
+        else:
+            for _ in range(form.count.data):
+                generate_task(current_app.db, self.dynamic_attachments_path, g.tasks_cache, None, task_cache)
+            logger.info(f"Task {task_name}' has been pregenerated {form.count.data} times by user '{current_user.user.login}")
         return redirect(success_url, code=303)
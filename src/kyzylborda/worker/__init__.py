@@ -0,0 +1,89 @@
+import os
+import logging
+from argparse import ArgumentParser
+from typing import Optional, Dict, Any
+import yaml
+import sqlalchemy
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+
+from ..db import Base
+from ..utils import debounce
+from ..tasks import read_tasks
+from ..cache import TasksCache, build_tasks_cache
+from ..notify import NotifyListener
+from ..generation_jobs import GenerationWorker
+from ..generator_workers import retire_generator_workers
+
+
+logger = logging.getLogger(__name__)
+
+
+arg_parser = ArgumentParser(description="Run dynamic task generators for jobs queued in the database (GENERATION_QUEUE: database).")
+arg_parser.add_argument("-j", "--threads", type=int, default=os.cpu_count(), help="number of generators to run in parallel")
+arg_parser.add_argument("-i", "--poll-interval", type=float, default=5, help="seconds between checks for jobs when no notifications arrive")
+arg_parser.add_argument("config", metavar="CONFIG", help="path to web application config")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+
+    args = arg_parser.parse_args()
+    with open(args.config) as f:
+        config: Dict[str, Any] = yaml.load(f, Loader=yaml.FullLoader)
+
+    flag_secret_path = config.get("FLAG_SECRET_PATH", None)
+    if flag_secret_path:
+        with open(flag_secret_path, "rb") as f:
+            flag_secret: Optional[bytes] = f.read().strip()
+    else:
+        flag_secret = None
+
+    tasks_path = config["TASKS_PATH"]
+    tasks_cache: Optional[TasksCache] = None
+    def reload_tasks():
+        nonlocal tasks_cache
+        tasks_cache = build_tasks_cache(read_tasks(tasks_path, default_attrs=config.get("DEFAULT_TASK_ATTRS", {})), flag_secret=flag_secret)
+        logger.info(f"Tasks reloaded, {len(tasks_cache.tasks)} tasks total")
+        retire_generator_workers()
+
+    class ReloadTasksEventHandler(FileSystemEventHandler):
+        @debounce(2)
+        def on_any_event(self, event):
+            reload_tasks()
+
+    reload_tasks()
+    tasks_observer = Observer()
+    tasks_observer.schedule(ReloadTasksEventHandler(), tasks_path, recursive=True)
+    tasks_observer.start()
+
+    # A generating thread holds at most two connections: a session and an advisory lock. Plus the notification
+    # listener and lease renewal.
+    db_engine = sqlalchemy.create_engine(config["DATABASE"], pool_size=2 * args.threads + 2, max_overflow=args.threads)
+    Base.metadata.create_all(db_engine)
+    db = sqlalchemy.orm.scoped_session(sqlalchemy.orm.sessionmaker(bind=db_engine))
+
+    # Shared with web processes, possibly over network storage.
+    attachments_path = os.path.abspath(config["DYNAMIC_ATTACHMENTS_PATH"])
+    os.makedirs(attachments_path, exist_ok=True)
+
+    worker = GenerationWorker(
+        db,
+        db_engine,
+        attachments_path,
+        lambda: tasks_cache,
+        threads=args.threads,
+        poll_interval=args.poll_interval,
+        failure_backoff=config.get("GENERATION_FAILURE_BACKOFF", 5),
+    )
+    notify_listener = NotifyListener(db_engine)
+    worker.subscribe(notify_listener)
+    notify_listener.start()
+
+    logger.info(f"Running generation jobs in {args.threads} threads")
+    worker.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import time
+import logging
+import subprocess
+from argparse import ArgumentParser
+from typing import List, Dict, Any
+import yaml
+import sqlalchemy
+from sqlalchemy import select, func
+
+from ..db import Base, GeneratedTask, QueuedGeneration
+from ..tasks import read_tasks
+from ..cache import build_tasks_cache
+from ..generate import generator_key
+from ..generation_jobs import DatabaseGenerationQueue
+
+
+logger = logging.getLogger(__name__)
+
+
+arg_parser = ArgumentParser(description="Queue pre-generation jobs and run them with several local `kyzylborda.worker` processes, checking that every job is done exactly once. Use a test database: generated instances are kept.")
+arg_parser.add_argument("-w", "--workers", type=int, default=2, help="number of worker processes")
+arg_parser.add_argument("-j", "--threads", type=int, default=2, help="number of threads per worker")
+arg_parser.add_argument("-n", "--jobs", type=int, default=20, help="number of jobs to queue")
+arg_parser.add_argument("-t", "--timeout", type=float, default=600, help="seconds to wait for the queue to drain")
+arg_parser.add_argument("config", metavar="CONFIG", help="path to web application config")
+arg_parser.add_argument("task", metavar="TASK", help="dynamic task to pre-generate")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("sqlalchemy.engine").setLevel(logging.WARNING)
+
+    args = arg_parser.parse_args()
+    with open(args.config) as f:
+        config: Dict[str, Any] = yaml.load(f, Loader=yaml.FullLoader)
+
+    tasks_cache = build_tasks_cache(read_tasks(config["TASKS_PATH"], default_attrs=config.get("DEFAULT_TASK_ATTRS", {})))
+    task_cache = tasks_cache.tasks.get(args.task)
+    if task_cache is None or task_cache.task.generator is None:
+        logger.error(f"Task {args.task} doesn't exist or is not dynamic")
+        sys.exit(1)
+    generator = generator_key(tasks_cache, task_cache)
+
+    db_engine = sqlalchemy.create_engine(config["DATABASE"])
+    Base.metadata.create_all(db_engine)
+    unclaimed = select(func.count()).where(GeneratedTask.task_name == args.task, GeneratedTask.user_id.is_(None), GeneratedTask.substitutions.isnot(None))
+    with db_engine.connect() as conn:
+        initial = conn.execute(unclaimed).scalar()
+
+    queue = DatabaseGenerationQueue(db_engine, os.path.abspath(config["DYNAMIC_ATTACHMENTS_PATH"]))
+    for i in range(args.jobs):
+        queue.enqueue(tasks_cache, task_cache)
+
+    start = time.perf_counter()
+    workers: List[subprocess.Popen] = [
+        subprocess.Popen([sys.executable, "-m", "kyzylborda.worker", "-j", str(args.threads), args.config])
+        for i in range(args.workers)
+    ]
+    try:
+        while time.perf_counter() - start < args.timeout:
+            if queue.pending_pregenerations(generator) == 0:
+                break
+            time.sleep(0.2)
+        elapsed = time.perf_counter() - start
+        with db_engine.connect() as conn:
+            pending = conn.execute(select(func.count()).where(QueuedGeneration.generator == generator, QueuedGeneration.user_id.is_(None))).scalar()
+            generated = conn.execute(unclaimed).scalar() - initial
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+    output = {
+        "workers": args.workers,
+        "threads": args.threads,
+        "jobs": args.jobs,
+        "generated": generated,
+        "pending": pending,
+        "time": elapsed,
+        "per_second": generated / elapsed,
+    }
+    json.dump(output, sys.stdout, indent=2)
+    print()
+    # More instances than jobs means that some jobs have run twice.
+    if pending > 0 or generated != args.jobs:
+        logger.error(f"Expected {args.jobs} generated instances, got {generated}; {pending} jobs left in the queue")
+        sys.exit(1)